@@ -0,0 +1,160 @@
+import os
+import sys
+import time
+import random
+import difflib
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from diff_engine import get_diff_content  # noqa: E402
+
+
+def get_ndiff_content(old_content, new_content):
+    # 置き換え前の get_diff_content / get_diff_to_file と同じ処理
+    diff = difflib.ndiff(
+        old_content.splitlines(),
+        new_content.splitlines()
+    )
+    diff_content = []
+    for line in diff:
+        if line.startswith('-'):
+            diff_content.append(f"--{line[2:]}")
+        elif line.startswith('+'):
+            diff_content.append(f"++{line[2:]}")
+        elif line.startswith(' '):
+            diff_content.append(line[2:])
+    return '\n'.join(diff_content)
+
+
+def make_document(rng, line_count):
+    # 見出し・箇条書き・本文・空行を含むマークダウン風の文書を作る。「--」「++」で始まる行は含めない
+    lines = []
+    section = 0
+    while len(lines) < line_count:
+        section += 1
+        lines.append(f"## セクション{section} の見出し")
+        lines.append("")
+        for paragraph in range(rng.randint(2, 6)):
+            if rng.random() < 0.4:
+                for item in range(rng.randint(2, 5)):
+                    lines.append(f"- 項目{section}-{paragraph}-{item}: 担当者 {rng.randint(1, 50)} が {rng.randint(1, 30)} 日までに対応する")
+            else:
+                lines.append(f"セクション{section}の段落{paragraph}です。ユーザーストーリー {rng.randint(1, 10000)} の受け入れ条件を満たすこと。")
+            lines.append("")
+    return lines[:line_count]
+
+
+def edit_document(rng, lines, edit_count):
+    # 行の書き換え・挿入・削除を混ぜて新しい版を作る
+    lines = list(lines)
+    for _ in range(edit_count):
+        i = rng.randrange(len(lines))
+        kind = rng.random()
+        if kind < 0.5:
+            lines[i] = lines[i] + f" （修正{rng.randint(1, 100)}）"
+        elif kind < 0.75:
+            lines[i:i] = [f"追加された行 {rng.randint(1, 100000)}" for _ in range(rng.randint(1, 3))]
+        else:
+            del lines[i:i + rng.randint(1, 3)]
+    return lines
+
+
+def make_rewritten_document(rng, lines):
+    # 全ての行を書き換えた版を作る。置換範囲が文書全体になる
+    return [line.replace("セクション", "章") + f" （改訂{rng.randint(1, 100)}）" for line in lines]
+
+
+def make_repeated_document(rng, line_count):
+    # チェックリストのように同じ行が何度も現れる文書を作る
+    templates = ["- [ ] 確認する", "- [x] 確認した", "", "### 確認項目"]
+    return [rng.choice(templates) for _ in range(line_count)]
+
+
+def reconstruct(diff_content):
+    # 出力から変更前と変更後の行を復元する
+    old_lines = []
+    new_lines = []
+    for line in diff_content.split('\n'):
+        if line.startswith('--'):
+            old_lines.append(line[2:])
+        elif line.startswith('++'):
+            new_lines.append(line[2:])
+        else:
+            old_lines.append(line)
+            new_lines.append(line)
+    return old_lines, new_lines
+
+
+def measure(function, old_content, new_content, repeat):
+    started_at = time.perf_counter()
+    for _ in range(repeat):
+        result = function(old_content, new_content)
+    return (time.perf_counter() - started_at) / repeat, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='diff_engine と difflib.ndiff の速度と出力を比較する')
+    parser.add_argument('--lines', type=int, nargs='+', default=[500, 2000, 10000])
+    parser.add_argument('--edits', type=int, default=20)
+    parser.add_argument('--documents', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rewrite-lines', type=int, default=400)
+    parser.add_argument('--repeated-lines', type=int, default=15000)
+    parser.add_argument('--large-time-limit', type=float, default=5.0,
+                        help='大きな変更1件あたりの処理時間の上限（秒）')
+    parser.add_argument('--ndiff-large', action='store_true',
+                        help='大きな変更でもndiffの時間を計る（数分掛かるか、再帰の上限を超える）')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    failures = 0
+    for line_count in args.lines:
+        ndiff_time = engine_time = 0
+        for _ in range(args.documents):
+            old_lines = make_document(rng, line_count)
+            new_lines = edit_document(rng, old_lines, args.edits)
+            old_content = '\n'.join(old_lines)
+            new_content = '\n'.join(new_lines)
+            elapsed, expected = measure(get_ndiff_content, old_content, new_content, args.repeat)
+            ndiff_time += elapsed
+            elapsed, actual = measure(get_diff_content, old_content, new_content, args.repeat)
+            engine_time += elapsed
+            if actual != expected:
+                failures += 1
+                print(f"ndiffと出力が一致しません: {line_count}行")
+        print(f"{line_count:>6}行: ndiff {ndiff_time / args.documents * 1000:9.2f}ms"
+              f" / diff_engine {engine_time / args.documents * 1000:9.2f}ms"
+              f" ({ndiff_time / engine_time:.1f}倍)")
+    # 置換範囲が大きい場合はDIFF_FANCY_REPLACE_LIMITを超えるため、ndiffとの一致ではなく差分として正しいことと処理時間を確認する
+    old_lines = make_document(rng, args.rewrite_lines)
+    repeated_lines = make_repeated_document(rng, args.repeated_lines)
+    cases = [
+        (f"全体の書き換え {args.rewrite_lines}行", old_lines, make_rewritten_document(rng, old_lines)),
+        (f"同じ行の繰り返し {args.repeated_lines}行", repeated_lines, edit_document(rng, repeated_lines, args.edits)),
+    ]
+    for name, old_lines, new_lines in cases:
+        old_content = '\n'.join(old_lines)
+        new_content = '\n'.join(new_lines)
+        engine_time, actual = measure(get_diff_content, old_content, new_content, 1)
+        if reconstruct(actual) != (old_content.splitlines(), new_content.splitlines()):
+            failures += 1
+            print(f"差分から元の文書を復元できません: {name}")
+        if engine_time > args.large_time_limit:
+            failures += 1
+            print(f"処理時間が上限を超えました: {name}")
+        result = f"{name}: diff_engine {engine_time * 1000:9.2f}ms"
+        if args.ndiff_large:
+            try:
+                ndiff_time, _ = measure(get_ndiff_content, old_content, new_content, 1)
+                result += f" / ndiff {ndiff_time * 1000:9.2f}ms"
+            except RecursionError:
+                result += " / ndiffは再帰の上限を超えました"
+        print(result)
+    if failures:
+        print(f"確認に失敗した文書: {failures}件")
+        sys.exit(1)
+    print("小さな編集ではndiffと同じ出力に、大きな変更では正しい差分になることを確認しました。")
+
+if __name__ == '__main__':
+    main()
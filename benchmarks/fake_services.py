@@ -0,0 +1,276 @@
+import os
+import sys
+import json
+import time
+import asyncio
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from http_server import LocalHttpServer  # noqa: E402
+
+BASE_TIME = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+class FakeService:
+    # 偽サーバーの共通部分。応答の遅延、リクエスト数、編集から書き戻しまでの時間を記録する
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.server = LocalHttpServer(self.handle_request, '127.0.0.1', 0)
+        self.request_counts = Counter()
+        self.clock = 0
+        self.edited_at = {}
+        self.write_back_latencies = []
+
+    async def start(self):
+        await self.server.start()
+        return self
+
+    async def stop(self):
+        await self.server.stop()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.port}"
+
+    def get_request_count(self):
+        return sum(self.request_counts.values())
+
+    def tick(self):
+        # 更新のたびに1分進めた時刻を返す（Notionのlast_edited_timeは分単位のため）
+        self.clock += 1
+        return (BASE_TIME + timedelta(minutes=self.clock)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+    def mark_edited(self, key):
+        self.edited_at.setdefault(key, time.monotonic())
+
+    def mark_written(self, key):
+        edited_at = self.edited_at.pop(key, None)
+        if edited_at is not None:
+            self.write_back_latencies.append(time.monotonic() - edited_at)
+
+    async def handle_request(self, method, path, headers, body):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        url = urlsplit(path)
+        data = json.loads(body) if body else {}
+        status, response = self.route(method, url.path, parse_qs(url.query), data)
+        return status, 'application/json', json.dumps(response, ensure_ascii=False)
+
+    def route(self, method, path, query, data):
+        raise NotImplementedError
+
+
+class FakeGitHubServer(FakeService):
+    # GitHubAgentが送るGraphQLクエリだけを、クエリ文字列の特徴で見分けて応答する
+    def __init__(self, item_count, latency=0.0, max_page_size=100, body_lines=20):
+        super().__init__(latency)
+        self.max_page_size = max_page_size
+        self.project = {'id': 'PVT_bench', 'title': 'bench', 'shortDescription': 'ベンチマーク用のプロジェクト'}
+        self.items = [self.create_item(i, body_lines) for i in range(item_count)]
+        self.items_by_id = {item['id']: item for item in self.items}
+        self.items_by_draft_id = {item['draftIssueId']: item for item in self.items}
+
+    def create_item(self, i, body_lines):
+        body = "\n".join([f"## PBI{i} の受け入れ条件"] + [f"- 条件{i}-{line}" for line in range(body_lines)])
+        return {'id': f'PVTI_{i}', 'draftIssueId': f'DI_{i}', 'title': f'PBI{i}', 'body': body, 'updatedAt': self.tick()}
+
+    def edit_items(self, rng, count):
+        # ランダムに選んだPBIの本文に1行追記する
+        edited = rng.sample(self.items, min(count, len(self.items)))
+        for item in edited:
+            item['body'] += f"\n- 追記 {self.clock}"
+            item['updatedAt'] = self.tick()
+            self.mark_edited(item['id'])
+        return [item['id'] for item in edited]
+
+    def to_node(self, item):
+        return {'id': item['id'], 'content': {'id': item['draftIssueId'], 'title': item['title'], 'body': item['body'], 'updatedAt': item['updatedAt']}}
+
+    def get_rate_limit(self):
+        return {'cost': 1, 'remaining': 5000, 'resetAt': (BASE_TIME + timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%SZ')}
+
+    def route(self, method, path, query, data):
+        if method != 'POST' or path != '/graphql':
+            return 404, {'message': 'Not Found'}
+        graphql_query = data.get('query', '')
+        variables = data.get('variables') or {}
+        if 'updateProjectV2DraftIssue' in graphql_query:
+            self.request_counts['mutation'] += 1
+            item = self.items_by_draft_id.get(variables['draftIssueId'])
+            if item is None:
+                return 200, {'errors': [{'message': 'Could not resolve to a node'}]}
+            item['title'] = variables['title']
+            item['body'] = variables['body']
+            item['updatedAt'] = self.tick()
+            self.mark_written(item['id'])
+            return 200, {'data': {'updateProjectV2DraftIssue': {'draftIssue': {'id': item['draftIssueId'], 'title': item['title'], 'body': item['body']}}}}
+        if 'projectsV2' in graphql_query:
+            self.request_counts['projects'] += 1
+            return 200, {'data': {'repository': {'projectsV2': {'nodes': [self.project]}}}}
+        if 'nodes(ids:' in graphql_query:
+            self.request_counts['nodes'] += 1
+            nodes = [self.to_node(self.items_by_id[item_id]) if item_id in self.items_by_id else None for item_id in variables['ids']]
+            return 200, {'data': {'rateLimit': self.get_rate_limit(), 'nodes': nodes}}
+        if 'items(first:' in graphql_query:
+            self.request_counts['items'] += 1
+            first = min(variables.get('first', 20), self.max_page_size)
+            start = int(variables.get('after') or 0)
+            page = self.items[start:start + first]
+            end = start + len(page)
+            return 200, {'data': {'rateLimit': self.get_rate_limit(), 'node': {'items': {
+                'pageInfo': {'hasNextPage': end < len(self.items), 'endCursor': str(end)},
+                'nodes': [self.to_node(item) for item in page]
+            }}}}
+        return 200, {'errors': [{'message': 'Unsupported query'}]}
+
+
+class FakeNotionServer(FakeService):
+    # データベース1件・ページ1件と、そのページのブロックを持つNotion REST APIの偽物。
+    # ページ直下のnested_every件ごとに1件のブロックはnested_children件の子ブロックを持つ
+    def __init__(self, block_count, latency=0.0, max_page_size=100, page_title='bench', nested_every=10, nested_children=2):
+        super().__init__(latency)
+        self.max_page_size = max_page_size
+        self.page = {'id': 'page-bench', 'title': page_title, 'last_edited_time': self.tick()}
+        self.children = {self.page['id']: [self.create_block(i) for i in range(block_count)]}
+        self.blocks = {block['id']: block for block in self.children[self.page['id']]}
+        if nested_every:
+            for block in self.children[self.page['id']][::nested_every]:
+                children = [self.create_block(f"{block['id'][len('block-'):]}-{i}") for i in range(nested_children)]
+                block['has_children'] = bool(children)
+                self.children[block['id']] = children
+                self.blocks.update((child['id'], child) for child in children)
+        self.block_counter = block_count
+
+    def create_block(self, i, text=None):
+        text = text if text is not None else f"ブロック{i}の本文です。"
+        return {
+            'object': 'block',
+            'id': f'block-{i}',
+            'type': 'paragraph',
+            'paragraph': {'rich_text': [{'type': 'text', 'text': {'content': text}, 'plain_text': text}]},
+            'has_children': False,
+            'last_edited_time': self.page['last_edited_time']
+        }
+
+    def set_text(self, block, text):
+        block['paragraph']['rich_text'] = [{'type': 'text', 'text': {'content': text}, 'plain_text': text}]
+
+    def edit_blocks(self, rng, count):
+        # ページ直下のブロックの本文を書き換え、ページとブロックの更新日時を進める
+        edited = rng.sample(self.children[self.page['id']], min(count, len(self.children[self.page['id']])))
+        now = self.tick()
+        for block in edited:
+            self.set_text(block, block['paragraph']['rich_text'][0]['text']['content'] + f" 追記{self.clock}")
+            block['last_edited_time'] = now
+        self.page['last_edited_time'] = now
+        self.mark_edited(self.page['id'])
+        return [block['id'] for block in edited]
+
+    def to_page(self):
+        return {
+            'object': 'page',
+            'id': self.page['id'],
+            'last_edited_time': self.page['last_edited_time'],
+            'properties': {'名前': {'type': 'title', 'title': [{'plain_text': self.page['title'], 'text': {'content': self.page['title']}}]}}
+        }
+
+    def route(self, method, path, query, data):
+        parts = path.strip('/').split('/')
+        if parts[:1] == ['v1']:
+            parts = parts[1:]
+        if method == 'POST' and len(parts) == 3 and parts[0] == 'databases' and parts[2] == 'query':
+            self.request_counts['database_query'] += 1
+            return 200, {'object': 'list', 'results': [self.to_page()], 'has_more': False, 'next_cursor': None}
+        if method == 'GET' and len(parts) == 2 and parts[0] == 'pages':
+            self.request_counts['page'] += 1
+            if parts[1] != self.page['id']:
+                return 404, {'message': 'page not found'}
+            return 200, self.to_page()
+        if len(parts) == 3 and parts[0] == 'blocks' and parts[2] == 'children':
+            if method == 'GET':
+                self.request_counts['block_children'] += 1
+                children = self.children.get(parts[1], [])
+                page_size = min(int(query.get('page_size', ['100'])[0]), self.max_page_size)
+                start = int(query.get('start_cursor', ['0'])[0])
+                page = children[start:start + page_size]
+                end = start + len(page)
+                return 200, {'object': 'list', 'results': page, 'has_more': end < len(children), 'next_cursor': str(end) if end < len(children) else None}
+            if method == 'PATCH':
+                self.request_counts['append'] += 1
+                parent = self.blocks.get(parts[1])
+                if parent is None and parts[1] != self.page['id']:
+                    return 404, {'message': 'block not found'}
+                now = self.tick()
+                appended = []
+                for child in data.get('children', []):
+                    block = self.create_block(self.block_counter, child['paragraph']['rich_text'][0]['text']['content'])
+                    block['last_edited_time'] = now
+                    self.block_counter += 1
+                    self.blocks[block['id']] = block
+                    appended.append(block)
+                self.children.setdefault(parts[1], []).extend(appended)
+                if parent is not None:
+                    parent['has_children'] = True
+                    parent['last_edited_time'] = now
+                self.page['last_edited_time'] = now
+                self.mark_written(self.page['id'])
+                return 200, {'object': 'list', 'results': appended}
+        return 404, {'message': 'Not Found'}
+
+
+class FakeOpenAIServer(FakeService):
+    # chat.completionsの偽物。コメントの配列（一括依頼ではIDごとの配列）をJSONで返し、stream=trueならSSEで返す
+    def __init__(self, latency=0.0, comments_per_request=2, chunk_size=16):
+        super().__init__(latency)
+        self.comments_per_request = comments_per_request
+        self.chunk_size = chunk_size
+        # 全リクエストの入力・出力の文字数の合計
+        self.prompt_characters = 0
+        self.completion_characters = 0
+
+    def create_comments(self):
+        # 位置が空文字列のコメントは先頭行の直後に挿入される
+        return [{'type': 'レビュー', 'comment': f'ベンチマーク用のコメント{i}', 'position': ''} for i in range(self.comments_per_request)]
+
+    def create_content(self, messages):
+        human_message = messages[-1]['content'] if messages else ''
+        ids = [line[len('=== ID: '):-len(' ===')] for line in human_message.split('\n') if line.startswith('=== ID: ')]
+        if ids:
+            return json.dumps({item_id: self.create_comments() for item_id in ids}, ensure_ascii=False)
+        return json.dumps(self.create_comments(), ensure_ascii=False)
+
+    async def handle_request(self, method, path, headers, body):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method != 'POST' or not urlsplit(path).path.endswith('/chat/completions'):
+            return 404, 'application/json', json.dumps({'error': {'message': 'Not Found'}})
+        data = json.loads(body)
+        self.request_counts['stream' if data.get('stream') else 'completion'] += 1
+        messages = data.get('messages', [])
+        content = self.create_content(messages)
+        # 使用量はこのリクエストの分だけを返す（1文字を1トークンとみなす）
+        prompt_tokens = sum(len(message.get('content') or '') for message in messages)
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': len(content), 'total_tokens': prompt_tokens + len(content)}
+        self.prompt_characters += prompt_tokens
+        self.completion_characters += len(content)
+        if not data.get('stream'):
+            return 200, 'application/json', json.dumps({
+                'id': 'chatcmpl-bench', 'object': 'chat.completion', 'created': 0, 'model': data.get('model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                'usage': usage
+            }, ensure_ascii=False)
+        events = []
+        for start in range(0, len(content), self.chunk_size):
+            events.append({'index': 0, 'delta': {'content': content[start:start + self.chunk_size]}, 'finish_reason': None})
+        events.append({'index': 0, 'delta': {}, 'finish_reason': 'stop'})
+        chunks = [{'choices': [event]} for event in events]
+        if (data.get('stream_options') or {}).get('include_usage'):
+            # 使用量は最後に選択肢のないチャンクで返される
+            chunks.append({'choices': [], 'usage': usage})
+        lines = [
+            "data: " + json.dumps({'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk', 'created': 0, 'model': data.get('model'), **chunk}, ensure_ascii=False)
+            for chunk in chunks
+        ]
+        return 200, 'text/event-stream', "\n\n".join(lines + ["data: [DONE]"]) + "\n\n"
@@ -0,0 +1,260 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import resource
+import tempfile
+import contextlib
+import subprocess
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_PATH)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# 各アシスタントは読み込み時にOPENAI_API_KEYを参照するため、偽サーバー用の値を先に入れておく
+os.environ.setdefault('OPENAI_API_KEY', 'bench')
+
+SCENARIOS = ('github', 'notion', 'markdown')
+# 前回の結果と比べて、この割合以上悪化した指標を退行とみなす
+REGRESSION_METRICS = ('requests_per_edit_cycle', 'requests_per_idle_cycle', 'cpu_seconds_per_cycle', 'write_back_latency_p95', 'max_rss_mb')
+
+
+def create_http_client(requests_per_second):
+    from http_client import AsyncHttpClient
+    from request_budgeter import RequestBudgeter, ApiBudget
+    budgeter = RequestBudgeter()
+    for name in budgeter.budgets:
+        budgeter.budgets[name] = ApiBudget(name, requests_per_second, requests_per_second)
+    return AsyncHttpClient(budgeter=budgeter)
+
+
+def create_llm_agent(openai):
+    from llm_agent import LLMAgent
+    return LLMAgent(cache_dir=None, base_url=f"{openai.base_url}/v1")
+
+
+def get_percentile(values, percentile):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile))]
+
+
+async def run_cycles(run_cycle, services, args, latencies):
+    # 編集を入れるサイクルと、何も変えないサイクルのリクエスト数・時間を分けて記録する
+    edit_requests, idle_requests, wall_times = [], [], []
+    cpu_started_at = time.process_time()
+    for cycle in range(args.cycles + args.idle_cycles):
+        edits = args.edits if cycle < args.cycles else 0
+        requests_before = sum(service.get_request_count() for service in services)
+        started_at = time.perf_counter()
+        await run_cycle(edits)
+        wall_times.append(time.perf_counter() - started_at)
+        requests = sum(service.get_request_count() for service in services) - requests_before
+        (edit_requests if edits else idle_requests).append(requests)
+    cpu_seconds = time.process_time() - cpu_started_at
+    cycles = args.cycles + args.idle_cycles
+    return {
+        'requests_per_edit_cycle': sum(edit_requests) / len(edit_requests) if edit_requests else None,
+        'requests_per_idle_cycle': sum(idle_requests) / len(idle_requests) if idle_requests else None,
+        'wall_seconds_per_cycle': sum(wall_times) / cycles,
+        'cpu_seconds_per_cycle': cpu_seconds / cycles,
+        'write_back_latency_p50': get_percentile(latencies, 0.5),
+        'write_back_latency_p95': get_percentile(latencies, 0.95),
+        'write_backs': len(latencies),
+    }
+
+
+async def run_github(args, size, work_path):
+    from fake_services import FakeGitHubServer, FakeOpenAIServer
+    from github_agent import GitHubAgent
+    from github_assistant import GitHubAssistant
+    rng = random.Random(args.seed)
+    github = await FakeGitHubServer(size, args.latency, args.page_size).start()
+    openai = await FakeOpenAIServer(args.llm_latency).start()
+    try:
+        github_agent = GitHubAgent(http_client=create_http_client(args.requests_per_second), owner='bench', repo='bench', project_name='bench', token='bench', api_url=github.base_url)
+        assistant = GitHubAssistant('bench', github_agent=github_agent, llm_agent=create_llm_agent(openai), projects_path=work_path, batch_window=args.batch_window)
+        await assistant.prepare()
+        # langchainの読み込みは起動時間としてstartup_benchmark.pyで計るので、ここでは済ませておく
+        await assistant.llm_agent.start_warm_up()
+
+        async def run_cycle(edits):
+            github.edit_items(rng, edits)
+            await assistant.detect_update()
+
+        return await run_cycles(run_cycle, [github, openai], args, github.write_back_latencies)
+    finally:
+        await github.stop()
+        await openai.stop()
+
+
+async def run_notion(args, size, work_path):
+    from fake_services import FakeNotionServer, FakeOpenAIServer
+    from notion_agent import NotionAgent
+    from notion_assistant import NotionAssistant
+    rng = random.Random(args.seed)
+    notion = await FakeNotionServer(size, args.latency, args.page_size).start()
+    openai = await FakeOpenAIServer(args.llm_latency).start()
+    try:
+        notion_agent = NotionAgent('bench', 'database-bench', http_client=create_http_client(args.requests_per_second), api_url=f"{notion.base_url}/v1")
+        assistant = NotionAssistant(
+            'bench', 'database-bench', 'bench', 'bench', None,
+            os.path.join(work_path, 'page_content.md'), os.path.join(work_path, 'page_content_diff.md'),
+            auto_mode=True, debounce_seconds=0, notion_agent=notion_agent, llm_agent=create_llm_agent(openai), prompt='ベンチマーク用のプロンプト')
+        await assistant.initialize_content()
+        await assistant.llm_agent.start_warm_up()
+
+        async def run_cycle(edits):
+            # 1回目のポーリングで変更を検知し、2回目でLLMに送信して書き戻す
+            notion.edit_blocks(rng, edits)
+            await assistant.poll()
+            await assistant.poll()
+
+        return await run_cycles(run_cycle, [notion, openai], args, notion.write_back_latencies)
+    finally:
+        await notion.stop()
+        await openai.stop()
+
+
+async def run_markdown(args, size, work_path):
+    from fake_services import FakeOpenAIServer
+    from markdown_assistant import MarkdownAssistant
+    rng = random.Random(args.seed)
+    openai = await FakeOpenAIServer(args.llm_latency).start()
+    input_md_file_path = os.path.join(work_path, 'input.md')
+    prompt_file_path = os.path.join(work_path, 'prompt.txt')
+    lines = [f"- 行{i}の本文です。" for i in range(size)]
+    with open(input_md_file_path, 'w', encoding='utf-8') as file:
+        file.write("\n".join(lines))
+    with open(prompt_file_path, 'w', encoding='utf-8') as file:
+        file.write('ベンチマーク用のプロンプト')
+    latencies = []
+    try:
+        assistant = MarkdownAssistant(
+            'bench', input_md_file_path, prompt_file_path,
+            os.path.join(work_path, 'page_content.md'), os.path.join(work_path, 'page_content_diff.md'),
+            auto_mode=True, llm_agent=create_llm_agent(openai))
+        assistant.initialize_content()
+        await assistant.llm_agent.start_warm_up()
+
+        async def run_cycle(edits):
+            # ファイルの監視は挟まず、変更を検知してからの処理だけを計る
+            for i in rng.sample(range(len(lines)), min(edits, len(lines))):
+                lines[i] += " 追記"
+            with open(input_md_file_path, 'w', encoding='utf-8') as file:
+                file.write("\n".join(lines))
+            edited_at = time.monotonic()
+            await assistant.fetch_and_save_content()
+            if edits:
+                latencies.append(time.monotonic() - edited_at)
+
+        return await run_cycles(run_cycle, [openai], args, latencies)
+    finally:
+        await openai.stop()
+
+
+async def run_scenario(args, scenario, size):
+    runners = {'github': run_github, 'notion': run_notion, 'markdown': run_markdown}
+    work_path = tempfile.mkdtemp(prefix=f'bench-{scenario}-')
+    try:
+        # アシスタントのログは結果の表示の邪魔になるので捨てる
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            result = await runners[scenario](args, size, work_path)
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+    result['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return result
+
+
+def run_in_subprocess(args, scenario, size):
+    # 最大メモリ使用量を規模ごとに測るため、1つの組み合わせごとに別プロセスで実行する
+    command = [
+        sys.executable, os.path.abspath(__file__), '--run-one', scenario, str(size),
+        '--cycles', str(args.cycles), '--idle-cycles', str(args.idle_cycles), '--edits', str(args.edits),
+        '--latency', str(args.latency), '--llm-latency', str(args.llm_latency), '--page-size', str(args.page_size),
+        '--batch-window', str(args.batch_window), '--requests-per-second', str(args.requests_per_second), '--seed', str(args.seed)
+    ]
+    completed = subprocess.run(command, cwd=REPOSITORY_PATH, capture_output=True, text=True)
+    if completed.returncode != 0:
+        print(completed.stderr)
+        return None
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def format_value(value, digits=3):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return f"{value:.{digits}f}"
+    return str(value)
+
+
+def compare_results(results, baseline, threshold):
+    regressions = []
+    for key, result in results.items():
+        previous = baseline.get(key)
+        if not previous or not result:
+            continue
+        for metric in REGRESSION_METRICS:
+            if result.get(metric) is None or not previous.get(metric):
+                continue
+            change = (result[metric] - previous[metric]) / previous[metric]
+            if change > threshold:
+                regressions.append(f"{key} {metric}: {format_value(previous[metric])} -> {format_value(result[metric])} ({change * 100:+.0f}%)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='偽のGitHub・Notion・OpenAIサーバーを相手に各アシスタントの1サイクルあたりのコストを測る')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000], help='PBI数（Notionはブロック数、Markdownは行数）')
+    parser.add_argument('--cycles', type=int, default=5, help='編集を入れるサイクル数')
+    parser.add_argument('--idle-cycles', type=int, default=5, help='何も変更しないサイクル数')
+    parser.add_argument('--edits', type=int, default=3, help='1サイクルあたりに編集する件数')
+    parser.add_argument('--latency', type=float, default=0.0, help='GitHub・Notionの偽サーバーの応答遅延（秒）')
+    parser.add_argument('--llm-latency', type=float, default=0.0, help='OpenAIの偽サーバーの応答遅延（秒）')
+    parser.add_argument('--page-size', type=int, default=100, help='偽サーバーが1回に返す最大件数')
+    parser.add_argument('--batch-window', type=float, default=0.5, help='GitHubAssistantのLLM一括依頼の待ち時間（0で無効）')
+    parser.add_argument('--requests-per-second', type=float, default=1000, help='レート制限の予算（実際の制限で測る場合は小さくする）')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='結果をJSONで保存するパス')
+    parser.add_argument('--baseline', help='比較する前回の結果のJSON')
+    parser.add_argument('--threshold', type=float, default=0.2, help='退行とみなす悪化の割合')
+    parser.add_argument('--run-one', nargs=2, metavar=('SCENARIO', 'SIZE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        os.chdir(REPOSITORY_PATH)
+        scenario, size = args.run_one
+        print(json.dumps(asyncio.run(run_scenario(args, scenario, int(size)))))
+        return
+
+    results = {}
+    columns = ('requests_per_edit_cycle', 'requests_per_idle_cycle', 'wall_seconds_per_cycle', 'cpu_seconds_per_cycle', 'write_back_latency_p50', 'write_back_latency_p95', 'max_rss_mb')
+    print(" ".join([f"{'scenario':>9}", f"{'size':>6}"] + [f"{column:>24}" for column in columns]))
+    for scenario in args.scenarios:
+        for size in args.sizes:
+            result = run_in_subprocess(args, scenario, size)
+            results[f"{scenario}:{size}"] = result
+            if result is None:
+                print(f"{scenario:>9} {size:>6} 失敗しました")
+                continue
+            print(" ".join([f"{scenario:>9}", f"{size:>6}"] + [f"{format_value(result[column]):>24}" for column in columns]))
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as file:
+            regressions = compare_results(results, json.load(file), args.threshold)
+        for regression in regressions:
+            print(f"退行: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
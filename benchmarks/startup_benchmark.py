@@ -0,0 +1,98 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ('cli', 'llm_agent', 'github_assistant', 'notion_assistant', 'markdown_assistant', 'text', 'github_daemon', 'notion_database_watcher')
+
+
+def run_python(arguments):
+    # 新しいプロセスで実行し、インタープリタの起動を含めた実時間を返す
+    started_at = time.perf_counter()
+    completed = subprocess.run([sys.executable] + arguments, cwd=REPOSITORY_PATH, capture_output=True, text=True)
+    elapsed = time.perf_counter() - started_at
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else f"exit {completed.returncode}")
+    return elapsed, completed.stdout
+
+
+async def measure_github_prepare(item_count, latency):
+    # 偽のGitHubサーバーを相手に、モジュールの読み込みからprepare()の完了までを計る
+    sys.path.insert(0, REPOSITORY_PATH)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from fake_services import FakeGitHubServer
+    github = await FakeGitHubServer(item_count, latency).start()
+    try:
+        with tempfile.TemporaryDirectory() as projects_path:
+            started_at = time.perf_counter()
+            from github_agent import GitHubAgent
+            from github_assistant import GitHubAssistant
+            github_agent = GitHubAgent(owner='bench', repo='bench', project_name='bench', token='bench', api_url=github.base_url)
+            assistant = GitHubAssistant('bench', github_agent=github_agent, projects_path=projects_path)
+            await assistant.prepare()
+            return time.perf_counter() - started_at
+    finally:
+        await github.stop()
+
+
+def summarize(times):
+    return {'median': statistics.median(times), 'min': min(times), 'max': max(times)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CLIと各モジュールの起動時間を、それぞれ新しいプロセスで計る')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--items', type=int, default=100, help='prepare()で取得する偽のPBIの数')
+    parser.add_argument('--latency', type=float, default=0.05, help='偽のGitHubサーバーの応答遅延（秒）')
+    parser.add_argument('--save', help='結果をJSONで保存するパス')
+    parser.add_argument('--run-prepare', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_prepare:
+        os.chdir(REPOSITORY_PATH)
+        os.environ.setdefault('OPENAI_API_KEY', 'bench')
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                elapsed = asyncio.run(measure_github_prepare(args.items, args.latency))
+            finally:
+                sys.stdout = stdout
+        print(json.dumps({'seconds': elapsed}))
+        return
+
+    cases = [('python -c pass', ['-c', 'pass']), ('cli.py --help', ['cli.py', '--help'])]
+    cases += [(f'import {module}', ['-c', f'import {module}']) for module in MODULES]
+    results = {}
+    print(f"{'case':<36}{'median':>10}{'min':>10}{'max':>10}")
+    for name, arguments in cases:
+        try:
+            times = [run_python(arguments)[0] for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(f"{name:<36} 失敗しました: {e}")
+            continue
+        results[name] = summarize(times)
+        print(f"{name:<36}" + "".join(f"{results[name][key]:>10.3f}" for key in ('median', 'min', 'max')))
+
+    # 読み込みとprepare()の時間はプロセス内で計るため、インタープリタの起動は含まない
+    name = f'github prepare ({args.items} items)'
+    prepare_arguments = [os.path.abspath(__file__), '--run-prepare', '--items', str(args.items), '--latency', str(args.latency)]
+    try:
+        times = [json.loads(run_python(prepare_arguments)[1].strip().splitlines()[-1])['seconds'] for _ in range(args.repeat)]
+        results[name] = summarize(times)
+        print(f"{name:<36}" + "".join(f"{results[name][key]:>10.3f}" for key in ('median', 'min', 'max')))
+    except RuntimeError as e:
+        print(f"{name:<36} 失敗しました: {e}")
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import os
+import sys
+import asyncio
+import argparse
+
+# 各アシスタントのモジュールは選ばれたサブコマンドの中で読み込み、起動を速くする
+
+
+def run_github(args):
+    if args.config:
+        from github_daemon import GitHubDaemon, load_targets
+        return GitHubDaemon(load_targets(args.config)).run_schedule()
+    from github_assistant import GitHubAssistant
+    project_name = args.project or os.getenv('PROJECT_NAME')
+    if not project_name:
+        sys.exit("--project か PROJECT_NAME を指定してください。")
+    return GitHubAssistant(project_name).run_schedule()
+
+
+def run_notion(args):
+    import notion_assistant
+    if args.database:
+        import notion_database_watcher
+        auto_mode = notion_database_watcher.auto_mode if args.auto is None else args.auto
+        return notion_database_watcher.NotionDatabaseWatcher(
+            notion_assistant.NOTION_API_KEY, notion_assistant.DATABASE_ID, notion_assistant.OPENAI_API_KEY,
+            args.prompt, notion_database_watcher.pages_path, auto_mode).run_schedule()
+    auto_mode = notion_assistant.auto_mode if args.auto is None else args.auto
+    return notion_assistant.NotionAssistant(
+        notion_assistant.NOTION_API_KEY, notion_assistant.DATABASE_ID, args.page or notion_assistant.PAGE_NAME,
+        notion_assistant.OPENAI_API_KEY, args.prompt, notion_assistant.md_file_path, notion_assistant.diff_file_path,
+        auto_mode).run_schedule()
+
+
+def run_markdown(args):
+    import markdown_assistant
+    auto_mode = markdown_assistant.auto_mode if args.auto is None else args.auto
+    return markdown_assistant.MarkdownAssistant(
+        markdown_assistant.OPENAI_API_KEY, args.input, args.prompt, markdown_assistant.md_file_path,
+        markdown_assistant.diff_file_path, auto_mode).run_schedule()
+
+
+def run_text(args):
+    import text
+    return text.monitor_files(args.input, args.prompt, args.output)
+
+
+def add_auto_mode_arguments(parser):
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--auto', dest='auto', action='store_true', default=None, help='変更が落ち着いたら自動でLLMに送信する')
+    group.add_argument('--manual', dest='auto', action='store_false', help='「user:」と書いたときだけLLMに送信する')
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description='GitHub・Notion・Markdown・テキストの変更を監視してAIのコメントを付ける')
+    parser.add_argument('--metrics-port', help='Prometheus形式のメトリクスを公開するポート（METRICS_PORT）')
+    parser.add_argument('--metrics-log', help='サイクルごとのメトリクスを追記するJSON Linesファイル（METRICS_LOG_PATH）')
+    parser.add_argument('--flight-recorder', action='store_true', help='遅いサイクルを記録するフライトレコーダーを有効にする（FLIGHT_RECORDER_ENABLED）')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    github_parser = subparsers.add_parser('github', help='GitHub ProjectsのPBIを監視する')
+    github_parser.add_argument('--project', help='プロジェクト名（省略時はPROJECT_NAME）')
+    github_parser.add_argument('--webhook', action='store_true', help='Webhookで変更を受け取る（GITHUB_WEBHOOK_MODE）')
+    github_parser.add_argument('--config', help='複数のプロジェクトを監視する場合の設定ファイル（github_projects_default.jsonの形式）')
+    github_parser.set_defaults(handler=run_github)
+
+    notion_parser = subparsers.add_parser('notion', help='Notionのページを監視する')
+    notion_parser.add_argument('--page', help='ページ名（省略時はPAGE_NAME）')
+    notion_parser.add_argument('--database', action='store_true', help='データベース内のすべてのページを監視する')
+    notion_parser.add_argument('--prompt', default='./test/prompt.txt', help='プロンプトのファイル')
+    add_auto_mode_arguments(notion_parser)
+    notion_parser.set_defaults(handler=run_notion)
+
+    markdown_parser = subparsers.add_parser('markdown', help='Markdownファイルを監視する')
+    markdown_parser.add_argument('--input', default='./test/input_and_output_content.md', help='監視するMarkdownファイル')
+    markdown_parser.add_argument('--prompt', default='./test/prompt.txt', help='プロンプトのファイル')
+    add_auto_mode_arguments(markdown_parser)
+    markdown_parser.set_defaults(handler=run_markdown)
+
+    text_parser = subparsers.add_parser('text', help='テキストファイルを監視してLLMの出力で置き換える')
+    text_parser.add_argument('--input', default='test/input_and_output.txt', help='監視するテキストファイル')
+    text_parser.add_argument('--prompt', default='default_prompt.txt', help='プロンプトのファイル')
+    text_parser.add_argument('--output', default='test/input_and_output.txt', help='出力先のファイル')
+    text_parser.set_defaults(handler=run_text)
+    return parser
+
+
+def main(argv=None):
+    args = create_parser().parse_args(argv)
+    # 各モジュールは読み込み時に環境変数から設定を読むので、読み込む前に上書きする
+    if args.metrics_port:
+        os.environ['METRICS_PORT'] = args.metrics_port
+    if args.metrics_log:
+        os.environ['METRICS_LOG_PATH'] = args.metrics_log
+    if args.flight_recorder:
+        os.environ['FLIGHT_RECORDER_ENABLED'] = 'true'
+    if getattr(args, 'webhook', False):
+        os.environ['GITHUB_WEBHOOK_MODE'] = 'true'
+    try:
+        asyncio.run(args.handler(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
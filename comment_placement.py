@@ -0,0 +1,78 @@
+from collections import deque
+
+
+class PositionMatcher:
+    # Aho-Corasick法で複数の挿入位置の文字列を同時に探す。行ごとに一度だけ走査すればよい
+    def __init__(self, patterns):
+        self.patterns = list(dict.fromkeys(patterns))
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+        for pattern in self.patterns:
+            self.add_pattern(pattern)
+        self.build_fail_links()
+
+    def add_pattern(self, pattern):
+        state = 0
+        for char in pattern:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+            state = next_state
+        self.outputs[state].append(pattern)
+
+    def build_fail_links(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail_state = self.fail[state]
+                while fail_state and char not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.goto[fail_state].get(char, 0)
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.fail[next_state]]
+
+    def find_first_lines(self, lines):
+        # 各パターンについて、それを含む最初の行の番号を返す。見つからないパターンは含めない
+        first_lines = {}
+        if '' in self.outputs[0] and lines:
+            first_lines[''] = 0
+        remaining = len(self.patterns) - len(first_lines)
+        for i, line in enumerate(lines):
+            if not remaining:
+                break
+            state = 0
+            for char in line:
+                while state and char not in self.goto[state]:
+                    state = self.fail[state]
+                state = self.goto[state].get(char, 0)
+                for pattern in self.outputs[state]:
+                    if pattern not in first_lines:
+                        first_lines[pattern] = i
+                        remaining -= 1
+        return first_lines
+
+
+def place_comments(lines, comments, format_comment):
+    # すべてのコメントの挿入先を一度の走査で求め、新しい行の一覧を一度だけ組み立てる。
+    # 挿入先が見つからなかったコメントは捨てずに返す
+    first_lines = PositionMatcher([comment['position'] for comment in comments]).find_first_lines(lines)
+    insertions = {}
+    unplaced_comments = []
+    for comment in comments:
+        i = first_lines.get(comment['position'])
+        if i is None:
+            unplaced_comments.append(comment)
+            continue
+        insertions.setdefault(i, []).extend(format_comment(comment))
+    new_lines = []
+    for i, line in enumerate(lines):
+        new_lines.append(line)
+        if i in insertions:
+            new_lines.extend(insertions[i])
+    return new_lines, unplaced_comments
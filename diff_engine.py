@@ -0,0 +1,294 @@
+import os
+import difflib
+from dotenv import load_dotenv
+
+load_dotenv()
+# 1の場合、一致する区間を索引から求める。0の場合はdifflib.SequenceMatcherで求める（出力は同じ）
+DIFF_FAST_PATH = os.getenv('DIFF_FAST_PATH', '1') == '1'
+# 置換範囲の行数の積がこれ以下の場合はndiffと同じく似た行の組を探す。超える場合はMyers法で同じ行だけを揃える。
+# 0の場合は制限せず常にndiffと同じ出力にするが、大きな書き換えでは行数の2乗以上の時間が掛かる
+DIFF_FANCY_REPLACE_LIMIT = int(os.getenv('DIFF_FANCY_REPLACE_LIMIT', '10000'))
+# Myers法で探す編集距離の上限を (置換範囲の行数の和) × 上限 がこの値に収まるように決める。
+# 上限を超えた範囲は同じ行を揃えずにまとめて削除・追加として出力する
+DIFF_EDIT_COST_LIMIT = int(os.getenv('DIFF_EDIT_COST_LIMIT', '10000000'))
+
+
+def hash_lines(old_lines, new_lines):
+    # 同じ内容の行に同じ整数を割り当て、以降の比較を整数同士で行う
+    ids = {}
+    old_ids = [ids.setdefault(line, len(ids)) for line in old_lines]
+    new_ids = [ids.setdefault(line, len(ids)) for line in new_lines]
+    return old_ids, new_ids
+
+
+def find_runs(a, b):
+    # difflib.SequenceMatcherと同じく、bの1%を超えて現れる行（空行など）は一致の起点にしない。
+    # それ以外の一致する行の組を対角線ごとにつなげ、連続して一致する区間 [aの開始位置, bの開始位置, 長さ] を作る
+    b2j = {}
+    for j, line in enumerate(b):
+        b2j.setdefault(line, []).append(j)
+    if len(b) >= 200:
+        ntest = len(b) // 100 + 1
+        for line in [line for line, indices in b2j.items() if len(indices) > ntest]:
+            del b2j[line]
+    runs = []
+    previous = {}
+    for i, line in enumerate(a):
+        current = {}
+        for j in b2j.get(line, ()):
+            run = previous.get(j - 1)
+            if run is None:
+                run = [i, j, 0]
+                runs.append(run)
+            run[2] += 1
+            current[j] = run
+        previous = current
+    return runs
+
+
+def find_longest_match(a, alo, ahi, b, blo, bhi, runs):
+    # SequenceMatcher.find_longest_matchと同じ結果を返す。範囲内で最も長い一致のうち、aで最も前、次にbで最も前のもの。
+    # 範囲に掛かる区間の一覧も返し、分割した範囲ではその中だけを探す
+    best_i, best_j, best_size = alo, blo, 0
+    overlapping = []
+    for run in runs:
+        i, j, size = run
+        # 範囲に収まる部分 [start, end) に切り詰める
+        start = alo - i if alo - i > blo - j else blo - j
+        if start < 0:
+            start = 0
+        end = ahi - i if ahi - i < bhi - j else bhi - j
+        if size < end:
+            end = size
+        if end <= start:
+            continue
+        overlapping.append(run)
+        size = end - start
+        if size > best_size or (size == best_size and (i + start < best_i or (i + start == best_i and j + start < best_j))):
+            best_i, best_j, best_size = i + start, j + start, size
+    # 起点にしなかった頻出の行も、前後で一致していれば一致区間に含める
+    while best_i > alo and best_j > blo and a[best_i - 1] == b[best_j - 1]:
+        best_i, best_j, best_size = best_i - 1, best_j - 1, best_size + 1
+    while best_i + best_size < ahi and best_j + best_size < bhi and a[best_i + best_size] == b[best_j + best_size]:
+        best_size += 1
+    return best_i, best_j, best_size, overlapping
+
+
+def get_matching_blocks(a, b, use_fast_path=DIFF_FAST_PATH):
+    # 一致する区間 (aの開始位置, bの開始位置, 長さ) の一覧を返す。末尾には長さ0の番兵を置く。
+    # difflib.ndiffが使うSequenceMatcher.get_matching_blocksと同じ区間になる
+    if not use_fast_path:
+        return [tuple(block) for block in difflib.SequenceMatcher(None, a, b).get_matching_blocks()]
+    a, b = hash_lines(a, b)
+    blocks = []
+    queue = [(0, len(a), 0, len(b), find_runs(a, b))]
+    while queue:
+        alo, ahi, blo, bhi, runs = queue.pop()
+        i, j, size, runs = find_longest_match(a, alo, ahi, b, blo, bhi, runs)
+        if size:
+            blocks.append((i, j, size))
+            if alo < i and blo < j:
+                queue.append((alo, i, blo, j, runs))
+            if i + size < ahi and j + size < bhi:
+                queue.append((i + size, ahi, j + size, bhi, runs))
+    blocks.sort()
+    blocks = merge_blocks(blocks)
+    blocks.append((len(a), len(b), 0))
+    return blocks
+
+
+def merge_blocks(blocks):
+    merged = []
+    for i, j, size in blocks:
+        if not size:
+            continue
+        if merged and merged[-1][0] + merged[-1][2] == i and merged[-1][1] + merged[-1][2] == j:
+            merged[-1] = (merged[-1][0], merged[-1][1], merged[-1][2] + size)
+        else:
+            merged.append((i, j, size))
+    return merged
+
+
+def get_opcodes(a, b, use_fast_path=DIFF_FAST_PATH):
+    # difflib.SequenceMatcher.get_opcodes と同じ形式で返す
+    opcodes = []
+    i = j = 0
+    for ai, bj, size in get_matching_blocks(a, b, use_fast_path):
+        if i < ai and j < bj:
+            opcodes.append(('replace', i, ai, j, bj))
+        elif i < ai:
+            opcodes.append(('delete', i, ai, j, bj))
+        elif j < bj:
+            opcodes.append(('insert', i, ai, j, bj))
+        if size:
+            opcodes.append(('equal', ai, ai + size, bj, bj + size))
+        i, j = ai + size, bj + size
+    return opcodes
+
+
+def find_middle_snake(a, alo, ahi, b, blo, bhi, max_d):
+    # Myersの線形空間版。前方と後方から同時に探索し、最短編集経路の中央にある一致区間を返す。
+    # 編集距離が2 * max_dを超える場合はNoneを返す
+    n = ahi - alo
+    m = bhi - blo
+    delta = n - m
+    odd = delta % 2 == 1
+    max_d = min(max_d, (n + m + 1) // 2)
+    offset = max_d + 1
+    forward = [0] * (2 * offset + 1)
+    backward = [0] * (2 * offset + 1)
+    for d in range(max_d + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and forward[offset + k - 1] < forward[offset + k + 1]):
+                x = forward[offset + k + 1]
+            else:
+                x = forward[offset + k - 1] + 1
+            y = x - k
+            start_x, start_y = x, y
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            forward[offset + k] = x
+            back_k = delta - k
+            if odd and -(d - 1) <= back_k <= d - 1 and x + backward[offset + back_k] >= n:
+                return start_x, start_y, x, y
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and backward[offset + k - 1] < backward[offset + k + 1]):
+                x = backward[offset + k + 1]
+            else:
+                x = backward[offset + k - 1] + 1
+            y = x - k
+            start_x, start_y = x, y
+            while x < n and y < m and a[ahi - 1 - x] == b[bhi - 1 - y]:
+                x += 1
+                y += 1
+            backward[offset + k] = x
+            forward_k = delta - k
+            if not odd and -d <= forward_k <= d and x + forward[offset + forward_k] >= n:
+                return n - x, m - y, n - start_x, m - start_y
+    return None
+
+
+def collect_myers_blocks(a, alo, ahi, b, blo, bhi, blocks):
+    # 先頭と末尾の一致を除いた範囲を中央の一致区間で分割していき、一致する区間を前から順に集める
+    end_a, end_b = ahi, bhi
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        blocks.append((alo, blo, 1))
+        alo += 1
+        blo += 1
+    while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+        ahi -= 1
+        bhi -= 1
+    if alo < ahi and blo < bhi:
+        snake = find_middle_snake(a, alo, ahi, b, blo, bhi, DIFF_EDIT_COST_LIMIT // (ahi - alo + bhi - blo))
+        if snake is not None:
+            x, y, u, v = snake
+            # 先頭と末尾が一致しない範囲は編集距離が2以上なので、中央の一致区間で分割すると必ず小さくなる
+            collect_myers_blocks(a, alo, alo + x, b, blo, blo + y, blocks)
+            blocks.extend((alo + x + k, blo + y + k, 1) for k in range(u - x))
+            collect_myers_blocks(a, alo + u, ahi, b, blo + v, bhi, blocks)
+    blocks.extend((ahi + k, bhi + k, 1) for k in range(end_a - ahi))
+
+
+def myers_replace_lines(a, alo, ahi, b, blo, bhi, diff_lines):
+    # 大きな置換範囲では似た行の組を探さず、Myers法で同じ行を揃える。揃わなかった部分は小さければndiffと同じ手順で並べる
+    if set(a[alo:ahi]).isdisjoint(b[blo:bhi]):
+        plain_replace_lines(a, alo, ahi, b, blo, bhi, diff_lines)
+        return
+    blocks = []
+    collect_myers_blocks(a, alo, ahi, b, blo, bhi, blocks)
+    i, j = alo, blo
+    for ai, bj, size in merge_blocks(blocks) + [(ahi, bhi, 0)]:
+        if (ai - i) * (bj - j) > DIFF_FANCY_REPLACE_LIMIT:
+            # 同じ行を含まないか、編集距離の上限を超えて揃えられなかった部分
+            plain_replace_lines(a, i, ai, b, j, bj, diff_lines)
+        else:
+            replace_range(a, i, ai, b, j, bj, diff_lines)
+        diff_lines.extend((' ', line) for line in a[ai:ai + size])
+        i, j = ai + size, bj + size
+
+
+def replace_lines(a, alo, ahi, b, blo, bhi, diff_lines):
+    # difflib.ndiffの置換処理と同じ手順で、最も似た行の組を基準に削除・追加の順序を決める
+    if DIFF_FANCY_REPLACE_LIMIT and (ahi - alo) * (bhi - blo) > DIFF_FANCY_REPLACE_LIMIT:
+        myers_replace_lines(a, alo, ahi, b, blo, bhi, diff_lines)
+        return
+    best_ratio, cutoff = 0.74, 0.75
+    cruncher = difflib.SequenceMatcher(difflib.IS_CHARACTER_JUNK)
+    equal_i, equal_j = None, None
+    for j in range(blo, bhi):
+        cruncher.set_seq2(b[j])
+        for i in range(alo, ahi):
+            if a[i] == b[j]:
+                if equal_i is None:
+                    equal_i, equal_j = i, j
+                continue
+            cruncher.set_seq1(a[i])
+            if cruncher.real_quick_ratio() > best_ratio and \
+                    cruncher.quick_ratio() > best_ratio and \
+                    cruncher.ratio() > best_ratio:
+                best_ratio, best_i, best_j = cruncher.ratio(), i, j
+    if best_ratio < cutoff:
+        if equal_i is None:
+            plain_replace_lines(a, alo, ahi, b, blo, bhi, diff_lines)
+            return
+        best_i, best_j = equal_i, equal_j
+    else:
+        equal_i = None
+    replace_range(a, alo, best_i, b, blo, best_j, diff_lines)
+    if equal_i is None:
+        diff_lines.append(('-', a[best_i]))
+        diff_lines.append(('+', b[best_j]))
+    else:
+        diff_lines.append((' ', a[best_i]))
+    replace_range(a, best_i + 1, ahi, b, best_j + 1, bhi, diff_lines)
+
+
+def replace_range(a, alo, ahi, b, blo, bhi, diff_lines):
+    if alo < ahi and blo < bhi:
+        replace_lines(a, alo, ahi, b, blo, bhi, diff_lines)
+    else:
+        diff_lines.extend(('-', line) for line in a[alo:ahi])
+        diff_lines.extend(('+', line) for line in b[blo:bhi])
+
+
+def plain_replace_lines(a, alo, ahi, b, blo, bhi, diff_lines):
+    # ndiffと同じく短い方を先に出力する
+    if bhi - blo < ahi - alo:
+        diff_lines.extend(('+', line) for line in b[blo:bhi])
+        diff_lines.extend(('-', line) for line in a[alo:ahi])
+    else:
+        diff_lines.extend(('-', line) for line in a[alo:ahi])
+        diff_lines.extend(('+', line) for line in b[blo:bhi])
+
+
+def get_diff_lines(old_content, new_content, use_fast_path=DIFF_FAST_PATH):
+    # (種別, 行) の一覧を返す。種別は ' '（変更なし）・'-'（削除）・'+'（追加）
+    a = old_content.splitlines()
+    b = new_content.splitlines()
+    if a == b:
+        return [(' ', line) for line in a]
+    diff_lines = []
+    for tag, alo, ahi, blo, bhi in get_opcodes(a, b, use_fast_path):
+        if tag == 'replace':
+            replace_lines(a, alo, ahi, b, blo, bhi, diff_lines)
+        elif tag == 'delete':
+            diff_lines.extend(('-', line) for line in a[alo:ahi])
+        elif tag == 'insert':
+            diff_lines.extend(('+', line) for line in b[blo:bhi])
+        else:
+            diff_lines.extend((' ', line) for line in a[alo:ahi])
+    return diff_lines
+
+
+def format_diff_line(tag, line):
+    if tag == '-':
+        return f"--{line}"
+    if tag == '+':
+        return f"++{line}"
+    return line
+
+
+def get_diff_content(old_content, new_content, use_fast_path=DIFF_FAST_PATH):
+    # 削除行は「--」、追加行は「++」を先頭に付け、変更されていない行はそのまま出力する
+    return '\n'.join(format_diff_line(tag, line) for tag, line in get_diff_lines(old_content, new_content, use_fast_path))
@@ -0,0 +1,99 @@
+import os
+from dotenv import load_dotenv
+from diff_engine import get_diff_lines, format_diff_line
+
+load_dotenv()
+DIFF_CONTEXT_LINES = int(os.getenv('DIFF_CONTEXT_LINES', '3'))
+DIFF_TOKEN_BUDGET = int(os.getenv('DIFF_TOKEN_BUDGET', '2000'))
+DIFF_TOKENIZER_ENCODING = 'o200k_base'
+
+tokenizer = None
+
+
+def count_tokens(text):
+    global tokenizer
+    if tokenizer is None:
+        try:
+            import tiktoken
+            tokenizer = tiktoken.get_encoding(DIFF_TOKENIZER_ENCODING)
+        except Exception:
+            # tiktokenが使えない場合はUTF-8のバイト数から概算する（日本語はおよそ1文字1トークン）
+            tokenizer = False
+    if tokenizer:
+        return len(tokenizer.encode(text))
+    return len(text.encode('utf-8')) // 3 + 1
+
+
+class DiffPayloadBuilder:
+    def __init__(self, context_lines=DIFF_CONTEXT_LINES, token_budget=DIFF_TOKEN_BUDGET, token_counter=count_tokens):
+        self.context_lines = context_lines
+        self.token_budget = token_budget
+        self.count_tokens = token_counter
+
+    def get_hunks(self, diff_lines):
+        # 変更行の前後context_lines行を含む範囲を求め、重なる範囲はまとめる
+        hunks = []
+        for i, (tag, _) in enumerate(diff_lines):
+            if tag == ' ':
+                continue
+            start = max(0, i - self.context_lines)
+            end = min(len(diff_lines), i + self.context_lines + 1)
+            if hunks and start <= hunks[-1][1]:
+                hunks[-1][1] = max(hunks[-1][1], end)
+            else:
+                hunks.append([start, end])
+        return hunks
+
+    def format_hunks(self, diff_lines, hunks):
+        return "\n...\n".join([
+            "\n".join([format_diff_line(tag, line) for tag, line in diff_lines[start:end]])
+            for start, end in hunks
+        ])
+
+    def get_sections(self, diff_lines):
+        # 見出し行で区切ったセクションごとに差分行をまとめる
+        sections = [{'heading': None, 'lines': []}]
+        for tag, line in diff_lines:
+            if line.lstrip().startswith('#') and tag != '-':
+                sections.append({'heading': line.strip(), 'lines': []})
+            sections[-1]['lines'].append((tag, line))
+        return [section for section in sections if any(tag != ' ' for tag, _ in section['lines'])]
+
+    def summarize_sections(self, diff_lines):
+        # 差分が予算に収まらない場合は、セクションごとの要約と収まる範囲の変更行だけを送る
+        output = []
+        used_tokens = 0
+        for section in self.get_sections(diff_lines):
+            added = sum(1 for tag, _ in section['lines'] if tag == '+')
+            removed = sum(1 for tag, _ in section['lines'] if tag == '-')
+            summary = f"[{section['heading'] or '(冒頭)'}] 追加{added}行 / 削除{removed}行"
+            output.append(summary)
+            used_tokens += self.count_tokens(summary) + 1
+            for tag, line in section['lines']:
+                if tag == ' ':
+                    continue
+                formatted = format_diff_line(tag, line)
+                tokens = self.count_tokens(formatted) + 1
+                if used_tokens + tokens > self.token_budget:
+                    output.append("...(省略)")
+                    break
+                output.append(formatted)
+                used_tokens += tokens
+        return "\n".join(output)
+
+    def build(self, old_content, new_content):
+        diff_lines = get_diff_lines(old_content or "", new_content or "")
+        hunks = self.get_hunks(diff_lines)
+        if not hunks:
+            return ""
+        payload = self.format_hunks(diff_lines, hunks)
+        if self.count_tokens(payload) <= self.token_budget:
+            return payload
+        return self.summarize_sections(diff_lines)
+
+    def build_content(self, content):
+        # 本文が予算に収まる場合はそのまま、収まらない場合は見出しの一覧だけを送る
+        if self.count_tokens(content) <= self.token_budget:
+            return content
+        headings = [line for line in content.splitlines() if line.lstrip().startswith('#')]
+        return "\n".join(headings + ["(本文は長いため見出しのみ。変更箇所は差分を参照)"])
@@ -0,0 +1,142 @@
+import os
+import sys
+import struct
+import asyncio
+import ctypes
+import ctypes.util
+from dotenv import load_dotenv
+
+load_dotenv()
+FILE_WATCHER_BACKEND = os.getenv('FILE_WATCHER_BACKEND', 'auto')
+FILE_WATCHER_POLL_INTERVAL = float(os.getenv('FILE_WATCHER_POLL_INTERVAL', '1'))
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+# エディタは一時ファイルに書いてから置き換えることが多いので、ファイルではなく親ディレクトリを監視する
+INOTIFY_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyBackend:
+    def __init__(self, directories):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 に失敗しました。")
+        self.directories = {}
+        for directory in directories:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), INOTIFY_MASK)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch に失敗しました: {directory}")
+            self.directories[wd] = directory
+
+    def read_paths(self):
+        # カーネルから届いたイベントを読み、変更のあったパスの一覧を返す
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, _, _, length = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+            offset += INOTIFY_EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if wd in self.directories and name:
+                paths.append(os.path.join(self.directories[wd], os.fsdecode(name)))
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileWatcher:
+    # ファイルの変更を検知し、パスごとにdebounce秒間変更が続かなくなってからcallback(path)を呼ぶ。
+    # Linuxではinotifyで通知を待ち、使えない環境ではmtimeとサイズを定期的に確認する
+    def __init__(self, paths, callback, debounce=1, poll_interval=FILE_WATCHER_POLL_INTERVAL, backend=FILE_WATCHER_BACKEND):
+        self.paths = {os.path.abspath(path) for path in paths}
+        self.callback = callback
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.backend = backend
+        self.timers = {}
+        self.callback_lock = asyncio.Lock()
+        self.tasks = set()
+
+    def get_stat(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def notify(self, path):
+        # 同じパスの変更が続く間はタイマーを延長する
+        if path not in self.paths:
+            return
+        timer = self.timers.pop(path, None)
+        if timer:
+            timer.cancel()
+        self.timers[path] = asyncio.get_running_loop().call_later(self.debounce, self.fire, path)
+
+    def fire(self, path):
+        self.timers.pop(path, None)
+        task = asyncio.create_task(self.run_callback(path))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run_callback(self, path):
+        # コールバックは一つずつ実行する
+        async with self.callback_lock:
+            try:
+                await self.callback(path)
+            except Exception as e:
+                print(f"ファイル変更の処理中にエラーが発生しました: {path}: {e}")
+
+    def create_inotify_backend(self):
+        if self.backend == 'poll' or not sys.platform.startswith('linux'):
+            return None
+        try:
+            return InotifyBackend({os.path.dirname(path) for path in self.paths})
+        except (OSError, AttributeError) as e:
+            if self.backend == 'inotify':
+                raise
+            print(f"inotifyが使えないため、定期的な確認に切り替えます: {e}")
+            return None
+
+    async def run(self):
+        inotify = self.create_inotify_backend()
+        try:
+            if inotify:
+                await self.run_inotify(inotify)
+            else:
+                await self.run_polling()
+        finally:
+            if inotify:
+                inotify.close()
+            for timer in self.timers.values():
+                timer.cancel()
+            self.timers.clear()
+
+    async def run_inotify(self, inotify):
+        loop = asyncio.get_running_loop()
+        loop.add_reader(inotify.fd, lambda: [self.notify(path) for path in inotify.read_paths()])
+        try:
+            await asyncio.Event().wait()
+        finally:
+            loop.remove_reader(inotify.fd)
+
+    async def run_polling(self):
+        stats = {path: self.get_stat(path) for path in self.paths}
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            for path in self.paths:
+                stat = self.get_stat(path)
+                if stat != stats[path]:
+                    stats[path] = stat
+                    self.notify(path)
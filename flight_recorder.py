@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import argparse
+import threading
+from collections import Counter, deque
+from datetime import datetime
+from dotenv import load_dotenv
+from metrics import shared_metrics
+
+load_dotenv()
+# trueの場合、直近のサイクルの記録を保持し、遅いサイクルを検知したらディスクに書き出す
+FLIGHT_RECORDER_ENABLED = os.getenv('FLIGHT_RECORDER_ENABLED', 'false').lower() == 'true'
+FLIGHT_RECORDER_DIR = os.getenv('FLIGHT_RECORDER_DIR', './flight_recorder')
+FLIGHT_RECORDER_BUFFER_SIZE = int(os.getenv('FLIGHT_RECORDER_BUFFER_SIZE', '50'))
+# この秒数を超えたサイクルを遅いとみなす
+FLIGHT_RECORDER_SLOW_CYCLE_SECONDS = float(os.getenv('FLIGHT_RECORDER_SLOW_CYCLE_SECONDS', '10'))
+# 遅いサイクルが続いたときに書き出しすぎないよう、書き出しの間隔をこの秒数以上空ける
+FLIGHT_RECORDER_DUMP_INTERVAL = float(os.getenv('FLIGHT_RECORDER_DUMP_INTERVAL', '300'))
+FLIGHT_RECORDER_MAX_EVENTS = int(os.getenv('FLIGHT_RECORDER_MAX_EVENTS', '1000'))
+FLIGHT_RECORDER_SAMPLE_INTERVAL = float(os.getenv('FLIGHT_RECORDER_SAMPLE_INTERVAL', '0.01'))
+# 遅いサイクルのプロファイル用に、直近この秒数分のスタックのサンプルを保持する
+FLIGHT_RECORDER_PROFILE_WINDOW = float(os.getenv('FLIGHT_RECORDER_PROFILE_WINDOW', '120'))
+# 指定した場合、起動時にプロセスIDを書き込む（flight_recorder.py のプロファイル切り替えで使う）
+FLIGHT_RECORDER_PID_FILE = os.getenv('FLIGHT_RECORDER_PID_FILE')
+# このシグナルを受け取るたびに、実行中のプロセスのプロファイルを開始・停止する
+PROFILE_SIGNAL = getattr(signal, 'SIGUSR1', None)
+
+
+class StackSampler:
+    # 別スレッドから一定間隔でイベントループのスレッドのスタックを記録する（実時間でのサンプリング）。
+    # イベントループが待機中のサンプルは select などの待ち受けとして現れる
+    def __init__(self, thread_id, interval=FLIGHT_RECORDER_SAMPLE_INTERVAL, max_samples=None):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = deque(maxlen=max_samples)
+        self.labels = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name='stack-sampler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def get_label(self, code):
+        # 同じ関数の文字列を毎回作らないよう、コードオブジェクトごとに使い回す
+        label = self.labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self.labels[code] = label
+        return label
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self.get_label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.samples.append((time.perf_counter(), tuple(reversed(stack))))
+
+    def collapse(self, start=None, end=None):
+        # flamegraph.pl や speedscope で読める「関数;関数;... 回数」の形式にまとめる
+        stacks = Counter()
+        for sampled_at, stack in list(self.samples):
+            if (start is None or sampled_at >= start) and (end is None or sampled_at <= end):
+                stacks[";".join(stack)] += 1
+        return stacks
+
+
+def write_collapsed_stacks(file_path, stacks):
+    with open(file_path, 'w', encoding='utf-8') as file:
+        for stack, count in stacks.most_common():
+            file.write(f"{stack} {count}\n")
+
+
+def get_timestamp():
+    return datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+
+
+class FlightRecorder:
+    # 直近のサイクルの記録（HTTP・LLM呼び出しと各段階の時間）をリングバッファに保持し、
+    # 予算を超えたサイクルがあれば、バッファとそのサイクルの間のスタックのサンプルを書き出す
+    def __init__(self, directory=FLIGHT_RECORDER_DIR, buffer_size=FLIGHT_RECORDER_BUFFER_SIZE, slow_cycle_seconds=FLIGHT_RECORDER_SLOW_CYCLE_SECONDS, dump_interval=FLIGHT_RECORDER_DUMP_INTERVAL, max_events=FLIGHT_RECORDER_MAX_EVENTS, sample_interval=FLIGHT_RECORDER_SAMPLE_INTERVAL, profile_window=FLIGHT_RECORDER_PROFILE_WINDOW, thread_id=None):
+        self.directory = directory
+        self.traces = deque(maxlen=buffer_size)
+        self.slow_cycle_seconds = slow_cycle_seconds
+        self.dump_interval = dump_interval
+        self.max_events = max_events
+        self.last_dumped_at = None
+        self.sampler = None
+        if sample_interval > 0:
+            self.sampler = StackSampler(
+                thread_id or threading.get_ident(), sample_interval, int(profile_window / sample_interval))
+
+    def start(self):
+        if self.sampler:
+            self.sampler.start()
+        return self
+
+    def stop(self):
+        if self.sampler:
+            self.sampler.stop()
+
+    def finish_cycle(self, cycle, duration):
+        trace = cycle.to_dict(duration)
+        trace['events'] = cycle.events
+        trace['dropped_events'] = cycle.dropped_events
+        self.traces.append(trace)
+        if duration < self.slow_cycle_seconds:
+            return
+        now = time.monotonic()
+        if self.last_dumped_at is not None and now - self.last_dumped_at < self.dump_interval:
+            return
+        self.last_dumped_at = now
+        try:
+            self.dump(trace, cycle.started_perf, cycle.started_perf + duration)
+        except OSError as e:
+            print(f"遅いサイクルの記録を書き出せませんでした: {e}")
+
+    def dump(self, trace, started_at, ended_at):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        file_name = f"slow-{trace['loop']}-{get_timestamp()}"
+        stacks = self.sampler.collapse(started_at, ended_at) if self.sampler else Counter()
+        with open(os.path.join(self.directory, f"{file_name}.json"), 'w', encoding='utf-8') as file:
+            json.dump({
+                'slow_cycle': trace,
+                'recent_cycles': list(self.traces),
+                'profile': {
+                    'sample_interval': self.sampler.interval if self.sampler else None,
+                    'samples': sum(stacks.values()),
+                    'top_stacks': [{'stack': stack, 'samples': count} for stack, count in stacks.most_common(20)]
+                }
+            }, file, ensure_ascii=False, indent=2)
+        if stacks:
+            write_collapsed_stacks(os.path.join(self.directory, f"{file_name}.folded"), stacks)
+        print(f"{trace['duration']:.1f}秒かかったサイクルを記録しました: {os.path.join(self.directory, file_name)}")
+
+
+class OnDemandProfiler:
+    # シグナルを受け取るたびにプロファイルを開始・停止し、停止時に結果を書き出す
+    def __init__(self, directory=FLIGHT_RECORDER_DIR, sample_interval=FLIGHT_RECORDER_SAMPLE_INTERVAL, thread_id=None):
+        self.directory = directory
+        self.sample_interval = sample_interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.sampler = None
+        self.started_at = None
+
+    def toggle(self):
+        if self.sampler is None:
+            self.sampler = StackSampler(self.thread_id, self.sample_interval)
+            self.sampler.start()
+            self.started_at = time.time()
+            print("プロファイルを開始しました。もう一度シグナルを送ると停止します。")
+            return
+        sampler, self.sampler = self.sampler, None
+        sampler.stop()
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        file_path = os.path.join(self.directory, f"profile-{get_timestamp()}.folded")
+        stacks = sampler.collapse()
+        try:
+            write_collapsed_stacks(file_path, stacks)
+        except OSError as e:
+            print(f"プロファイルを書き出せませんでした: {e}")
+            return
+        print(f"{time.time() - self.started_at:.1f}秒間のプロファイル（{sum(stacks.values())}サンプル）を書き出しました: {file_path}")
+
+
+def install_flight_recorder(metrics=shared_metrics, enabled=FLIGHT_RECORDER_ENABLED):
+    # 実行中のイベントループから呼ぶ。プロファイル切り替えのシグナルは常に受け付ける
+    loop = asyncio.get_running_loop()
+    if enabled and metrics.recorder is None:
+        metrics.recorder = FlightRecorder().start()
+        print(f"フライトレコーダーを開始しました（{FLIGHT_RECORDER_SLOW_CYCLE_SECONDS}秒を超えたサイクルを記録します）。")
+    if PROFILE_SIGNAL is not None:
+        try:
+            loop.add_signal_handler(PROFILE_SIGNAL, OnDemandProfiler().toggle)
+        except (NotImplementedError, RuntimeError, ValueError) as e:
+            print(f"プロファイル切り替えのシグナルを登録できませんでした: {e}")
+    if FLIGHT_RECORDER_PID_FILE:
+        with open(FLIGHT_RECORDER_PID_FILE, 'w', encoding='utf-8') as file:
+            file.write(str(os.getpid()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='実行中のアシスタントのプロファイルを開始・停止する（もう一度実行すると停止して書き出す）')
+    parser.add_argument('--pid', type=int, help='対象のプロセスID（省略時はFLIGHT_RECORDER_PID_FILEから読む）')
+    args = parser.parse_args()
+    pid = args.pid
+    if pid is None:
+        if not FLIGHT_RECORDER_PID_FILE or not os.path.exists(FLIGHT_RECORDER_PID_FILE):
+            parser.error("--pid か FLIGHT_RECORDER_PID_FILE を指定してください。")
+        with open(FLIGHT_RECORDER_PID_FILE, 'r', encoding='utf-8') as file:
+            pid = int(file.read().strip())
+    if PROFILE_SIGNAL is None:
+        parser.error("この環境ではシグナルによるプロファイルの切り替えに対応していません。")
+    os.kill(pid, PROFILE_SIGNAL)
+    print(f"プロセス {pid} にプロファイル切り替えのシグナルを送りました。結果は {FLIGHT_RECORDER_DIR} に書き出されます。")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,85 @@
-import requests
 import os
+import time
+import asyncio
 from dotenv import load_dotenv
+from http_client import get_http_client
+from request_budgeter import RequestDropped, PRIORITY_POLL, PRIORITY_READ, PRIORITY_WRITE
+from metrics import shared_metrics
 
 load_dotenv()
 GITHUB_TOKEN = os.getenv('GITHUB_TOKEN')
 GITHUB_OWNER = os.getenv('GITHUB_OWNER')
 GITHUB_REPO = os.getenv('GITHUB_REPO')
 PROJECT_NAME = os.getenv('PROJECT_NAME')
+GITHUB_METADATA_CACHE_TTL = float(os.getenv('GITHUB_METADATA_CACHE_TTL', '3600'))
+GITHUB_API_URL = os.getenv('GITHUB_API_URL', 'https://api.github.com')
 
 class GitHubAgent:
-    def __init__(self):
-        self.token = GITHUB_TOKEN
-        self.owner = GITHUB_OWNER
-        self.repo = GITHUB_REPO
-        self.project_name = PROJECT_NAME
+    def __init__(self, metadata_cache_ttl=GITHUB_METADATA_CACHE_TTL, http_client=None, owner=GITHUB_OWNER, repo=GITHUB_REPO, project_name=PROJECT_NAME, token=GITHUB_TOKEN, api_url=GITHUB_API_URL):
+        self.token = token
+        self.owner = owner
+        self.repo = repo
+        self.project_name = project_name
         self.headers = {
             'Authorization': f'token {self.token}',
             'Accept': 'application/vnd.github.v3+json'
         }
-        self.issues_url = f'https://api.github.com/repos/{self.owner}/{self.repo}/issues'
-        self.projects_url = f'https://api.github.com/repos/{self.owner}/{self.repo}/projects'
-        self.graphql_url = 'https://api.github.com/graphql'
+        self.api_url = api_url
+        self.issues_url = f'{self.api_url}/repos/{self.owner}/{self.repo}/issues'
+        self.projects_url = f'{self.api_url}/repos/{self.owner}/{self.repo}/projects'
+        self.graphql_url = f'{self.api_url}/graphql'
+        self.http = http_client or get_http_client()
+        # プロジェクトのメタデータ（ノードID・概要・アイテムID→ドラフトIssue IDの対応）をキャッシュする
+        self.metadata_cache_ttl = metadata_cache_ttl
+        self.metadata_cache = {
+            'project_id': None,
+            'short_description': None,
+            'draft_issue_ids': {},
+            'fetched_at': None
+        }
+        self.metadata_lock = asyncio.Lock()
+
+    def is_metadata_cache_expired(self):
+        fetched_at = self.metadata_cache['fetched_at']
+        if fetched_at is None:
+            return True
+        return time.monotonic() - fetched_at >= self.metadata_cache_ttl
+
+    def invalidate_metadata_cache(self, draft_issues_only=False):
+        self.metadata_cache['draft_issue_ids'] = {}
+        if not draft_issues_only:
+            self.metadata_cache['project_id'] = None
+            self.metadata_cache['short_description'] = None
+            self.metadata_cache['fetched_at'] = None
+
+    async def resolve_project_metadata(self):
+        # 同時に呼ばれても問い合わせは一度だけにする
+        async with self.metadata_lock:
+            if not self.is_metadata_cache_expired():
+                return self.metadata_cache
+            projects = await self.get_repository_projects() or []
+            for project in projects:
+                if project['title'] == self.project_name:
+                    if project['id'] != self.metadata_cache['project_id']:
+                        self.invalidate_metadata_cache()
+                    self.metadata_cache['project_id'] = project['id']
+                    self.metadata_cache['short_description'] = project['shortDescription']
+                    self.metadata_cache['fetched_at'] = time.monotonic()
+                    return self.metadata_cache
+            print(f"Project not found: {self.project_name}")
+            return None
+
+    def update_draft_issue_cache(self, snapshot):
+        # アイテムの追加・削除があった場合のみ対応表を作り直す
+        draft_issue_ids = self.metadata_cache['draft_issue_ids']
+        if {item['id'] for item in snapshot} == draft_issue_ids.keys():
+            return
+        self.invalidate_metadata_cache(draft_issues_only=True)
+        self.metadata_cache['draft_issue_ids'] = {
+            item['id']: item['draftIssueId'] for item in snapshot
+        }
 
-    def get_repository_projects(self):
+    async def get_repository_projects(self):
         query = """
         query {
             repository(owner: "%s", name: "%s") {
@@ -37,7 +94,7 @@ class GitHubAgent:
         }
         """ % (self.owner, self.repo)
 
-        response = requests.post(self.graphql_url, headers=self.headers, json={'query': query})
+        response = await self.http.post(self.graphql_url, headers=self.headers, json={'query': query}, api='github', priority=PRIORITY_READ)
         if response.status_code == 200:
             result = response.json()
             if 'errors' in result:
@@ -49,84 +106,144 @@ class GitHubAgent:
             print(f"Failed to fetch projects: {response.status_code}")
             print(response.json())
 
-    def get_project_short_description(self):
-        projects = self.get_repository_projects()
-        for project in projects:
-            if project['title'] == self.project_name:
-                return project['shortDescription']
-        print(f"Project not found: {self.project_name}")
+    async def get_project_short_description(self):
+        metadata = await self.resolve_project_metadata()
+        if metadata:
+            return metadata['short_description']
+        return None
+
+    async def get_project_id(self):
+        metadata = await self.resolve_project_metadata()
+        if metadata:
+            return metadata['project_id']
         return None
 
-    def get_project_id(self):
-        projects = self.get_repository_projects()
-        for project in projects:
-            if project['title'] == self.project_name:
-                return project['id']
-        print(f"Project not found: {self.project_name}")
+    async def get_draft_issue_id(self, project_id, item_title, item_id=None):
+        if self.is_metadata_cache_expired():
+            await self.resolve_project_metadata()
+        draft_issue_ids = self.metadata_cache['draft_issue_ids']
+        # ドラフトIssueでないアイテムはNoneとして記録しているので、Noneもキャッシュ済みとして扱う
+        is_cached = bool(item_id) and item_id in draft_issue_ids
+        shared_metrics.record_cache('github_draft_issue', is_cached)
+        if is_cached:
+            return draft_issue_ids[item_id]
+        # キャッシュにない場合のみ一覧を取得し直す
+        snapshot = await self.get_project_snapshot(project_id, priority=PRIORITY_READ)
+        if snapshot is None:
+            return None
+        for item in snapshot:
+            if item_id and item['id'] == item_id:
+                return item['draftIssueId']
+            if not item_id and item['title'] == item_title and item['draftIssueId']:
+                return item['draftIssueId']
         return None
 
-    def get_project_items(self, project_id):
+    def to_snapshot_item(self, item):
+        content = item.get('content') or {}
+        return {
+            'id': item['id'],
+            'title': content.get('title', ''),
+            'body': content.get('body') or '',
+            'updatedAt': content.get('updatedAt'),
+            'draftIssueId': content.get('id')
+        }
+
+    async def get_project_items_by_ids(self, item_ids):
+        # 指定したアイテムだけを取得する。削除済みのアイテムは結果に含まれない
         query = """
-        query {
-            node(id: "%s") {
-                ... on ProjectV2 {
-                    items(first: 20) {
-                        nodes {
+        query($ids: [ID!]!) {
+            rateLimit {
+                cost
+                remaining
+                resetAt
+            }
+            nodes(ids: $ids) {
+                ... on ProjectV2Item {
+                    id
+                    content {
+                        ... on Issue {
+                            title
+                            body
+                            updatedAt
+                        }
+                        ... on PullRequest {
+                            title
+                            body
+                            updatedAt
+                        }
+                        ... on DraftIssue {
                             id
-                            content {
-                                ... on Issue {
-                                    title
-                                    assignees(first: 10) {
-                                        nodes {
-                                            login
-                                        }
-                                    }
-                                }
-                                ... on PullRequest {
-                                    title
-                                    assignees(first: 10) {
-                                        nodes {
-                                            login
-                                        }
-                                    }
-                                }
-                                ... on DraftIssue {
-                                    title
-                                    body
-                                    updatedAt
-                                }
-                            }
+                            title
+                            body
+                            updatedAt
                         }
                     }
                 }
             }
         }
-        """ % project_id
-
-        response = requests.post(self.graphql_url, headers=self.headers, json={'query': query})
-        if response.status_code == 200:
-            project = response.json()
-            if 'errors' in project:
-                print("GraphQL errors:", project['errors'])
-            else:
-                items = project['data']['node']['items']['nodes']
-                return items
-        else:
+        """
+        response = await self.http.post(self.graphql_url, headers=self.headers, json={'query': query, 'variables': {'ids': list(item_ids)}}, api='github', priority=PRIORITY_READ)
+        if response.status_code != 200:
             print(f"Failed to fetch project items: {response.status_code}")
             print(response.json())
+            return None
+        result = response.json()
+        if not result.get('data'):
+            print("GraphQL errors:", result.get('errors'))
+            return None
+        self.update_rate_limit(result)
+        items = []
+        for item in result['data']['nodes']:
+            if item:
+                snapshot_item = self.to_snapshot_item(item)
+                items.append(snapshot_item)
+                self.metadata_cache['draft_issue_ids'][snapshot_item['id']] = snapshot_item['draftIssueId']
+        return items
+
+    def update_rate_limit(self, result):
+        budget = self.http.budgeter.get_budget('github')
+        if budget:
+            budget.update_from_graphql(result['data'].get('rateLimit'))
 
-    def get_draft_issue_id(self, project_id, item_title):
+    async def get_project_snapshot(self, project_id=None, page_size=100, priority=PRIORITY_POLL):
+        # プロジェクトの全アイテムをカーソルで辿り、id・タイトル・本文・更新日時をまとめて取得する
+        if project_id is None:
+            project_id = await self.get_project_id()
+            if not project_id:
+                print(f"Project not found: {self.project_name}")
+                return None
         query = """
-        query {
-            node(id: "%s") {
+        query($projectId: ID!, $first: Int!, $after: String) {
+            rateLimit {
+                cost
+                remaining
+                resetAt
+            }
+            node(id: $projectId) {
                 ... on ProjectV2 {
-                    items(first: 20) {
+                    items(first: $first, after: $after) {
+                        pageInfo {
+                            hasNextPage
+                            endCursor
+                        }
                         nodes {
                             id
                             content {
+                                ... on Issue {
+                                    title
+                                    body
+                                    updatedAt
+                                }
+                                ... on PullRequest {
+                                    title
+                                    body
+                                    updatedAt
+                                }
                                 ... on DraftIssue {
                                     id
                                     title
+                                    body
+                                    updatedAt
                                 }
                             }
                         }
@@ -134,82 +251,85 @@ class GitHubAgent:
                 }
             }
         }
-        """ % project_id
-
-        response = requests.post(self.graphql_url, headers=self.headers, json={'query': query})
-        if response.status_code == 200:
-            project = response.json()
-            if 'errors' in project:
-                print("GraphQL errors:", project['errors'])
-            else:
-                items = project['data']['node']['items']['nodes']
-                for item in items:
-                    if 'content' in item and 'title' in item['content'] and item['content']['title'] == item_title:
-                        return item['content']['id']
-        else:
-            print(f"Failed to fetch project items: {response.status_code}")
-            print(response.json())
-        return None
-
-    def get_project_items_updateAt(self):
-        project_id = self.get_project_id()
-        if project_id:
-            items = self.get_project_items(project_id)
-            if items:
-                update_status = []
-                for item in items:
-                    update_status.append({
-                        'id': item['id'],
-                        'title': item['content']['title'],
-                        'updatedAt': item['content']['updatedAt'],
-                        'is_updated': False,
-                        'is_created': False,
-                        'is_deleted': False
-                    })
-                return update_status
-            else:
-                print(f"No items found in project: {self.project_name}")
+        """
+        snapshot = []
+        cursor = None
+        while True:
+            variables = {'projectId': project_id, 'first': page_size, 'after': cursor}
+            try:
+                response = await self.http.post(self.graphql_url, headers=self.headers, json={'query': query, 'variables': variables}, api='github', priority=priority)
+            except RequestDropped as e:
+                print(e)
                 return None
-        else:
-            print(f"Project not found: {self.project_name}")
+            if response.status_code != 200:
+                print(f"Failed to fetch project items: {response.status_code}")
+                print(response.json())
+                return None
+            result = response.json()
+            if 'errors' in result:
+                print("GraphQL errors:", result['errors'])
+                return None
+            self.update_rate_limit(result)
+            items = result['data']['node']['items']
+            for item in items['nodes']:
+                snapshot.append(self.to_snapshot_item(item))
+            if not items['pageInfo']['hasNextPage']:
+                break
+            cursor = items['pageInfo']['endCursor']
+        self.update_draft_issue_cache(snapshot)
+        return snapshot
+
+    async def get_project_items_updateAt(self, snapshot=None):
+        if snapshot is None:
+            snapshot = await self.get_project_snapshot()
+        if snapshot is None:
             return None
+        if not snapshot:
+            print(f"No items found in project: {self.project_name}")
+        update_status = []
+        for item in snapshot:
+            update_status.append({
+                'id': item['id'],
+                'title': item['title'],
+                'updatedAt': item['updatedAt'],
+                'is_updated': False,
+                'is_created': False,
+                'is_deleted': False
+            })
+        return update_status
 
-    def get_project_items_body(self):
-        project_id = self.get_project_id()
-        if project_id:
-            items = self.get_project_items(project_id)
-            if items:
-                items_body = []
-                for item in items:
-                    items_body.append({
-                        'id': item['id'],
-                        'title': item['content']['title'],
-                        'body': item['content']['body']
-                    })
-                return items_body
-            else:
-                print(f"No items found in project: {self.project_name}")
-                return None
-        else:
-            print(f"Project not found: {self.project_name}")
+    async def get_project_items_body(self, snapshot=None):
+        if snapshot is None:
+            snapshot = await self.get_project_snapshot()
+        if snapshot is None:
             return None
+        if not snapshot:
+            print(f"No items found in project: {self.project_name}")
+        items_body = []
+        for item in snapshot:
+            items_body.append({
+                'id': item['id'],
+                'title': item['title'],
+                'body': item['body']
+            })
+        return items_body
 
-    def get_pbi_content(self, pbi_name):
-        project_id = self.get_project_id()
+    async def get_pbi_content(self, pbi_name):
+        project_id = await self.get_project_id()
         if project_id:
-            items = self.get_project_items(project_id)
+            items = await self.get_project_snapshot(project_id) or []
             for item in items:
-                if item['content']['title'] == pbi_name:
-                    content = item['content']['body']
+                if item['title'] == pbi_name:
+                    content = item['body']
                     return project_id, content
         else:
             print(f"Project not found: {self.project_name}")
             return None
 
-    def update_draft_issue(self, draft_issue_id, new_title, new_body):
+    async def update_draft_issue(self, draft_issue_id, new_title, new_body):
         mutation = """
-        mutation {
-            updateProjectV2DraftIssue(input: {draftIssueId: "%s", title: "%s", body: "%s"}) {
+        mutation($draftIssueId: ID!, $title: String!, $body: String!) {
+            updateProjectV2DraftIssue(input: {draftIssueId: $draftIssueId, title: $title, body: $body}) {
                 draftIssue {
                     id
                     title
@@ -217,9 +337,10 @@ class GitHubAgent:
                 }
             }
         }
-        """ % (draft_issue_id, new_title, new_body)
+        """
+        variables = {'draftIssueId': draft_issue_id, 'title': new_title, 'body': new_body}
 
-        response = requests.post(self.graphql_url, headers=self.headers, json={'query': mutation})
+        response = await self.http.post(self.graphql_url, headers=self.headers, json={'query': mutation, 'variables': variables}, api='github', priority=PRIORITY_WRITE)
         if response.status_code == 200:
             result = response.json()
             if 'errors' in result:
@@ -228,10 +349,10 @@ class GitHubAgent:
             print(f"Failed to update draft issue: {response.status_code}")
             print(response.json())
 
-    def add_comment_to_github(self, project_id, title, new_body):
-        draft_issue_id = self.get_draft_issue_id(project_id, title)
+    async def add_comment_to_github(self, project_id, title, new_body, item_id=None):
+        draft_issue_id = await self.get_draft_issue_id(project_id, title, item_id)
         if draft_issue_id:
-            self.update_draft_issue(draft_issue_id, title, new_body)
+            await self.update_draft_issue(draft_issue_id, title, new_body)
         else:
             print("Draft issue not found.")
         pass
@@ -248,10 +369,14 @@ if __name__ == "__main__":
     # additional_text = "additional text"
     # new_title = "test2"
 
-    agent = GitHubAgent()
-    id = agent.get_project_id()
-    items = agent.get_project_items(id)
-    print(items)
+    async def main():
+        agent = GitHubAgent()
+        id = await agent.get_project_id()
+        items = await agent.get_project_snapshot(id)
+        print(items)
+        await agent.http.aclose()
+
+    asyncio.run(main())
     # pbi_content = agent.get_pbi_content(project_name, "ユーザーニーズ調査を実施")
     # print(pbi_content)
     
\ No newline at end of file
@@ -1,62 +1,164 @@
 import os
 import time
 import asyncio
-import json
 from github_agent import GitHubAgent
 from markdown_agent import MarkdownAgent
 from llm_agent import LLMAgent
+from task_state_store import TaskStateStore
+from diff_payload import DiffPayloadBuilder
+from llm_stream import apply_incrementally
+from metrics import shared_metrics
+from flight_recorder import install_flight_recorder
+from llm_batcher import LLMBatcher, LLM_BATCH_WINDOW, format_batch_sections, parse_batch_response
+from github_webhook_receiver import GitHubWebhookReceiver, GITHUB_WEBHOOK_HOST, GITHUB_WEBHOOK_PORT
 from dotenv import load_dotenv
 
 load_dotenv()
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-os.environ['OPENAI_API_KEY'] = OPENAI_API_KEY
 
 assist_updated_task_prompt_file_path = './prompt/assist_updated_task_prompt.txt'
 assist_created_task_prompt_file_path = './prompt/assist_created_task_prompt.txt'
 pbi_format_file_path = './prompt/pbi_format.txt'
 projects_path = './projects'
+GITHUB_ASSISTANT_CONCURRENCY = int(os.getenv('GITHUB_ASSISTANT_CONCURRENCY', '4'))
+GITHUB_WEBHOOK_MODE = os.getenv('GITHUB_WEBHOOK_MODE', 'false').lower() == 'true'
+GITHUB_RECONCILE_INTERVAL = float(os.getenv('GITHUB_RECONCILE_INTERVAL', '300'))
+# ストリーミング中にPBIの本文を書き戻す最短の間隔（秒）。その間に届いたコメントは次の書き戻しにまとめる
+GITHUB_STREAM_WRITE_INTERVAL = float(os.getenv('GITHUB_STREAM_WRITE_INTERVAL', '1'))
+# 複数のPBIをまとめて依頼するときにプロンプトの後ろへ付け足す指示
+assist_updated_tasks_batch_instruction = """
+# 複数PBIの一括依頼
+複数のPBIが「=== ID: PBIのID ===」で区切られて送られます。
+各PBIについて上記の形式のコメントの配列を作成し、PBIのIDをキー、コメントの配列を値とするJSONオブジェクトだけを返してください。
+"""
 
 class GitHubAssistant:
-    def __init__(self, project_name):
-        self.github_agent = GitHubAgent()
-        self.llm_agent = LLMAgent()
+    def __init__(self, project_name, max_concurrency=GITHUB_ASSISTANT_CONCURRENCY, webhook_mode=GITHUB_WEBHOOK_MODE, reconcile_interval=GITHUB_RECONCILE_INTERVAL, webhook_host=GITHUB_WEBHOOK_HOST, webhook_port=GITHUB_WEBHOOK_PORT, github_agent=None, llm_agent=None, projects_path=projects_path, batch_window=LLM_BATCH_WINDOW, stream_write_interval=GITHUB_STREAM_WRITE_INTERVAL):
+        self.github_agent = github_agent or GitHubAgent()
+        self.llm_agent = llm_agent or LLMAgent()
         self.markdown_agent = MarkdownAgent(projects_path=projects_path, project_name=project_name)
         self.project_name = project_name
-        self.project_id = self.github_agent.get_project_id()
-        self.tasks_update_status = []
+        self.project_id = None
+        self.task_state_store = TaskStateStore(
+            os.path.join(self.markdown_agent.project_path, '.task_state.json'))
         self.diff_content = []
-        with open(assist_updated_task_prompt_file_path, 'r', encoding='utf-8') as file:
-            self.assist_updated_task_prompt = file.read()
-        with open(assist_created_task_prompt_file_path, 'r', encoding='utf-8') as file:
-            self.assist_created_task_template = file.read()
-        with open(pbi_format_file_path, 'r', encoding='utf-8') as file:
-            self.pbi_format = file.read()
-        self.project_short_description = self.github_agent.get_project_short_description()
+        self.diff_payload_builder = DiffPayloadBuilder()
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.task_locks = {}
+        self.webhook_mode = webhook_mode
+        self.reconcile_interval = reconcile_interval
+        self.webhook_host = webhook_host
+        self.webhook_port = webhook_port
+        self.stream_write_interval = stream_write_interval
+        # プロンプトはinitializeでプロジェクト情報の取得と並行して読み込む
+        self.assist_updated_task_prompt = None
+        self.assist_created_task_template = None
+        self.pbi_format = None
+        self.project_short_description = None
+        # batch_windowが0以下の場合はPBIごとに個別に依頼する
+        self.llm_batcher = LLMBatcher(self.assist_updated_tasks, window=batch_window) if batch_window > 0 else None
+
+    def read_file(self, file_path):
+        with open(file_path, 'r', encoding='utf-8') as file:
+            return file.read()
+
+    async def load_prompts(self):
+        self.assist_updated_task_prompt, self.assist_created_task_template, self.pbi_format = await asyncio.gather(
+            asyncio.to_thread(self.read_file, assist_updated_task_prompt_file_path),
+            asyncio.to_thread(self.read_file, assist_created_task_prompt_file_path),
+            asyncio.to_thread(self.read_file, pbi_format_file_path))
+
+    async def initialize(self):
+        # プロジェクト情報の取得とプロンプトの読み込みを並行して行う
+        self.project_id, self.project_short_description, _ = await asyncio.gather(
+            self.github_agent.get_project_id(),
+            self.github_agent.get_project_short_description(),
+            self.load_prompts())
 
     def save_to_file(self, markdown_content, file_path):
         with open(file_path, 'w', encoding='utf-8') as f:
             f.write(markdown_content)
 
-    async def assist_updated_task(self, title,present_md_content,previous_md_content):
-        diff_content = self.markdown_agent.get_diff_content(previous_md_content, present_md_content)
-        human_message = f"PBI名: {title}\nプロジェクトの概要: {self.project_short_description}\nPBIの内容: {present_md_content}\n前回からの差分: {diff_content}"
+    def get_updated_task_section(self, title, present_md_content, previous_md_content):
+        # 変更箇所と前後の数行だけを、トークン予算内に収めて送る
+        with shared_metrics.stage('diff'):
+            diff_content = self.diff_payload_builder.build(previous_md_content, present_md_content)
+            pbi_content = self.diff_payload_builder.build_content(present_md_content)
+        return f"PBI名: {title}\nPBIの内容: {pbi_content}\n前回からの差分: {diff_content}"
+
+    async def assist_updated_tasks(self, sections):
+        # 複数のPBIを一度のLLM呼び出しで依頼し、PBIごとのコメントの配列に分けて返す
+        human_message = f"プロジェクトの概要: {self.project_short_description}\n\n{format_batch_sections(sections)}"
+        print(f"{len(sections)}件のPBIをまとめてLLMに送信します。")
+        async with self.semaphore:
+            llm_response = await self.llm_agent(
+                system_message=self.assist_updated_task_prompt + assist_updated_tasks_batch_instruction,
+                human_message=human_message)
+        return parse_batch_response(llm_response)
+
+    async def write_comments(self, title, present_md_content, comments, item_id=None):
+        with shared_metrics.stage('placement'):
+            new_md_content, unplaced_comments = self.markdown_agent.place_ai_feedback(
+                present_md_content, comments)
+        if len(unplaced_comments) < len(comments):
+            with shared_metrics.stage('write_back'):
+                await self.github_agent.add_comment_to_github(
+                    self.project_id, title, new_md_content, item_id)
+            print(f"PBI「{title}」にコメントが{len(comments) - len(unplaced_comments)}件追加されました。")
+
+    async def assist_updated_task(self, title,present_md_content,previous_md_content, item_id=None):
+        section = self.get_updated_task_section(title, present_md_content, previous_md_content)
+        if self.llm_batcher and item_id:
+            # 同時に変更されたPBIとまとめて依頼する。まとめられなかった場合は個別に依頼する
+            comments = await self.llm_batcher.submit(item_id, section)
+            if comments is not None:
+                await self.write_comments(title, present_md_content, comments, item_id)
+                return
+        async with self.semaphore:
+            await self.assist_updated_task_streaming(title, present_md_content, section, item_id)
+
+    async def assist_updated_task_streaming(self, title, present_md_content, section, item_id=None):
+        human_message = f"プロジェクトの概要: {self.project_short_description}\n{section}"
         print("LLMに送信します。")
-        llm_response = await self.llm_agent(system_message=self.assist_updated_task_prompt, human_message=human_message)
-        # コメントを追加
-        comments = json.loads(llm_response)
-        new_md_content = self.markdown_agent.get_content_with_ai_feedback(
-            present_md_content, comments)
-        if new_md_content:
-            self.github_agent.add_comment_to_github(
-                self.project_id, title, new_md_content)
-            print(f"PBI「{title}」にコメントが追加されました。")
-
-    async def assist_created_task(self, title):
+        comments = []
+        # 並行して処理するPBIごとに、最初のコメントが届くまでの時間を計る。
+        # 配置できなかったコメントは最後の配置の結果をそのまま使う
+        written = {'placed': 0, 'unplaced_comments': [], 'started_at': time.monotonic(), 'time_to_first_comment': None}
+
+        async def write_streamed_comments(new_comments):
+            # 生成が続いている間も、届いたコメントまでを反映した本文で書き戻す。
+            # 書き戻しは一度に一つだけ行い、stream_write_interval秒の間に届いたコメントはまとめる
+            if written['time_to_first_comment'] is None:
+                written['time_to_first_comment'] = time.monotonic() - written['started_at']
+            comments.extend(new_comments)
+            with shared_metrics.stage('placement'):
+                new_md_content, unplaced_comments = self.markdown_agent.insert_ai_feedback(
+                    present_md_content, comments)
+            written['unplaced_comments'] = unplaced_comments
+            placed = len(comments) - len(unplaced_comments)
+            if placed > written['placed']:
+                with shared_metrics.stage('write_back'):
+                    await self.github_agent.add_comment_to_github(
+                        self.project_id, title, new_md_content, item_id)
+                written['placed'] = placed
+
+        await apply_incrementally(
+            self.llm_agent.stream_json_array(system_message=self.assist_updated_task_prompt, human_message=human_message),
+            write_streamed_comments, min_interval=self.stream_write_interval)
+        if written['time_to_first_comment'] is not None:
+            print(f"PBI「{title}」の最初のコメントまで{written['time_to_first_comment']:.2f}秒")
+        if written['placed']:
+            print(f"PBI「{title}」にコメントが{written['placed']}件追加されました。")
+        for comment in written['unplaced_comments']:
+            print(f"挿入位置が見つかりませんでした: {comment['position']}")
+
+    async def assist_created_task(self, title, item_id=None):
         human_message = f"PBI名: {title}\nプロジェクトの概要: {self.project_short_description}\nPBIのフォーマット: {self.pbi_format}"
         print("LLMに送信します。")
         llm_response = await self.llm_agent(system_message=self.assist_created_task_template, human_message=human_message)
-        self.github_agent.add_comment_to_github(
-            self.project_id, title, llm_response)
+        with shared_metrics.stage('write_back'):
+            await self.github_agent.add_comment_to_github(
+                self.project_id, title, llm_response, item_id)
         print(f"PBI「{title}」にコメントが追加されました。")
         
     def remove_user_input(self, markdown_content):
@@ -69,86 +171,148 @@ class GitHubAssistant:
     def contains_unmarked_user_input(self, markdown_content):
         return "user:" in markdown_content and "!user:" not in markdown_content
 
-    def init_update_status(self):
-        for task in self.tasks_update_status:
-            task['is_updated'] = False
-            task['is_created'] = False
-            task["is_deleted"] = False
-
-    def update_status(self):
-        tasks_update_status = self.github_agent.get_project_items_updateAt()  
-        for task in tasks_update_status:
-            is_created = True
-            for existing_task in self.tasks_update_status:
-                if existing_task["id"] == task["id"]:
-                    is_created = False
-                    if task['updatedAt'] != existing_task['updatedAt']:
-                        existing_task['is_updated'] = True
-                    break
-            if is_created:
-                task['is_created'] = True
-                self.tasks_update_status.append(task)
-        # 削除されたタスクを検出
-        for existing_task in self.tasks_update_status:
-            if not any(task["id"] == existing_task["id"] for task in tasks_update_status):
-                existing_task["is_deleted"] = True
-        return
+    def update_status(self, snapshot):
+        return self.task_state_store.apply_snapshot(snapshot)
+
+    async def prepare(self):
+        await self.initialize()
+        if len(self.task_state_store) == 0:
+            # 保存済みの状態がない場合のみ、プロジェクトの初期状態を取得して保存
+            snapshot = await self.github_agent.get_project_snapshot(self.project_id)
+            if snapshot is None:
+                # 取得に失敗した場合は何も保存せずにFalseを返す
+                return False
+            project_items = await self.github_agent.get_project_items_body(snapshot)
+            self.markdown_agent.save_project_items(
+                project_items=project_items)
+            self.task_state_store.baseline(snapshot)
+            self.task_state_store.save()
+        return True
 
     async def run_schedule(self):
-        # プロジェクトの初期状態を取得
-        project_items = self.github_agent.get_project_items_body()
-        # プロジェクトの初期状態を保存
-        self.markdown_agent.save_project_items(
-            project_items=project_items)
-        # プロジェクト各タスクの更新日時を取得
-        self.tasks_update_status = self.github_agent.get_project_items_updateAt()
+        await shared_metrics.start_server()
+        install_flight_recorder()
+        while not await self.prepare():
+            print("プロジェクトの初期状態を取得できませんでした。1秒後に再試行します。")
+            await asyncio.sleep(1)
+        self.llm_agent.start_warm_up()
         print("ページ更新検知開始")
+        if self.webhook_mode:
+            await self.run_webhook_schedule()
+            return
         while True:
             await self.detect_update()
-            time.sleep(1)
+            await asyncio.sleep(1)
+
+    def get_task_lock(self, item_id):
+        if item_id not in self.task_locks:
+            self.task_locks[item_id] = asyncio.Lock()
+        return self.task_locks[item_id]
+
+    async def process_task(self, task, item):
+        if not item:
+            print(f"ID {task['id']} に一致するアイテムが見つかりませんでした。")
+            return
+        # 同じPBIに対するLLM呼び出しは同時に一つまで、全体の同時実行数はセマフォで制限する（一括依頼は一回と数える）
+        async with self.get_task_lock(item['id']):
+            try:
+                if task["is_created"] and item['body'] == "":
+                    print(f"PBI「{task['title']}」が作成されました。{task['updatedAt']}")
+                    async with self.semaphore:
+                        await self.assist_created_task(title=item['title'], item_id=item['id'])
+                    return
+                with shared_metrics.stage('detect'):
+                    present_md_content = self.markdown_agent.get_content_without_ai_feedback(item['body'])
+                    if self.task_state_store.is_processed(item['id'], present_md_content):
+                        return
+                    previous_md_content = self.markdown_agent.get_saved_content(item['id']) or ""
+                if present_md_content != previous_md_content:
+                    print(f"PBI「{item['title']}」が更新されました。{task['updatedAt']}")
+                    await self.assist_updated_task(title=item['title'],present_md_content=present_md_content,previous_md_content=previous_md_content,item_id=item['id'])
+                    self.task_state_store.mark_processed(item['id'], present_md_content)
+            except Exception as e:
+                print(f"PBI「{item['title']}」の処理中にエラーが発生しました: {e}")
+
+    async def handle_changes(self, created_ids, updated_ids, deleted_ids, project_items):
+        items_by_id = {item['id']: item for item in project_items}
+        for item_id in deleted_ids:
+            task = self.task_state_store.get(item_id)
+            print(f"PBI「{task['title']}」が削除されました。{task['updatedAt']}")
+            self.markdown_agent.delete_project_item(item_id)
+            self.task_state_store.remove(item_id)
+            self.task_locks.pop(item_id, None)
+        # 変更のあったPBIを並行して処理する
+        await asyncio.gather(*[
+            self.process_task(self.task_state_store.get(item_id), items_by_id.get(item_id))
+            for item_id in created_ids | updated_ids
+        ])
+        with shared_metrics.stage('save'):
+            try:
+                self.markdown_agent.save_project_items(
+                    project_items=project_items)
+            except Exception as e:
+                print(e)
+            self.task_state_store.reset_flags()
+            self.task_state_store.save()
+        return bool(created_ids or updated_ids or deleted_ids)
 
     async def detect_update(self):
+        # 取得・変更検知・差分・LLM・コメント配置・書き戻しの各段階の時間をサイクル単位で記録する
+        with shared_metrics.cycle('github') as cycle:
+            try:
+                with shared_metrics.stage('fetch'):
+                    snapshot = await self.github_agent.get_project_snapshot(self.project_id)
+                if snapshot is None:
+                    return False
+                with shared_metrics.stage('detect'):
+                    created_ids, updated_ids, deleted_ids = self.update_status(snapshot)
+                with shared_metrics.stage('fetch'):
+                    project_items = await self.github_agent.get_project_items_body(snapshot)
+                cycle.changed = await self.handle_changes(created_ids, updated_ids, deleted_ids, project_items)
+            except Exception as e:
+                print(e)
+                return False
+            return cycle.changed
+
+    async def detect_update_by_ids(self, item_ids):
+        # Webhookで通知されたアイテムだけを取得して処理する
+        with shared_metrics.cycle('github') as cycle:
+            try:
+                with shared_metrics.stage('fetch'):
+                    items = await self.github_agent.get_project_items_by_ids(item_ids)
+                if items is None:
+                    return False
+                with shared_metrics.stage('detect'):
+                    created_ids, updated_ids, deleted_ids = self.task_state_store.apply_items(items, item_ids)
+                with shared_metrics.stage('fetch'):
+                    project_items = await self.github_agent.get_project_items_body(items)
+                cycle.changed = await self.handle_changes(created_ids, updated_ids, deleted_ids, project_items)
+            except Exception as e:
+                print(e)
+                return False
+            return cycle.changed
+
+    async def run_webhook_schedule(self):
+        receiver = GitHubWebhookReceiver(project_id=self.project_id, host=self.webhook_host, port=self.webhook_port)
+        await receiver.start()
+        loop = asyncio.get_running_loop()
+        next_reconcile_time = loop.time() + self.reconcile_interval
         try:
-            self.update_status()
-            project_items = self.github_agent.get_project_items_body()
-            for task in self.tasks_update_status:
-                if task["is_deleted"]:
-                    print(f"PBI「{task['title']}」が削除されました。{task['updatedAt']}")
-                    self.markdown_agent.delete_project_item(task['id'])
-                    self.tasks_update_status.remove(task)
-                elif task["is_created"]:
-                    item = next((item for item in project_items if item['id'] == task['id']), None)
-                    if item:
-                        if item['body'] == "":
-                            print(f"PBI「{task['title']}」が作成されました。{task['updatedAt']}")
-                            await self.assist_created_task(title=item['title'])
-                        else:
-                            present_md_content = self.markdown_agent.get_content_without_ai_feedback(item['body'])
-                            previous_md_content = self.markdown_agent.get_saved_content(item['id'])
-                            if present_md_content != previous_md_content:
-                                print(f"PBI「{item['title']}」が更新されました。{task['updatedAt']}")
-                                await self.assist_updated_task(title=item['title'],present_md_content=present_md_content,previous_md_content=previous_md_content)
-                    else:
-                        print(f"ID {task['id']} に一致するアイテムが見つかりませんでした。")
-                        continue
-                elif task["is_updated"]:
-                    item = next((item for item in project_items if item['id'] == task['id']), None)
-                    if item:
-                        present_md_content = self.markdown_agent.get_content_without_ai_feedback(item['body'])
-                        previous_md_content = self.markdown_agent.get_saved_content(item['id'])
-                        if present_md_content != previous_md_content:
-                            print(f"PBI「{item['title']}」が更新されました。{task['updatedAt']}")
-                            await self.assist_updated_task(title=item['title'],present_md_content=present_md_content,previous_md_content=previous_md_content)
-                    else:
-                        print(f"ID {task['id']} に一致するアイテムが見つかりませんでした。")
-                        continue
-            self.markdown_agent.save_project_items(
-                project_items=project_items)
-            self.init_update_status()
-        except Exception as e:
-            print(e)
+            while True:
+                events = await receiver.get_item_ids(
+                    timeout=max(0, next_reconcile_time - loop.time()))
+                if events:
+                    print(f"Webhookで{len(events)}件の変更を受信しました。")
+                    await self.detect_update_by_ids(list(events))
+                if loop.time() >= next_reconcile_time:
+                    # 取りこぼしに備えて低頻度で全体を突き合わせる
+                    await self.detect_update()
+                    next_reconcile_time = loop.time() + self.reconcile_interval
+        finally:
+            await receiver.stop()
 
-project_name = "test"
 # 非同期関数を実行するためのエントリーポイント
-github_assistant = GitHubAssistant(project_name)
-asyncio.run(github_assistant.run_schedule())
+if __name__ == "__main__":
+    project_name = "test"
+    github_assistant = GitHubAssistant(project_name)
+    asyncio.run(github_assistant.run_schedule())
@@ -0,0 +1,124 @@
+import os
+import json
+import heapq
+import asyncio
+import itertools
+from github_agent import GitHubAgent
+from github_assistant import GitHubAssistant, projects_path
+from llm_agent import LLMAgent
+from metrics import shared_metrics
+from flight_recorder import install_flight_recorder
+from dotenv import load_dotenv
+
+load_dotenv()
+GITHUB_PROJECTS_CONFIG = os.getenv('GITHUB_PROJECTS_CONFIG', './github_projects.json')
+GITHUB_ACTIVE_POLL_INTERVAL = float(os.getenv('GITHUB_ACTIVE_POLL_INTERVAL', '1'))
+GITHUB_IDLE_POLL_INTERVAL = float(os.getenv('GITHUB_IDLE_POLL_INTERVAL', '30'))
+GITHUB_POLL_BACKOFF = float(os.getenv('GITHUB_POLL_BACKOFF', '2'))
+GITHUB_MAX_PARALLEL_POLLS = int(os.getenv('GITHUB_MAX_PARALLEL_POLLS', '4'))
+
+
+def load_targets(config_file_path):
+    # 設定ファイルの形式: {"targets": [{"owner": "...", "repo": "...", "project_name": "..."}]}
+    with open(config_file_path, 'r', encoding='utf-8') as file:
+        config = json.load(file)
+    return config['targets']
+
+
+class GitHubPollScheduler:
+    def __init__(self, active_interval=GITHUB_ACTIVE_POLL_INTERVAL, idle_interval=GITHUB_IDLE_POLL_INTERVAL, backoff=GITHUB_POLL_BACKOFF, max_parallel_polls=GITHUB_MAX_PARALLEL_POLLS):
+        self.active_interval = active_interval
+        self.idle_interval = idle_interval
+        self.backoff = backoff
+        self.semaphore = asyncio.Semaphore(max_parallel_polls)
+        # (次回実行時刻, 登録順, プロジェクト) のヒープ。同時刻なら登録順に回すので公平になる
+        self.queue = []
+        self.sequence = itertools.count()
+        self.intervals = {}
+        self.wakeup = asyncio.Event()
+
+    def schedule(self, assistant, due_time):
+        heapq.heappush(self.queue, (due_time, next(self.sequence), assistant))
+        self.wakeup.set()
+
+    def next_interval(self, assistant, is_active):
+        # 最近変更があったプロジェクトは短い間隔で、静かなプロジェクトは徐々に間隔を広げる
+        if is_active:
+            interval = self.active_interval
+        else:
+            interval = min(self.intervals.get(assistant, self.active_interval) * self.backoff, self.idle_interval)
+        self.intervals[assistant] = interval
+        return interval
+
+    async def poll(self, assistant):
+        loop = asyncio.get_running_loop()
+        async with self.semaphore:
+            try:
+                is_active = await assistant.detect_update()
+            except Exception as e:
+                print(f"{assistant.github_agent.owner}/{assistant.github_agent.repo} の更新検知に失敗しました: {e}")
+                is_active = False
+        self.schedule(assistant, loop.time() + self.next_interval(assistant, is_active))
+
+    async def run(self, assistants):
+        loop = asyncio.get_running_loop()
+        for assistant in assistants:
+            self.schedule(assistant, loop.time())
+        tasks = set()
+        while True:
+            self.wakeup.clear()
+            if not self.queue:
+                await self.wakeup.wait()
+                continue
+            due_time, _, assistant = self.queue[0]
+            delay = due_time - loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self.queue)
+            task = asyncio.create_task(self.poll(assistant))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+
+class GitHubDaemon:
+    def __init__(self, targets, scheduler=None):
+        # LLMクライアントとHTTP接続プールは全プロジェクトで共有する
+        self.llm_agent = LLMAgent()
+        self.scheduler = scheduler or GitHubPollScheduler()
+        self.assistants = []
+        for target in targets:
+            github_agent = GitHubAgent(owner=target['owner'], repo=target['repo'], project_name=target['project_name'])
+            self.assistants.append(GitHubAssistant(
+                target['project_name'],
+                github_agent=github_agent,
+                llm_agent=self.llm_agent,
+                projects_path=f"{projects_path}/{target['owner']}/{target['repo']}"))
+
+    async def prepare(self, assistant):
+        try:
+            if not await assistant.prepare():
+                print(f"{assistant.github_agent.owner}/{assistant.github_agent.repo} の初期状態を取得できませんでした。")
+                return None
+            return assistant
+        except Exception as e:
+            print(f"{assistant.github_agent.owner}/{assistant.github_agent.repo} の初期化に失敗しました: {e}")
+            return None
+
+    async def run_schedule(self):
+        await shared_metrics.start_server()
+        install_flight_recorder()
+        assistants = await asyncio.gather(*[self.prepare(assistant) for assistant in self.assistants])
+        assistants = [assistant for assistant in assistants if assistant]
+        self.llm_agent.start_warm_up()
+        print(f"{len(assistants)}件のプロジェクトの更新検知開始")
+        await self.scheduler.run(assistants)
+
+
+# 非同期関数を実行するためのエントリーポイント
+if __name__ == "__main__":
+    github_daemon = GitHubDaemon(load_targets(GITHUB_PROJECTS_CONFIG))
+    asyncio.run(github_daemon.run_schedule())
@@ -0,0 +1,81 @@
+import os
+import hmac
+import json
+import asyncio
+import hashlib
+from dotenv import load_dotenv
+from http_server import LocalHttpServer
+
+load_dotenv()
+GITHUB_WEBHOOK_SECRET = os.getenv('GITHUB_WEBHOOK_SECRET')
+GITHUB_WEBHOOK_HOST = os.getenv('GITHUB_WEBHOOK_HOST', '127.0.0.1')
+GITHUB_WEBHOOK_PORT = int(os.getenv('GITHUB_WEBHOOK_PORT', '8765'))
+GITHUB_WEBHOOK_PATH = os.getenv('GITHUB_WEBHOOK_PATH', '/webhook')
+
+
+class GitHubWebhookReceiver:
+    def __init__(self, secret=GITHUB_WEBHOOK_SECRET, project_id=None, host=GITHUB_WEBHOOK_HOST, port=GITHUB_WEBHOOK_PORT, path=GITHUB_WEBHOOK_PATH):
+        if not secret:
+            raise ValueError("GITHUB_WEBHOOK_SECRET が設定されていません。")
+        self.secret = secret.encode('utf-8')
+        self.project_id = project_id
+        self.path = path
+        self.queue = asyncio.Queue()
+        self.server = LocalHttpServer(self.handle_request, host, port)
+
+    async def start(self):
+        await self.server.start()
+        print(f"Webhook受信開始: http://{self.server.host}:{self.server.port}{self.path}")
+        return self
+
+    async def stop(self):
+        await self.server.stop()
+
+    def is_valid_signature(self, body, signature):
+        if not signature or not signature.startswith('sha256='):
+            return False
+        expected = 'sha256=' + hmac.new(self.secret, body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature)
+
+    async def handle_request(self, method, path, headers, body):
+        if method != 'POST' or path.split('?', 1)[0] != self.path:
+            return 404, 'text/plain', 'not found'
+        if not self.is_valid_signature(body, headers.get('x-hub-signature-256')):
+            return 401, 'text/plain', 'invalid signature'
+        event = headers.get('x-github-event')
+        if event == 'ping':
+            return 200, 'text/plain', 'pong'
+        if event != 'projects_v2_item':
+            return 202, 'text/plain', 'ignored'
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return 400, 'text/plain', 'invalid json'
+        item = payload.get('projects_v2_item') or {}
+        item_id = item.get('node_id')
+        if not item_id:
+            return 400, 'text/plain', 'missing projects_v2_item.node_id'
+        if self.project_id and item.get('project_node_id') != self.project_id:
+            return 202, 'text/plain', 'ignored'
+        self.queue.put_nowait((item_id, payload.get('action')))
+        return 202, 'text/plain', 'accepted'
+
+    async def get_item_ids(self, timeout, batch_window=0.5):
+        # 最初のイベントを待ち、続けて届くイベントを短い時間まとめて受け取る
+        try:
+            item_id, action = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return {}
+        events = {item_id: action}
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + batch_window
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                item_id, action = await asyncio.wait_for(self.queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            events[item_id] = action
+        return events
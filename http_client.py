@@ -0,0 +1,110 @@
+import os
+import time
+import random
+import asyncio
+import httpx
+from dotenv import load_dotenv
+from request_budgeter import shared_request_budgeter, get_retry_after, PRIORITY_READ
+from metrics import shared_metrics
+
+load_dotenv()
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', '20'))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('HTTP_MAX_KEEPALIVE_CONNECTIONS', '10'))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '30'))
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '5'))
+HTTP_RETRY_BASE_DELAY = float(os.getenv('HTTP_RETRY_BASE_DELAY', '1'))
+HTTP_RETRY_MAX_DELAY = float(os.getenv('HTTP_RETRY_MAX_DELAY', '60'))
+
+
+class AsyncHttpClient:
+    def __init__(self, max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS, timeout=HTTP_TIMEOUT, budgeter=shared_request_budgeter, max_retries=HTTP_MAX_RETRIES, metrics=shared_metrics):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.timeout = timeout
+        self.budgeter = budgeter
+        self.max_retries = max_retries
+        self.metrics = metrics
+        self.client = None
+
+    def get_client(self):
+        # 接続プールはイベントループ上で初めて使うときに作成し、以降は使い回す
+        if self.client is None or self.client.is_closed:
+            self.client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive_connections
+                )
+            )
+        return self.client
+
+    def is_retryable(self, response, idempotent):
+        if response.status_code == 429:
+            return True
+        # 冪等でないリクエストはサーバーエラー時に処理済みの可能性があるため再試行しない
+        if response.status_code >= 500:
+            return idempotent
+        # GitHubはレート制限超過を403で返すことがある
+        return response.status_code == 403 and (
+            response.headers.get('x-ratelimit-remaining') == '0' or 'retry-after' in response.headers)
+
+    def get_retry_delay(self, attempt, response=None):
+        if response is not None:
+            retry_after = get_retry_after(response.headers)
+            if retry_after is not None:
+                return retry_after + random.uniform(0, HTTP_RETRY_BASE_DELAY)
+        delay = min(HTTP_RETRY_MAX_DELAY, HTTP_RETRY_BASE_DELAY * 2 ** attempt)
+        return random.uniform(0, delay)
+
+    async def request(self, method, url, api=None, priority=PRIORITY_READ, idempotent=True, **kwargs):
+        # apiを指定した場合はレート制限の予算を通し、429/5xxはジッター付きで再試行する
+        budget = self.budgeter.get_budget(api) if api else None
+        for attempt in range(self.max_retries + 1):
+            if budget:
+                await budget.acquire(priority)
+            started_at = time.perf_counter()
+            try:
+                response = await self.get_client().request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                self.metrics.record_http(api, method, 'error', time.perf_counter() - started_at, url=url)
+                if attempt == self.max_retries or not idempotent:
+                    raise
+                delay = self.get_retry_delay(attempt)
+                print(f"通信エラーのため{delay:.1f}秒後に再試行します: {e}")
+                self.metrics.record_http_retry(api)
+                await asyncio.sleep(delay)
+                continue
+            self.metrics.record_http(
+                api, method, response.status_code, time.perf_counter() - started_at, url=url,
+                request_bytes=len(response.request.content), response_bytes=len(response.content))
+            if budget:
+                budget.update_from_headers(response.headers)
+            if not self.is_retryable(response, idempotent) or attempt == self.max_retries:
+                return response
+            delay = self.get_retry_delay(attempt, response)
+            if budget:
+                budget.block_for(delay)
+            print(f"{response.status_code} が返されたため{delay:.1f}秒後に再試行します: {url}")
+            self.metrics.record_http_retry(api)
+            await asyncio.sleep(delay)
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def patch(self, url, **kwargs):
+        return await self.request('PATCH', url, **kwargs)
+
+    async def aclose(self):
+        if self.client is not None and not self.client.is_closed:
+            await self.client.aclose()
+        self.client = None
+
+
+shared_http_client = AsyncHttpClient()
+
+
+def get_http_client():
+    return shared_http_client
@@ -0,0 +1,87 @@
+import asyncio
+from http import HTTPStatus
+
+MAX_BODY_SIZE = 25 * 1024 * 1024
+
+
+class LocalHttpServer:
+    def __init__(self, handler, host='127.0.0.1', port=8000):
+        # handler(method, path, headers, body) -> (status, content_type, body)
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.server = None
+        self.writers = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        # port=0 の場合は実際に割り当てられたポートを保持する
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            # keep-aliveで待機中の接続を閉じないと wait_closed が戻らない
+            for writer in list(self.writers):
+                writer.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, path, _ = request_line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        content_length = int(headers.get('content-length', '0'))
+        if content_length > MAX_BODY_SIZE:
+            raise ValueError(f"リクエストボディが大きすぎます: {content_length}")
+        body = await reader.readexactly(content_length) if content_length else b''
+        return method, path, headers, body
+
+    async def write_response(self, writer, status, content_type, body, keep_alive):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        reason = HTTPStatus(status).phrase
+        header_lines = [
+            f"HTTP/1.1 {status} {reason}",
+            f"Content-Type: {content_type}",
+            f"Content-Length: {len(body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        writer.write(('\r\n'.join(header_lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except (ValueError, asyncio.IncompleteReadError) as e:
+                    await self.write_response(writer, 400, 'text/plain', str(e), False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                try:
+                    status, content_type, response_body = await self.handler(method, path, headers, body)
+                except Exception as e:
+                    print(f"リクエストの処理中にエラーが発生しました: {e}")
+                    status, content_type, response_body = 500, 'text/plain', 'internal error'
+                await self.write_response(writer, status, content_type, response_body, keep_alive)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
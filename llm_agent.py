@@ -1,24 +1,130 @@
-from langchain_openai import ChatOpenAI
-from langchain.schema import SystemMessage
-from langchain_core.messages import HumanMessage
+import os
+import time
+import asyncio
+from llm_cache import LLMResponseCache
+from llm_stream import JsonArrayParser, parse_json_response
+from metrics import shared_metrics
+from dotenv import load_dotenv
+
+load_dotenv()
+LLM_CACHE_DIR = os.getenv('LLM_CACHE_DIR')
+# 未指定の場合はOpenAIのAPIを使う。互換サーバーやベンチマーク用の偽サーバーに向けるときに指定する
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL') or None
+LLM_CACHE_MAX_ENTRIES = int(os.getenv('LLM_CACHE_MAX_ENTRIES', '1000'))
+LLM_CACHE_MAX_BYTES = int(os.getenv('LLM_CACHE_MAX_BYTES', str(100 * 1024 * 1024)))
+LLM_CACHE_MAX_AGE = float(os.getenv('LLM_CACHE_MAX_AGE', str(7 * 24 * 60 * 60)))
 
 
 class LLMAgent:
-    def __init__(self):
-        self.llm = ChatOpenAI(model='gpt-4o')
+    def __init__(self, model='gpt-4o', cache_dir=LLM_CACHE_DIR, cache_max_entries=LLM_CACHE_MAX_ENTRIES, cache_max_bytes=LLM_CACHE_MAX_BYTES, cache_max_age=LLM_CACHE_MAX_AGE, base_url=OPENAI_BASE_URL, metrics=shared_metrics):
+        self.model = model
+        self.base_url = base_url
+        self.llm = None
+        self.warm_up_task = None
+        self.metrics = metrics
+        # cache_dirを指定した場合のみ、同じ入力に対する応答をディスクにキャッシュする
+        self.cache = None
+        if cache_dir:
+            self.cache = LLMResponseCache(cache_dir, cache_max_entries, cache_max_bytes, cache_max_age)
+
+    def get_llm(self):
+        # langchainの読み込みには数秒かかるため、起動時ではなく初めてLLMを呼ぶときに読み込む
+        if self.llm is None:
+            from langchain_openai import ChatOpenAI
+            # メッセージクラスも同じスレッドで読み込んでおく
+            import langchain_core.messages  # noqa: F401
+            # ストリーミングでもトークン数を受け取れるようにする
+            self.llm = ChatOpenAI(model=self.model, base_url=self.base_url, stream_usage=True)
+        return self.llm
+
+    def start_warm_up(self):
+        # 起動後、最初の呼び出しを待たずに別スレッドでlangchainを読み込んでおく。
+        # 失敗した場合は最初の呼び出しで改めて例外になる
+        if self.llm is None and self.warm_up_task is None:
+            self.warm_up_task = asyncio.create_task(asyncio.to_thread(self.get_llm))
+            self.warm_up_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return self.warm_up_task
 
     def render_system_message(self, content):
-        system_message = SystemMessage(content=content)
-        assert isinstance(system_message, SystemMessage)
-        return system_message
+        from langchain_core.messages import SystemMessage
+        return SystemMessage(content=content)
 
     def render_human_message(self, content):
+        from langchain_core.messages import HumanMessage
         return HumanMessage(content=content)
 
     async def __call__(self, system_message, human_message):
+        cache_key = None
+        if self.cache:
+            cache_key = self.cache.get_key(self.model, system_message, human_message)
+            cached_response = self.cache.get(cache_key)
+            self.metrics.record_cache('llm', cached_response is not None)
+            if cached_response is not None:
+                return cached_response
         messages = [
             self.render_system_message(content=system_message),
             self.render_human_message(content=human_message)
         ]
-        response = await self.llm.ainvoke(input=messages)
+        started_at = time.perf_counter()
+        with self.metrics.stage('llm'):
+            response = await self.get_llm().ainvoke(input=messages)
+        self.metrics.record_llm('invoke', time.perf_counter() - started_at, response.usage_metadata)
+        if self.cache:
+            self.cache.put(cache_key, response.content)
         return response.content
+
+    async def stream(self, system_message, human_message):
+        # 生成中の応答を届いた分から順に返す。キャッシュがあればまとめて一度に返す
+        cache_key = None
+        if self.cache:
+            cache_key = self.cache.get_key(self.model, system_message, human_message)
+            cached_response = self.cache.get(cache_key)
+            self.metrics.record_cache('llm', cached_response is not None)
+            if cached_response is not None:
+                yield cached_response
+                return
+        messages = [
+            self.render_system_message(content=system_message),
+            self.render_human_message(content=human_message)
+        ]
+        chunks = []
+        usage = None
+        started_at = time.perf_counter()
+        with self.metrics.stage('llm'):
+            async for chunk in self.get_llm().astream(input=messages):
+                if chunk.usage_metadata:
+                    usage = chunk.usage_metadata
+                if chunk.content:
+                    chunks.append(chunk.content)
+                    yield chunk.content
+        self.metrics.record_llm('stream', time.perf_counter() - started_at, usage)
+        if self.cache:
+            self.cache.put(cache_key, "".join(chunks))
+
+    async def stream_json_array(self, system_message, human_message):
+        # JSON配列の応答を、要素が閉じるたびに一つずつ返す。
+        # 同時に複数の呼び出しがあるため、最初の要素までの時間はメトリクスにだけ記録する
+        started_at = time.monotonic()
+        parser = JsonArrayParser()
+        chunks = []
+        has_items = False
+        async for chunk in self.stream(system_message, human_message):
+            chunks.append(chunk)
+            for item in parser.feed(chunk):
+                if not has_items:
+                    has_items = True
+                    self.metrics.record_time_to_first_item(time.monotonic() - started_at)
+                yield item
+        if has_items:
+            return
+        # 要素を一つも返せなかった場合は、応答全体をJSONとして解釈し直す（空の応答なら何も返さない）
+        response = parse_json_response("".join(chunks))
+        if response is None:
+            return
+        for item in response if isinstance(response, list) else [response]:
+            yield item
+
+    def get_cache_stats(self):
+        if self.cache:
+            return self.cache.get_stats()
+        return None
@@ -0,0 +1,75 @@
+import os
+import json
+import asyncio
+from dotenv import load_dotenv
+from diff_payload import count_tokens
+from llm_stream import strip_code_fence
+
+load_dotenv()
+LLM_BATCH_WINDOW = float(os.getenv('LLM_BATCH_WINDOW', '0.5'))
+LLM_BATCH_TOKEN_BUDGET = int(os.getenv('LLM_BATCH_TOKEN_BUDGET', '6000'))
+LLM_BATCH_MAX_ITEMS = int(os.getenv('LLM_BATCH_MAX_ITEMS', '10'))
+
+
+def format_batch_sections(sections):
+    # 各項目を「=== ID: ... ===」で区切って一つのメッセージにまとめる
+    return "\n\n".join([f"=== ID: {key} ===\n{section}" for key, section in sections])
+
+
+def parse_batch_response(response):
+    # {ID: [コメント, ...]} 形式の応答を読む。コードブロックで囲まれていても受け付ける
+    results = json.loads(strip_code_fence(response))
+    if not isinstance(results, dict):
+        raise ValueError("一括応答がIDをキーとするオブジェクトではありません。")
+    return {key: comments for key, comments in results.items() if isinstance(comments, list)}
+
+
+class LLMBatcher:
+    # 短い時間内に届いた依頼をまとめ、トークン予算に収まる単位で一度のLLM呼び出しにする。
+    # submitの戻り値がNoneの場合、呼び出し側は個別にLLMへ依頼する
+    def __init__(self, run_batch, window=LLM_BATCH_WINDOW, token_budget=LLM_BATCH_TOKEN_BUDGET, max_items=LLM_BATCH_MAX_ITEMS, token_counter=count_tokens):
+        self.run_batch = run_batch
+        self.window = window
+        self.token_budget = token_budget
+        self.max_items = max_items
+        self.count_tokens = token_counter
+        self.pending = []
+        self.flush_task = None
+
+    async def submit(self, key, section):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((key, section, future))
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_after_window())
+        return await future
+
+    async def flush_after_window(self):
+        await asyncio.sleep(self.window)
+        entries, self.pending = self.pending, []
+        self.flush_task = None
+        await asyncio.gather(*[self.run(batch) for batch in self.split(entries)])
+
+    def split(self, entries):
+        batches = []
+        batch, used_tokens = [], 0
+        for entry in entries:
+            tokens = self.count_tokens(entry[1])
+            if batch and (used_tokens + tokens > self.token_budget or len(batch) >= self.max_items):
+                batches.append(batch)
+                batch, used_tokens = [], 0
+            batch.append(entry)
+            used_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    async def run(self, batch):
+        results = {}
+        if len(batch) > 1:
+            try:
+                results = await self.run_batch([(key, section) for key, section, _ in batch])
+            except Exception as e:
+                print(f"一括での依頼に失敗したため、{len(batch)}件を個別に依頼します: {e}")
+        for key, _, future in batch:
+            if not future.done():
+                future.set_result(results.get(key))
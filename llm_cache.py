@@ -0,0 +1,101 @@
+import os
+import time
+import json
+import hashlib
+from collections import OrderedDict
+
+
+class LLMResponseCache:
+    def __init__(self, cache_dir, max_entries=1000, max_bytes=100 * 1024 * 1024, max_age=7 * 24 * 60 * 60):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        # キー -> (ファイルサイズ, 作成時刻)。先頭ほど長く使われていない
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.load_index()
+
+    def load_index(self):
+        # atimeを最終アクセス時刻、mtimeを作成時刻として記録しているので、atime順に並べてLRUの順序を復元する
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith('.json'):
+                stat = entry.stat()
+                files.append((stat.st_atime, entry.name[:-len('.json')], stat.st_size, stat.st_mtime))
+        for _, key, size, created_at in sorted(files):
+            self.entries[key] = (size, created_at)
+            self.total_bytes += size
+        self.evict()
+
+    def get_key(self, model, system_message, human_message):
+        payload = json.dumps([model, system_message, human_message], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get_file_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def remove(self, key):
+        size, _ = self.entries.pop(key)
+        self.total_bytes -= size
+        try:
+            os.remove(self.get_file_path(key))
+        except FileNotFoundError:
+            pass
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        try:
+            with open(self.get_file_path(key), 'r', encoding='utf-8') as file:
+                cached = json.load(file)
+        except (OSError, ValueError):
+            self.remove(key)
+            self.misses += 1
+            return None
+        if time.time() - cached['created_at'] > self.max_age:
+            self.remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        os.utime(self.get_file_path(key), (time.time(), entry[1]))
+        self.hits += 1
+        return cached['response']
+
+    def put(self, key, response):
+        if key in self.entries:
+            self.remove(key)
+        file_path = self.get_file_path(key)
+        tmp_file_path = f"{file_path}.tmp"
+        with open(tmp_file_path, 'w', encoding='utf-8') as file:
+            json.dump({'created_at': time.time(), 'response': response}, file, ensure_ascii=False)
+        os.replace(tmp_file_path, file_path)
+        stat = os.stat(file_path)
+        self.entries[key] = (stat.st_size, stat.st_mtime)
+        self.total_bytes += stat.st_size
+        self.evict()
+
+    def evict(self):
+        # 件数・容量の上限を超えた分と期限切れのものを古い順に削除する
+        now = time.time()
+        for key, (_, created_at) in list(self.entries.items()):
+            if now - created_at > self.max_age:
+                self.remove(key)
+        while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            self.remove(next(iter(self.entries)))
+
+    def get_stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': len(self.entries),
+            'bytes': self.total_bytes
+        }
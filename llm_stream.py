@@ -0,0 +1,152 @@
+import json
+import time
+import asyncio
+
+
+class JsonArrayParser:
+    # ストリーミングで届くJSON配列を少しずつ受け取り、要素が閉じた時点でその要素を返す
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+        self.in_array = False
+        # 配列の「]」まで読んだか。空の配列でもTrueになる
+        self.is_complete = False
+        # 次の空白以外の文字が値の始まりか。応答の先頭とコードブロックの開始行の直後だけTrueになる
+        self.at_value_start = True
+        self.in_fence_header = False
+        self.backticks = 0
+        self.element_start = None
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, chunk):
+        items = []
+        self.buffer += chunk
+        while self.position < len(self.buffer):
+            char = self.buffer[self.position]
+            self.position += 1
+            if not self.in_array:
+                self.skip_preamble(char)
+                continue
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                continue
+            if char == '"':
+                self.in_string = True
+            elif char in '{[':
+                if self.element_start is None:
+                    self.element_start = self.position - 1
+                self.depth += 1
+            elif char in '}]':
+                if self.depth == 0:
+                    # 配列の終わり
+                    self.in_array = False
+                    self.is_complete = True
+                    continue
+                self.depth -= 1
+                if self.depth == 0:
+                    items.append(json.loads(self.buffer[self.element_start:self.position]))
+                    self.element_start = None
+        # 処理済みの部分は捨てる
+        keep_from = self.position if self.element_start is None else self.element_start
+        self.buffer = self.buffer[keep_from:]
+        self.position -= keep_from
+        if self.element_start is not None:
+            self.element_start -= keep_from
+        return items
+
+    def skip_preamble(self, char):
+        # 応答の先頭か「```json」などの行の直後にある「[」だけを配列の始まりとみなし、前置きの文章中の「[」は読み飛ばす
+        if self.in_fence_header:
+            if char == '\n':
+                self.in_fence_header = False
+                self.at_value_start = True
+            return
+        if char == '`':
+            self.backticks += 1
+            if self.backticks == 3:
+                self.backticks = 0
+                self.in_fence_header = True
+            return
+        self.backticks = 0
+        if char.isspace():
+            return
+        if char == '[' and self.at_value_start and not self.is_complete:
+            self.in_array = True
+        self.at_value_start = False
+
+
+def parse_json_response(text):
+    # 応答全体をJSONとして解釈する。前置きの文章がある場合は、JSONとして読める最初の「[」か「{」から解釈する
+    text = strip_code_fence(text)
+    if not text:
+        return None
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError as e:
+        decoder = json.JSONDecoder()
+        for start, char in enumerate(text):
+            if char in '[{':
+                try:
+                    return decoder.raw_decode(text, start)[0]
+                except json.JSONDecodeError:
+                    continue
+        raise e
+
+
+def strip_code_fence(text):
+    # 「```json ... ```」のように囲まれた応答から中身を取り出す
+    text = text.strip()
+    if text.startswith('```'):
+        text = text.split('\n', 1)[1] if '\n' in text else ""
+        text = text.rsplit('```', 1)[0]
+    return text.strip()
+
+
+async def apply_incrementally(items, apply, min_interval=0):
+    # 届いた要素を順にapplyへ渡す。applyの実行中に届いた要素は次の呼び出しでまとめて渡すので、
+    # 書き込みは常に一つずつ、生成と並行して進む。min_intervalを指定した場合は、前回の呼び出しから
+    # その秒数が経つまで待ち、その間に届いた要素もまとめる（生成が終わったら待たずに渡す）
+    applied = []
+    pending = []
+    task = None
+    finished = asyncio.Event()
+    applied_at = None
+
+    async def apply_pending():
+        nonlocal pending, applied_at
+        while pending:
+            if applied_at is not None and not finished.is_set():
+                delay = applied_at + min_interval - time.monotonic()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(finished.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+            batch, pending = pending, []
+            applied.extend(batch)
+            applied_at = time.monotonic()
+            await apply(batch)
+
+    try:
+        async for item in items:
+            pending.append(item)
+            if task is None or task.done():
+                if task is not None:
+                    task.result()
+                task = asyncio.create_task(apply_pending())
+        finished.set()
+        if task is not None:
+            await task
+    finally:
+        # 生成が途中で失敗しても、実行中の書き込みは最後まで待ってから例外を伝える
+        if task is not None:
+            await asyncio.gather(task, return_exceptions=True)
+    return applied
+
@@ -1,37 +1,44 @@
-import difflib
 import os
+from diff_engine import get_diff_content
+from comment_placement import place_comments
+from snapshot_store import SnapshotStore, SNAPSHOT_BACKEND, SNAPSHOT_HISTORY_SIZE
 
 
 class MarkdownAgent:
-    def __init__(self, projects_path, project_name):
+    def __init__(self, projects_path=None, project_name=None, md_file_path=None, snapshot_backend=SNAPSHOT_BACKEND, snapshot_history_size=SNAPSHOT_HISTORY_SIZE):
+        # プロジェクトのPBIを保存する場合はprojects_pathとproject_nameを、単一のファイルを扱う場合はmd_file_pathを指定する
         self.projects_path = projects_path
         self.project_name = project_name
-        self.project_path = f"{self.projects_path}/{self.project_name}"
-        if not os.path.exists(self.project_path):
-            os.makedirs(self.project_path)
+        self.md_file_path = md_file_path
+        self.project_path = None
+        self.snapshot_store = None
+        if projects_path is not None:
+            self.project_path = f"{self.projects_path}/{self.project_name}"
+            if not os.path.exists(self.project_path):
+                os.makedirs(self.project_path)
+            self.snapshot_store = SnapshotStore(self.project_path, snapshot_backend, snapshot_history_size)
 
     def delete_project_item(self, id):
-        file_path = f"{self.project_path}/{id}.md"
-        if os.path.exists(file_path):
-            os.remove(file_path)
-
-    def get_saved_content(self, id):
-        file_path = f"{self.project_path}/{id}.md"
-        if os.path.exists(file_path):
-            with open(file_path, 'r', encoding='utf-8') as file:
-                return file.read()
-        else:
-            print(f"ファイルが存在しません: {file_path}")
-            return None
+        self.snapshot_store.remove(id)
+
+    def get_saved_content(self, id, versions_back=0):
+        # versions_back を指定すると、最新より前に保存した版を返す
+        content = self.snapshot_store.get(id, versions_back)
+        if content is None:
+            print(f"保存された内容がありません: {id}")
+        return content
 
     def save_project_items(self, project_items):
+        # 内容が変わったPBIだけを書き込み、書き込んだ件数を返す
+        saved_count = 0
         for item in project_items:
-            id = item['id']
             body = self.get_content_without_ai_feedback(item['body'])
-            file_path = f"{self.project_path}/{id}.md"
+            if self.snapshot_store.put(item['id'], body):
+                saved_count += 1
+        return saved_count
 
-            with open(file_path, 'w', encoding='utf-8') as file:
-                file.write(body)
+    def get_diff_from_saved(self, id, new_content, versions_back=0):
+        return self.snapshot_store.diff(id, new_content, versions_back)
 
     def get_file_content(self, md_file_path):
         if md_file_path:
@@ -50,33 +57,30 @@ class MarkdownAgent:
                 filtered_lines.append(line)
         return '\n'.join(filtered_lines)
 
+    def format_ai_feedback(self, comment):
+        return [f"> {text_line}" for text_line in comment['comment'].split('\n')]
+
+    def insert_ai_feedback(self, markdown_content, comments):
+        # 挿入先が見つかったコメントだけを反映し、見つからなかったコメントは一覧で返す
+        lines, unplaced_comments = place_comments(
+            markdown_content.splitlines(), comments, self.format_ai_feedback)
+        return '\n'.join(lines), unplaced_comments
+
+    def place_ai_feedback(self, markdown_content, comments):
+        new_content, unplaced_comments = self.insert_ai_feedback(markdown_content, comments)
+        for comment in unplaced_comments:
+            print(f"挿入位置が見つかりませんでした: {comment['position']}")
+        return new_content, unplaced_comments
+
     def get_content_with_ai_feedback(self, markdown_content, comments):
-        lines = markdown_content.splitlines()
-        for comment in comments:
-            position = comment['position']
-            text = comment['comment']
-            position_found = False
-            for i, line in enumerate(lines):
-                if position in line:
-                    text_lines = text.split('\n')
-                    for j, text_line in enumerate(text_lines):
-                        lines.insert(i + 1 + j, f"> {text_line}")
-                    position_found = True
-                    break
-
-            if not position_found:
-                print(f"挿入位置が見つかりませんでした: {position}")
-                return None
-
-        return '\n'.join(lines)
+        return self.place_ai_feedback(markdown_content, comments)[0]
 
     def clear_ai_feedback(self):
         with open(self.md_file_path, 'r', encoding='utf-8') as file:
-            lines = file.readlines()
-        lines = self.get_content_without_ai_feedback('\n'.join(lines))
+            content = self.get_content_without_ai_feedback(file.read())
 
         with open(self.md_file_path, 'w', encoding='utf-8') as file:
-            file.writelines(lines)
+            file.write(content)
 
     def add_text_to_markdown(self, position, text):
         with open(self.md_file_path, 'r', encoding='utf-8') as file:
@@ -99,17 +103,4 @@ class MarkdownAgent:
             file.writelines(lines)
 
     def get_diff_content(self, old_content, new_content):
-        diff = difflib.ndiff(
-            old_content.splitlines(),
-            new_content.splitlines()
-        )
-        diff_content = []
-        for line in diff:
-            if line.startswith('-'):
-                diff_content.append(f"--{line[2:]}")
-            elif line.startswith('+'):
-                diff_content.append(f"++{line[2:]}")
-            elif line.startswith(' '):
-                diff_content.append(line[2:])  # 変更されていない行はそのまま出力
-
-        return '\n'.join(diff_content)
+        return get_diff_content(old_content, new_content)
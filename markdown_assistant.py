@@ -1,9 +1,13 @@
 import os
 import time
 import asyncio
-import json
 from markdown_agent import MarkdownAgent
 from llm_agent import LLMAgent
+from diff_payload import DiffPayloadBuilder
+from llm_stream import apply_incrementally
+from metrics import shared_metrics
+from flight_recorder import install_flight_recorder
+from file_watcher import FileWatcher
 from dotenv import load_dotenv
 import pytz
 from datetime import datetime
@@ -13,7 +17,6 @@ tokyo_tz = pytz.timezone('Asia/Tokyo')
 
 load_dotenv()
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-os.environ['OPENAI_API_KEY'] = OPENAI_API_KEY
 
 prompt_file_path = './test/prompt.txt'
 md_file_path = './test/page_content.md'
@@ -21,9 +24,9 @@ diff_file_path = './test/page_content_diff.md'
 
 
 class MarkdownAssistant:
-    def __init__(self, openai_api_key, input_md_file_path, prompt_file_path, md_file_path, diff_file_path, auto_mode=True):
+    def __init__(self, openai_api_key, input_md_file_path, prompt_file_path, md_file_path, diff_file_path, auto_mode=True, llm_agent=None):
         self.markdown_agent = MarkdownAgent(md_file_path=md_file_path)
-        self.llm_agent = LLMAgent()
+        self.llm_agent = llm_agent or LLMAgent()
         self.input_md_file_path = input_md_file_path
         self.prompt_file_path = prompt_file_path
         self.md_file_path = md_file_path
@@ -35,6 +38,7 @@ class MarkdownAssistant:
         self.last_update_time = None
         self.prompt = None
         self.diff_content = None
+        self.diff_payload_builder = DiffPayloadBuilder()
         with open(self.prompt_file_path, 'r', encoding='utf-8') as file:
             self.prompt = file.read()
 
@@ -44,14 +48,29 @@ class MarkdownAssistant:
 
     async def assist_markdown(self):
         print("LLMに送信します。")
-        llm_response = await self.llm_agent(system_message=self.prompt, human_message=self.diff_content)
-        # コメントを追加
-        comments = json.loads(llm_response)
         self.markdown_agent.clear_ai_feedback()
+        placed_comments = []
+        started_at = time.monotonic()
+        time_to_first_comment = None
+
+        async def write_comments(comments):
+            # 生成が続いている間も、届いたコメントまでを反映してファイルを書き直す
+            nonlocal time_to_first_comment
+            if time_to_first_comment is None:
+                time_to_first_comment = time.monotonic() - started_at
+            placed_comments.extend(comments)
+            with shared_metrics.stage('placement'):
+                self.new_md_content = self.markdown_agent.insert_ai_feedback(
+                    self.present_md_content, placed_comments)[0]
+            with shared_metrics.stage('write_back'):
+                self.save_to_file(self.new_md_content, self.input_md_file_path)
+
+        comments = await apply_incrementally(
+            self.llm_agent.stream_json_array(system_message=self.prompt, human_message=self.diff_content),
+            write_comments)
         print(f"コメント: {comments}")
-        self.new_md_content = self.markdown_agent.get_content_with_ai_feedback(
-            self.present_md_content, comments)
-        self.save_to_file(self.new_md_content, self.input_md_file_path)
+        if time_to_first_comment is not None:
+            print(f"最初のコメントまで{time_to_first_comment:.2f}秒")
         tokyo_time = datetime.fromtimestamp(
             self.last_update_time, tokyo_tz).strftime('%Y-%m-%d %H:%M:%S')
         print(f"ページの中身が保存され、コメントが追加されました。最終更新日時: {tokyo_time} (東京の時間)")
@@ -66,7 +85,7 @@ class MarkdownAssistant:
     def contains_unmarked_user_input(self, markdown_content):
         return "user:" in markdown_content and "!user:" not in markdown_content
 
-    async def run_schedule(self):
+    def initialize_content(self):
         previous_markdown_content = self.markdown_agent.get_file_content(
             md_file_path=self.input_md_file_path)
         self.previous_md_content = self.markdown_agent.get_content_without_ai_feedback(
@@ -75,41 +94,54 @@ class MarkdownAssistant:
         self.save_to_file(self.previous_md_content, self.md_file_path)
         self.is_updated = False
         self.last_update_time = time.time()
+
+    async def run_schedule(self):
+        await shared_metrics.start_server()
+        install_flight_recorder()
+        self.initialize_content()
+        self.llm_agent.start_warm_up()
         print(f"ページ更新検知開始 自動モード:{self.auto_mode}")
-        while True:
-            await self.fetch_and_save_content()
-            await asyncio.sleep(1)
-
-    async def fetch_and_save_content(self):
-        try:
-            markdown_content = self.markdown_agent.get_file_content(
-                md_file_path=self.input_md_file_path)
-            self.present_md_content = self.markdown_agent.get_content_without_ai_feedback(
-                markdown_content)
-            if not self.present_md_content:
-                print("ページが見つかりませんでした。")
-                return
-            if self.present_md_content != self.previous_md_content:
+        # ファイルが1秒間変更されなくなってから読み込み、変化があればLLMに送信する
+        await FileWatcher([self.input_md_file_path], self.fetch_and_save_content, debounce=1).run()
+
+    async def fetch_and_save_content(self, path=None):
+        # ファイルの読み込みからコメントの書き戻しまでを1サイクルとして記録する
+        with shared_metrics.cycle('markdown') as cycle:
+            try:
+                with shared_metrics.stage('fetch'):
+                    markdown_content = self.markdown_agent.get_file_content(
+                        md_file_path=self.input_md_file_path)
+                with shared_metrics.stage('detect'):
+                    self.present_md_content = self.markdown_agent.get_content_without_ai_feedback(
+                        markdown_content)
+                if not self.present_md_content:
+                    print("ページが見つかりませんでした。")
+                    return
+                if self.present_md_content == self.previous_md_content:
+                    # コメントの書き込みなど、AIのフィードバック以外に変化がない場合
+                    return
                 print("ページが更新されました。")
+                cycle.changed = True
                 self.is_updated = True
-                # 変化があった場合、更新時間を記録
                 self.previous_md_content = self.present_md_content
                 self.last_update_time = time.time()
-            elif self.auto_mode and self.is_updated and time.time() - self.last_update_time >= 1:
-                # 1秒間変化がなかった場合、保存してLLMに送信
-                self.diff_content = self.markdown_agent.get_diff_to_file(
-                    self.saved_md_content, self.present_md_content)
-                self.saved_md_content = self.present_md_content
-                await self.assist_markdown()
-                self.save_to_file(self.diff_content, self.diff_file_path)
-                self.is_updated = False
-        except Exception as e:
-            print(e)
+                if self.auto_mode:
+                    with shared_metrics.stage('diff'):
+                        self.diff_content = self.diff_payload_builder.build(
+                            self.saved_md_content, self.present_md_content)
+                    self.saved_md_content = self.present_md_content
+                    await self.assist_markdown()
+                    with shared_metrics.stage('save'):
+                        self.save_to_file(self.diff_content, self.diff_file_path)
+                    self.is_updated = False
+            except Exception as e:
+                print(e)
 
 auto_mode = True
 input_md_file_path = './test/input_and_output_content.md'
 
 # 非同期関数を実行するためのエントリーポイント
-markdown_assistant = MarkdownAssistant(
-    OPENAI_API_KEY, input_md_file_path, prompt_file_path, md_file_path, diff_file_path, auto_mode)
-asyncio.run(markdown_assistant.run_schedule())
+if __name__ == "__main__":
+    markdown_assistant = MarkdownAssistant(
+        OPENAI_API_KEY, input_md_file_path, prompt_file_path, md_file_path, diff_file_path, auto_mode)
+    asyncio.run(markdown_assistant.run_schedule())
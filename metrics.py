@@ -0,0 +1,264 @@
+import os
+import json
+import time
+import bisect
+import contextvars
+from contextlib import contextmanager
+from collections import Counter
+from dotenv import load_dotenv
+from http_server import LocalHttpServer
+
+load_dotenv()
+# 未指定の場合はPrometheus形式のエンドポイントを開かない
+METRICS_PORT = os.getenv('METRICS_PORT')
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PATH = os.getenv('METRICS_PATH', '/metrics')
+# 指定した場合、サイクルごとの集計をJSON Lines形式で追記する
+METRICS_LOG_PATH = os.getenv('METRICS_LOG_PATH')
+# 変化のなかったサイクルも記録するか（ポーリングのたびに1行増える）
+METRICS_LOG_IDLE = os.getenv('METRICS_LOG_IDLE', 'false').lower() == 'true'
+METRICS_PREFIX = 'assistant_'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+METRIC_HELPS = {
+    'cycle_seconds': ('histogram', '検知ループ1回あたりの所要時間'),
+    'stage_seconds': ('histogram', '段階（取得・変更検知・差分・LLM・コメント配置・書き戻し・保存）ごとの所要時間'),
+    'http_requests_total': ('counter', 'APIごとのHTTPリクエスト数'),
+    'http_request_seconds': ('histogram', 'APIごとのHTTPリクエストの所要時間'),
+    'http_retries_total': ('counter', 'APIごとの再試行の回数'),
+    'llm_requests_total': ('counter', 'LLMの呼び出し回数'),
+    'llm_request_seconds': ('histogram', 'LLMの呼び出しの所要時間'),
+    'llm_time_to_first_item_seconds': ('histogram', 'ストリーミングで最初のコメントが届くまでの時間'),
+    'llm_tokens_total': ('counter', 'LLMの入力・出力トークン数'),
+    'cache_requests_total': ('counter', 'キャッシュごとのヒット・ミスの回数'),
+    'cache_hit_ratio': ('gauge', 'キャッシュごとのヒット率'),
+}
+
+# 実行中のサイクル。asyncio.gatherやcreate_taskで作られたタスクにも引き継がれる
+current_cycle = contextvars.ContextVar('current_cycle', default=None)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Cycle:
+    # 検知ループ1回分の集計。終了時にJSONログの1行になる
+    def __init__(self, loop):
+        self.loop = loop
+        self.started_at = time.time()
+        self.started_perf = time.perf_counter()
+        self.changed = False
+        self.stages = Counter()
+        self.http_requests = Counter()
+        self.llm_requests = 0
+        self.llm_tokens = Counter()
+        self.cache = {}
+        # フライトレコーダーが有効な場合のみ、HTTP・LLM呼び出しと段階の記録を残す
+        self.events = None
+        self.dropped_events = 0
+
+    def to_dict(self, duration):
+        return {
+            'time': self.started_at,
+            'loop': self.loop,
+            'changed': self.changed,
+            'duration': round(duration, 6),
+            # 並行して進む段階（LLMの生成中の書き戻しなど）は重なって数えられる
+            'stages': {stage: round(seconds, 6) for stage, seconds in self.stages.items()},
+            'http_requests': dict(self.http_requests),
+            'llm_requests': self.llm_requests,
+            'llm_tokens': dict(self.llm_tokens),
+            'cache': {
+                name: {**counts, 'hit_rate': counts['hits'] / (counts['hits'] + counts['misses'])}
+                for name, counts in self.cache.items()
+            },
+        }
+
+
+class Metrics:
+    # 各段階の所要時間、HTTPリクエスト数、LLMのトークン数、キャッシュのヒット率を集計する
+    def __init__(self, log_path=METRICS_LOG_PATH, log_idle=METRICS_LOG_IDLE):
+        self.log_path = log_path
+        self.log_idle = log_idle
+        self.counters = {}
+        self.histograms = {}
+        self.server = None
+        self.recorder = None
+
+    def get_labels_key(self, labels):
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        self.counters.setdefault(name, Counter())[self.get_labels_key(labels)] += value
+
+    def observe(self, name, value, **labels):
+        histograms = self.histograms.setdefault(name, {})
+        key = self.get_labels_key(labels)
+        if key not in histograms:
+            histograms[key] = Histogram()
+        histograms[key].observe(value)
+
+    @contextmanager
+    def cycle(self, loop):
+        # with metrics.cycle('github') as cycle: の中で記録した値をサイクル単位でもまとめる
+        cycle = current_cycle.get()
+        if cycle is not None and cycle.loop == loop:
+            # 同じループのサイクルの中から呼ばれた場合は外側のサイクルに含める
+            yield cycle
+            return
+        cycle = Cycle(loop)
+        recorder = self.recorder
+        if recorder:
+            cycle.events = []
+        token = current_cycle.set(cycle)
+        try:
+            yield cycle
+        finally:
+            current_cycle.reset(token)
+            duration = time.perf_counter() - cycle.started_perf
+            self.observe('cycle_seconds', duration, loop=loop, changed=str(cycle.changed).lower())
+            if self.log_path and (cycle.changed or self.log_idle):
+                self.write_log(cycle.to_dict(duration))
+            if recorder:
+                recorder.finish_cycle(cycle, duration)
+
+    def record_event(self, event_type, duration, **fields):
+        # 実行中のサイクルにイベントを追加する。offsetはサイクル開始からイベント開始までの秒数
+        cycle = current_cycle.get()
+        if cycle is None or cycle.events is None:
+            return
+        if self.recorder and len(cycle.events) >= self.recorder.max_events:
+            cycle.dropped_events += 1
+            return
+        offset = time.perf_counter() - duration - cycle.started_perf
+        cycle.events.append({'type': event_type, 'offset': round(offset, 6), 'duration': round(duration, 6), **fields})
+
+    @contextmanager
+    def stage(self, stage):
+        cycle = current_cycle.get()
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - started_at
+            self.observe('stage_seconds', duration, loop=cycle.loop if cycle else 'none', stage=stage)
+            if cycle:
+                cycle.stages[stage] += duration
+                self.record_event('stage', duration, stage=stage)
+
+    def record_http(self, api, method, status, duration, url=None, request_bytes=0, response_bytes=0):
+        api = api or 'other'
+        self.inc('http_requests_total', api=api, method=method, status=status)
+        self.observe('http_request_seconds', duration, api=api)
+        cycle = current_cycle.get()
+        if cycle:
+            cycle.http_requests[api] += 1
+            self.record_event('http', duration, api=api, method=method, url=url, status=status, request_bytes=request_bytes, response_bytes=response_bytes)
+
+    def record_http_retry(self, api):
+        self.inc('http_retries_total', api=api or 'other')
+
+    def record_llm(self, mode, duration, usage=None):
+        # usageはlangchainのusage_metadata（input_tokens・output_tokens）
+        self.inc('llm_requests_total', mode=mode)
+        self.observe('llm_request_seconds', duration, mode=mode)
+        cycle = current_cycle.get()
+        if cycle:
+            cycle.llm_requests += 1
+        tokens = {}
+        for kind in ('input', 'output'):
+            tokens[kind] = (usage or {}).get(f'{kind}_tokens') or 0
+            if tokens[kind]:
+                self.inc('llm_tokens_total', tokens[kind], type=kind)
+                if cycle:
+                    cycle.llm_tokens[kind] += tokens[kind]
+        self.record_event('llm', duration, mode=mode, input_tokens=tokens['input'], output_tokens=tokens['output'])
+
+    def record_time_to_first_item(self, duration):
+        self.observe('llm_time_to_first_item_seconds', duration)
+
+    def record_cache(self, cache, hit, count=1):
+        self.inc('cache_requests_total', count, cache=cache, result='hit' if hit else 'miss')
+        cycle = current_cycle.get()
+        if cycle:
+            counts = cycle.cache.setdefault(cache, Counter(hits=0, misses=0))
+            counts['hits' if hit else 'misses'] += count
+
+    def write_log(self, entry):
+        try:
+            with open(self.log_path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"メトリクスのログを書き込めませんでした: {e}")
+
+    def format_labels(self, key, extra=()):
+        labels = list(key) + list(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+    def get_cache_hit_ratios(self):
+        totals = {}
+        for key, value in self.counters.get('cache_requests_total', {}).items():
+            labels = dict(key)
+            hits, requests = totals.get(labels['cache'], (0, 0))
+            totals[labels['cache']] = (hits + (value if labels['result'] == 'hit' else 0), requests + value)
+        return {cache: hits / requests for cache, (hits, requests) in totals.items() if requests}
+
+    def render_prometheus(self):
+        # Prometheusのテキスト形式（version 0.0.4）で出力する
+        lines = []
+        for name, (metric_type, help_text) in METRIC_HELPS.items():
+            full_name = METRICS_PREFIX + name
+            if metric_type == 'counter' and name in self.counters:
+                lines += [f"# HELP {full_name} {help_text}", f"# TYPE {full_name} counter"]
+                for key, value in sorted(self.counters[name].items()):
+                    lines.append(f"{full_name}{self.format_labels(key)} {value}")
+            elif metric_type == 'histogram' and name in self.histograms:
+                lines += [f"# HELP {full_name} {help_text}", f"# TYPE {full_name} histogram"]
+                for key, histogram in sorted(self.histograms[name].items()):
+                    cumulative = 0
+                    for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                        cumulative += count
+                        lines.append(f"{full_name}_bucket{self.format_labels(key, [('le', bound)])} {cumulative}")
+                    lines.append(f"{full_name}_sum{self.format_labels(key)} {histogram.sum}")
+                    lines.append(f"{full_name}_count{self.format_labels(key)} {histogram.count}")
+            elif name == 'cache_hit_ratio':
+                ratios = self.get_cache_hit_ratios()
+                if ratios:
+                    lines += [f"# HELP {full_name} {help_text}", f"# TYPE {full_name} gauge"]
+                    for cache, ratio in sorted(ratios.items()):
+                        lines.append(f'{full_name}{{cache="{cache}"}} {ratio}')
+        return "\n".join(lines) + "\n"
+
+    async def handle_request(self, method, path, headers, body):
+        if method != 'GET' or path.split('?', 1)[0] != METRICS_PATH:
+            return 404, 'text/plain', 'not found'
+        return 200, 'text/plain; version=0.0.4; charset=utf-8', self.render_prometheus()
+
+    async def start_server(self, host=METRICS_HOST, port=METRICS_PORT):
+        # portが未指定の場合は何もしない。複数のアシスタントから呼ばれても一度だけ開く
+        if not port or self.server is not None:
+            return self.server
+        self.server = LocalHttpServer(self.handle_request, host, int(port))
+        await self.server.start()
+        print(f"メトリクス公開開始: http://{self.server.host}:{self.server.port}{METRICS_PATH}")
+        return self.server
+
+    async def stop_server(self):
+        if self.server is not None:
+            await self.server.stop()
+            self.server = None
+
+
+shared_metrics = Metrics()
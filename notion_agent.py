@@ -1,9 +1,28 @@
-import requests
-import difflib
+import os
+import time
+import asyncio
+import itertools
+from datetime import datetime
+from collections import Counter
+from dotenv import load_dotenv
+from http_client import get_http_client
+from diff_engine import get_diff_content
+from comment_placement import PositionMatcher
+from request_budgeter import PRIORITY_POLL, PRIORITY_READ, PRIORITY_WRITE
+from metrics import shared_metrics
+
+load_dotenv()
+NOTION_MAX_IN_FLIGHT = int(os.getenv('NOTION_MAX_IN_FLIGHT', '3'))
+# キャッシュした子ブロックは親ブロックの更新日時が変わらない限り使い回す。親の更新日時が変わらない
+# 入れ子のブロックの編集は、この秒数ごとのキャッシュの全破棄まで（最大でこの秒数だけ）遅れて検知される
+NOTION_BLOCK_CACHE_REFRESH_INTERVAL = float(os.getenv('NOTION_BLOCK_CACHE_REFRESH_INTERVAL', '60'))
+# last_edited_timeの精度（秒）。同じ分のうちに取得した子ブロックは、その後の編集で更新日時が変わらないため使い回さない
+NOTION_TIMESTAMP_PRECISION = 60
+NOTION_API_URL = os.getenv('NOTION_API_URL', 'https://api.notion.com/v1')
 
 
 class NotionAgent:
-    def __init__(self, api_key, database_id):
+    def __init__(self, api_key, database_id, http_client=None, max_in_flight=NOTION_MAX_IN_FLIGHT, use_block_cache=True, block_cache_refresh_interval=NOTION_BLOCK_CACHE_REFRESH_INTERVAL, api_url=NOTION_API_URL):
         self.api_key = api_key
         self.database_id = database_id
         self.headers = {
@@ -11,10 +30,21 @@ class NotionAgent:
             'Authorization': 'Bearer ' + self.api_key,
             'Content-Type': 'application/json',
         }
-        self.url = f'https://api.notion.com/v1/databases/{
-            self.database_id}/query'
+        self.api_url = api_url
+        self.url = f'{self.api_url}/databases/{self.database_id}/query'
+        self.http = http_client or get_http_client()
+        # ブロック取得の同時リクエスト数を制限する
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        # 最終更新日時で検証する子ブロックのキャッシュと、本文と子の世代をキーにしたマークダウンのキャッシュ
+        self.use_block_cache = use_block_cache
+        self.block_cache_refresh_interval = block_cache_refresh_interval
+        self.block_cache_refreshed_at = None
+        self.block_generations = itertools.count()
+        # ブロックごとのキャッシュのヒット・ミスは数えておき、ページ単位でまとめてメトリクスに送る
+        self.cache_counts = Counter()
+        self.clear_block_cache()
 
-    def get_page_id_by_name(self, page_name):
+    async def get_page_id_by_name(self, page_name):
         json_data = {
             'filter': {
                 'property': '名前',
@@ -23,8 +53,11 @@ class NotionAgent:
                 }
             }
         }
-        response = requests.post(
-            self.url, headers=self.headers, json=json_data)
+        response = await self.http.post(
+            self.url, headers=self.headers, json=json_data, api='notion', priority=PRIORITY_READ)
+        if response.status_code != 200:
+            print(f"ページの検索に失敗しました: {response.text}")
+            return None
         results = response.json().get('results')
         if results:
             return results[0]['id']
@@ -32,124 +65,300 @@ class NotionAgent:
             print("ページが見つかりませんでした。")
             return None
 
-    def get_block_children(self, block_id):
-        blocks_url = f'https://api.notion.com/v1/blocks/{block_id}/children'
-        blocks_response = requests.get(blocks_url, headers=self.headers)
-        return blocks_response.json().get('results', [])
+    def get_page_title(self, page):
+        for page_property in page.get('properties', {}).values():
+            if page_property.get('type') == 'title':
+                return "".join([t['plain_text'] for t in page_property['title']])
+        return ""
 
-    def notion_to_markdown(self, blocks, indent=0):
-        markdown = ""
-        indent_str = "    " * indent
+    async def query_database_pages(self, since=None):
+        # データベースのページを一覧する。sinceを指定した場合はそれ以降に更新されたページのみ
+        json_data = {'page_size': 100}
+        if since:
+            json_data['filter'] = {
+                'timestamp': 'last_edited_time',
+                'last_edited_time': {
+                    'on_or_after': since
+                }
+            }
+        pages = []
+        while True:
+            async with self.semaphore:
+                response = await self.http.post(
+                    self.url, headers=self.headers, json=json_data, api='notion', priority=PRIORITY_POLL)
+            if response.status_code != 200:
+                print(f"データベースの取得に失敗しました: {response.text}")
+                return None
+            result = response.json()
+            for page in result.get('results', []):
+                pages.append({
+                    'id': page['id'],
+                    'title': self.get_page_title(page),
+                    'last_edited_time': page.get('last_edited_time'),
+                    'archived': page.get('archived', False) or page.get('in_trash', False)
+                })
+            if not result.get('has_more'):
+                return pages
+            json_data['start_cursor'] = result['next_cursor']
+
+    async def get_block_children(self, block_id):
+        # 取得に失敗した場合はNoneを返す（空のページとして差分を取らないように）
+        blocks_url = f'{self.api_url}/blocks/{block_id}/children'
+        blocks = []
+        params = {'page_size': 100}
+        while True:
+            async with self.semaphore:
+                blocks_response = await self.http.get(blocks_url, headers=self.headers, params=params, api='notion', priority=PRIORITY_READ)
+            if blocks_response.status_code != 200:
+                print(f"ブロックの取得に失敗しました: {blocks_response.text}")
+                return None
+            result = blocks_response.json()
+            blocks.extend(result.get('results', []))
+            if not result.get('has_more'):
+                return blocks
+            params = {'page_size': 100, 'start_cursor': result['next_cursor']}
+
+    async def get_block_tree(self, block_id):
+        # 子ブロックを全ページ分取得し、兄弟の部分木は並行して取得する
+        blocks = await self.get_block_children(block_id)
+        if blocks is None:
+            return None
+        parents = [block for block in blocks if block.get('has_children')]
+        children = await asyncio.gather(*[self.get_block_tree(block['id']) for block in parents])
+        if any(child_blocks is None for child_blocks in children):
+            return None
+        for block, child_blocks in zip(parents, children):
+            block['children'] = child_blocks
+        return blocks
+
+    async def get_cached_block_tree(self, block_id):
+        # 一定時間ごとにキャッシュを捨てて全体を取り直し、取りこぼしと不要なエントリを解消する
+        now = time.monotonic()
+        if self.block_cache_refreshed_at is None or now - self.block_cache_refreshed_at >= self.block_cache_refresh_interval:
+            self.clear_block_cache()
+            self.block_cache_refreshed_at = now
+        return await self.get_cached_subtree(block_id)
+
+    async def get_cached_subtree(self, block_id):
+        blocks = await self.get_block_children(block_id)
+        if blocks is None:
+            return None
+        stale_blocks = []
         for block in blocks:
-            block_type = block['type']
-            if 'rich_text' in block[block_type]:
-                text = block[block_type]['rich_text']
-                content = "".join([t['text']['content'] for t in text])
+            self.block_parents[block['id']] = block_id
+            if not block.get('has_children'):
+                self.block_cache.pop(block['id'], None)
+                continue
+            cached = self.block_cache.get(block['id'])
+            is_cached = bool(cached and cached['is_settled'] and cached['last_edited_time'] == block.get('last_edited_time'))
+            self.cache_counts['notion_block', is_cached] += 1
+            if is_cached:
+                block['children'] = cached['children']
+                block['children_generation'] = cached['generation']
             else:
-                content = ""
-
-            if block_type == 'paragraph':
-                markdown += f"{indent_str}{content}\n"
-            elif block_type == 'heading_1':
-                markdown += f"{indent_str}# {content}\n"
-            elif block_type == 'heading_2':
-                markdown += f"{indent_str}## {content}\n"
-            elif block_type == 'heading_3':
-                markdown += f"{indent_str}### {content}\n"
-            elif block_type == 'bulleted_list_item':
-                markdown += f"{indent_str}- {content}\n"
-            elif block_type == 'numbered_list_item':
-                markdown += f"{indent_str}1. {content}\n"
-            elif block_type == 'toggle':
-                markdown += f"{indent_str}{content}\n"
-            # 他のブロックタイプも必要に応じて追加
-
-            if block.get('has_children'):
-                child_blocks = self.get_block_children(block['id'])
-                markdown += self.notion_to_markdown(child_blocks, indent + 1)
+                stale_blocks.append(block)
+        # 更新日時が変わったブロックの子だけを取得し直す
+        fetched_at = time.time()
+        children = await asyncio.gather(*[self.get_cached_subtree(block['id']) for block in stale_blocks])
+        if any(child_blocks is None for child_blocks in children):
+            return None
+        for block, child_blocks in zip(stale_blocks, children):
+            generation = next(self.block_generations)
+            self.block_cache[block['id']] = {
+                'last_edited_time': block.get('last_edited_time'),
+                'is_settled': self.is_settled(block.get('last_edited_time'), fetched_at),
+                'children': child_blocks,
+                'generation': generation
+            }
+            block['children'] = child_blocks
+            block['children_generation'] = generation
+        return blocks
+
+    def is_settled(self, last_edited_time, fetched_at):
+        # 更新日時の分が過ぎてから取得した子ブロックなら、以降の編集は更新日時の変化として現れる
+        try:
+            edited_at = datetime.fromisoformat(last_edited_time.replace('Z', '+00:00')).timestamp()
+        except (AttributeError, ValueError):
+            return False
+        return fetched_at >= edited_at + NOTION_TIMESTAMP_PRECISION
+
+    def invalidate_block(self, block_id):
+        # 子が変わったブロックと、その祖先のキャッシュを無効にする
+        while block_id is not None:
+            self.block_cache.pop(block_id, None)
+            block_id = self.block_parents.get(block_id)
+
+    def clear_block_cache(self):
+        self.block_cache = {}
+        self.block_parents = {}
+        self.segment_cache = {}
+
+    def render_block(self, block, indent):
+        # 子孫に変化のないブロックは前回のマークダウンを使い回す。
+        # 本文は毎回取得したブロックから読み、更新日時は分単位のためキーに使わない
+        block_type = block['type']
+        content = self.get_block_text(block)
+        # 子を持たないブロックは本文が手元にあるので、キャッシュせずにそのまま変換する
+        is_cacheable = 'children_generation' in block
+        key = (block_type, content, indent, block.get('children_generation'))
+        if is_cacheable:
+            cached = self.segment_cache.get(block['id'])
+            is_cached = bool(cached and cached[0] == key)
+            self.cache_counts['notion_markdown', is_cached] += 1
+            if is_cached:
+                return cached[1]
 
+        indent_str = "    " * indent
+
+        markdown = ""
+        if block_type == 'paragraph':
+            markdown += f"{indent_str}{content}\n"
+        elif block_type == 'heading_1':
+            markdown += f"{indent_str}# {content}\n"
+        elif block_type == 'heading_2':
+            markdown += f"{indent_str}## {content}\n"
+        elif block_type == 'heading_3':
+            markdown += f"{indent_str}### {content}\n"
+        elif block_type == 'bulleted_list_item':
+            markdown += f"{indent_str}- {content}\n"
+        elif block_type == 'numbered_list_item':
+            markdown += f"{indent_str}1. {content}\n"
+        elif block_type == 'toggle':
+            markdown += f"{indent_str}{content}\n"
+        # 他のブロックタイプも必要に応じて追加
+
+        if block.get('children'):
+            markdown += self.notion_to_markdown(block['children'], indent + 1)
+
+        if is_cacheable:
+            self.segment_cache[block['id']] = (key, markdown)
         return markdown
 
-    def get_page_content(self, page_name):
-        page_id = self.get_page_id_by_name(page_name)
-        if page_id:
-            # ページのメタデータを取得
-            page_url = f'https://api.notion.com/v1/pages/{page_id}'
-            page_response = requests.get(page_url, headers=self.headers)
-            page_data = page_response.json()
-            last_edited_time = page_data.get('last_edited_time')
+    def notion_to_markdown(self, blocks, indent=0):
+        return "".join([self.render_block(block, indent) for block in blocks])
+
+    async def get_page_last_edited_time(self, page_id):
+        page_url = f'{self.api_url}/pages/{page_id}'
+        async with self.semaphore:
+            page_response = await self.http.get(page_url, headers=self.headers, api='notion', priority=PRIORITY_POLL)
+        if page_response.status_code != 200:
+            print(f"ページの取得に失敗しました: {page_response.text}")
+            return None
+        return page_response.json().get('last_edited_time')
+
+    async def get_page_content_by_id(self, page_id):
+        # ページのメタデータとブロックツリーを並行して取得
+        last_edited_time, blocks_content = await asyncio.gather(
+            self.get_page_last_edited_time(page_id),
+            self.get_cached_block_tree(page_id) if self.use_block_cache else self.get_block_tree(page_id))
+        if blocks_content is None:
+            self.report_cache_counts()
+            return None, last_edited_time
 
-            blocks_content = self.get_block_children(page_id)
+        # マークダウン形式に変換
+        markdown_content = self.notion_to_markdown(blocks_content)
+        self.report_cache_counts()
+        return markdown_content, last_edited_time
 
-            # マークダウン形式に変換
-            markdown_content = self.notion_to_markdown(blocks_content)
+    def report_cache_counts(self):
+        for (cache, hit), count in self.cache_counts.items():
+            shared_metrics.record_cache(cache, hit, count)
+        self.cache_counts.clear()
+
+    async def get_page_content(self, page_name):
+        page_id = await self.get_page_id_by_name(page_name)
+        if page_id:
+            markdown_content, last_edited_time = await self.get_page_content_by_id(page_id)
             return markdown_content, last_edited_time, page_id
         else:
             return None, None, None
 
-    def add_text_to_notion(self, page_id, position, text):
-        def find_and_add_text(blocks, position, text):
-            for i, block in enumerate(blocks):
-                block_type = block['type']
-                if 'rich_text' in block[block_type]:
-                    block_text = "".join([t['text']['content']
-                                         for t in block[block_type]['rich_text']])
-                else:
-                    block_text = ""
-
-                if position in block_text:
-                    new_block = {
-                        "object": "block",
-                        "type": "paragraph",
-                        "paragraph": {
-                            "rich_text": [
-                                {
-                                    "type": "text",
-                                    "text": {
-                                        "content": text
-                                    },
-                                    "annotations": {
-                                        "color": "gray"
-                                    }
-                                }
-                            ]
+    def get_block_text(self, block):
+        block_type = block['type']
+        if 'rich_text' in block[block_type]:
+            return "".join([t['text']['content'] for t in block[block_type]['rich_text']])
+        return ""
+
+    def create_comment_block(self, text):
+        return {
+            "object": "block",
+            "type": "paragraph",
+            "paragraph": {
+                "rich_text": [
+                    {
+                        "type": "text",
+                        "text": {
+                            "content": text
+                        },
+                        "annotations": {
+                            "color": "gray"
                         }
                     }
-                    # 新しいブロックを追加
-                    append_url = f'https://api.notion.com/v1/blocks/{
-                        block["id"]}/children'
-                    response = requests.patch(append_url, headers=self.headers, json={
-                                              "children": [new_block]})
-                    if response.status_code != 200:
-                        print(f"テキストの追加に失敗しました: {response.text}")
-                    else:
-                        print(f"テキストが追加されました: {text}")
-                    return True
-                if block.get('has_children'):
-                    child_blocks = self.get_block_children(block['id'])
-                    if find_and_add_text(child_blocks, position, text):
-                        return True
-            return False
+                ]
+            }
+        }
+
+    def index_blocks(self, blocks, index=None):
+        # ブロックツリーを文書順に平坦化し、位置検索用の(ブロック, テキスト)の一覧を作る
+        if index is None:
+            index = []
+        for block in blocks:
+            index.append((block, self.get_block_text(block)))
+            if block.get('children'):
+                self.index_blocks(block['children'], index)
+        return index
 
-        blocks_url = f'https://api.notion.com/v1/blocks/{page_id}/children'
-        blocks_response = requests.get(blocks_url, headers=self.headers)
-        blocks = blocks_response.json().get('results', [])
+    async def append_block_children(self, block_id, children):
+        append_url = f'{self.api_url}/blocks/{block_id}/children'
+        # 一度に追加できる子ブロックは100件まで
+        for start in range(0, len(children), 100):
+            async with self.semaphore:
+                response = await self.http.patch(append_url, headers=self.headers, json={
+                    "children": children[start:start + 100]}, api='notion', priority=PRIORITY_WRITE, idempotent=False)
+            if response.status_code != 200:
+                print(f"テキストの追加に失敗しました: {response.text}")
+                return False
+        self.invalidate_block(block_id)
+        return True
+
+    async def add_texts_to_notion(self, page_id, comments):
+        # ツリーを一度だけ辿り、コメントを挿入先のブロックごとにまとめて追加する
+        with shared_metrics.stage('fetch'):
+            if self.use_block_cache:
+                blocks = await self.get_cached_block_tree(page_id)
+            else:
+                blocks = await self.get_block_tree(page_id)
+        if blocks is None:
+            print("ブロックを取得できなかったため、コメントを追加できませんでした。")
+            return comments
+        with shared_metrics.stage('placement'):
+            self.report_cache_counts()
+            index = self.index_blocks(blocks)
+            first_blocks = PositionMatcher([comment['position'] for comment in comments]).find_first_lines(
+                [block_text for _, block_text in index])
+            new_children = {}
+            unplaced_comments = []
+            for comment in comments:
+                i = first_blocks.get(comment['position'])
+                block = index[i][0] if i is not None else None
+                if block is None:
+                    print(f"指定された位置にテキストを追加できませんでした: {comment['position']}")
+                    unplaced_comments.append(comment)
+                    continue
+                new_children.setdefault(block['id'], []).append(
+                    self.create_comment_block("AI:" + comment['comment']))
+        with shared_metrics.stage('write_back'):
+            results = await asyncio.gather(*[
+                self.append_block_children(block_id, children)
+                for block_id, children in new_children.items()
+            ])
+        for children, is_added in zip(new_children.values(), results):
+            if is_added:
+                print(f"テキストが{len(children)}件追加されました。")
+        return unplaced_comments
 
-        if not find_and_add_text(blocks, position, "AI:" + text):
-            print("指定された位置にテキストを追加できませんでした。")
+    async def add_text_to_notion(self, page_id, position, text):
+        await self.add_texts_to_notion(page_id, [{'position': position, 'comment': text}])
 
     def get_diff_to_file(self, old_content, new_content):
-        diff = difflib.ndiff(
-            old_content.splitlines(),
-            new_content.splitlines()
-        )
-        diff_content = []
-        for line in diff:
-            if line.startswith('-'):
-                diff_content.append(f"--{line[2:]}")
-            elif line.startswith('+'):
-                diff_content.append(f"++{line[2:]}")
-            elif line.startswith(' '):
-                diff_content.append(line[2:])  # 変更されていない行はそのまま出力
-
-        return '\n'.join(diff_content)
+        return get_diff_content(old_content, new_content)
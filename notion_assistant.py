@@ -1,9 +1,12 @@
 import os
 import time
 import asyncio
-import json
 from notion_agent import NotionAgent
 from llm_agent import LLMAgent
+from diff_payload import DiffPayloadBuilder
+from llm_stream import apply_incrementally
+from metrics import shared_metrics
+from flight_recorder import install_flight_recorder
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -11,19 +14,27 @@ NOTION_API_KEY = os.getenv('NOTION_API_KEY')
 DATABASE_ID = os.getenv('DATABASE_ID')
 PAGE_NAME = os.getenv('PAGE_NAME')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-os.environ['OPENAI_API_KEY'] = OPENAI_API_KEY
 
 prompt_file_path = './test/prompt.txt'
 md_file_path = './test/page_content.md'
 diff_file_path = './test/page_content_diff.md'
 
 auto_mode = False
+NOTION_DEBOUNCE_SECONDS = float(os.getenv('NOTION_DEBOUNCE_SECONDS', '3'))
+NOTION_MIN_POLL_INTERVAL = float(os.getenv('NOTION_MIN_POLL_INTERVAL', '1'))
+NOTION_MAX_POLL_INTERVAL = float(os.getenv('NOTION_MAX_POLL_INTERVAL', '30'))
+NOTION_POLL_BACKOFF = float(os.getenv('NOTION_POLL_BACKOFF', '1.5'))
+# Notionのlast_edited_timeは分単位に丸められるため、変化を検知してからしばらくはブロックを取得し続ける。
+# デバウンス後の取得もこの間に行うため、NOTION_DEBOUNCE_SECONDSより長くする
+NOTION_ACTIVE_WINDOW = float(os.getenv('NOTION_ACTIVE_WINDOW', '60'))
+# ストリーミング中にページへコメントを追加する最短の間隔（秒）。その間に届いたコメントは次の追加にまとめる
+NOTION_STREAM_WRITE_INTERVAL = float(os.getenv('NOTION_STREAM_WRITE_INTERVAL', '1'))
 
 
 class NotionAssistant:
-    def __init__(self, notion_api_key, database_id, page_name, openai_api_key, prompt_file_path, md_file_path, diff_file_path, auto_mode=True):
-        self.notion_agent = NotionAgent(notion_api_key, database_id)
-        self.llm_agent = LLMAgent()
+    def __init__(self, notion_api_key, database_id, page_name, openai_api_key, prompt_file_path, md_file_path, diff_file_path, auto_mode=True, debounce_seconds=NOTION_DEBOUNCE_SECONDS, min_poll_interval=NOTION_MIN_POLL_INTERVAL, max_poll_interval=NOTION_MAX_POLL_INTERVAL, poll_backoff=NOTION_POLL_BACKOFF, active_window=NOTION_ACTIVE_WINDOW, stream_write_interval=NOTION_STREAM_WRITE_INTERVAL, notion_agent=None, llm_agent=None, prompt=None):
+        self.notion_agent = notion_agent or NotionAgent(notion_api_key, database_id)
+        self.llm_agent = llm_agent or LLMAgent()
         self.page_name = page_name
         self.prompt_file_path = prompt_file_path
         self.md_file_path = md_file_path
@@ -33,11 +44,21 @@ class NotionAssistant:
         self.saved_md_content = None
         self.is_updated = False
         self.last_update_time = None
-        self.prompt = None
+        self.prompt = prompt
         self.diff_content = None
+        self.diff_payload_builder = DiffPayloadBuilder()
         self.page_id = None
-        with open(self.prompt_file_path, 'r', encoding='utf-8') as file:
-            self.prompt = file.read()
+        self.last_edited_time = None
+        self.last_activity_time = None
+        self.debounce_seconds = debounce_seconds
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.poll_backoff = poll_backoff
+        self.active_window = active_window
+        self.stream_write_interval = stream_write_interval
+        if self.prompt is None:
+            with open(self.prompt_file_path, 'r', encoding='utf-8') as file:
+                self.prompt = file.read()
 
     def save_to_file(self, markdown_content, file_path):
         with open(file_path, 'w', encoding='utf-8') as f:
@@ -45,15 +66,28 @@ class NotionAssistant:
 
     async def assist_notion(self):
         print("LLMに送信します。")
-        llm_response = await self.llm_agent(system_message=self.prompt, human_message=self.diff_content)
-        # コメントを追加
-        comments = json.loads(llm_response)
+        unplaced_comments = []
+        started_at = time.monotonic()
+        time_to_first_comment = None
+
+        async def add_comments(comments):
+            # 生成が続いている間も、届いたコメントから順にページへ追加する。
+            # 追加のたびにブロックを辿り直すので、stream_write_interval秒の間に届いたコメントはまとめる
+            nonlocal time_to_first_comment
+            if time_to_first_comment is None:
+                time_to_first_comment = time.monotonic() - started_at
+            unplaced_comments.extend(await self.notion_agent.add_texts_to_notion(self.page_id, comments))
+
+        comments = await apply_incrementally(
+            self.llm_agent.stream_json_array(system_message=self.prompt, human_message=self.diff_content),
+            add_comments, min_interval=self.stream_write_interval)
         print(f"コメント: {comments}")
-        for comment in comments:
-            self.notion_agent.add_text_to_notion(
-                self.page_id, comment['position'], comment['comment'])
-        self.previous_md_content, _, _ = self.notion_agent.get_page_content(
-            page_name=self.page_name)
+        if time_to_first_comment is not None:
+            print(f"最初のコメントまで{time_to_first_comment:.2f}秒")
+        with shared_metrics.stage('fetch'):
+            markdown_content, last_edited_time = await self.notion_agent.get_page_content_by_id(self.page_id)
+        if markdown_content is not None:
+            self.previous_md_content, self.last_edited_time = markdown_content, last_edited_time
         print(f"ページの中身が保存され、コメントが追加されました。最終更新日時: {
             self.last_update_time}")
 
@@ -67,57 +101,130 @@ class NotionAssistant:
     def contains_unmarked_user_input(self, markdown_content):
         return "user:" in markdown_content and "!user:" not in markdown_content
 
-    async def run_schedule(self):
-        self.previous_md_content, _, _ = self.notion_agent.get_page_content(
-            page_name=self.page_name)
+    async def resolve_page_id(self):
+        # ページIDは一度だけ名前から引く
+        if self.page_id is None:
+            self.page_id = await self.notion_agent.get_page_id_by_name(self.page_name)
+        return self.page_id
+
+    async def probe_page(self):
+        # ページの最終更新日時だけを確認し、ブロックを取得する必要があるかを判定する
+        last_edited_time = await self.notion_agent.get_page_last_edited_time(self.page_id)
+        if last_edited_time is None:
+            self.page_id = None
+            return False
+        if last_edited_time != self.last_edited_time:
+            self.last_edited_time = last_edited_time
+            self.last_activity_time = time.time()
+            return True
+        return self.is_active(time.time())
+
+    def is_active(self, now):
+        # 最終更新日時か内容が最後に変化してからactive_windowの間だけ取得を続ける
+        return self.last_activity_time is not None and now - self.last_activity_time < self.active_window
+
+    async def poll(self):
+        # 最終更新日時の確認からコメントの書き戻しまでを1サイクルとして記録する
+        with shared_metrics.cycle('notion'):
+            with shared_metrics.stage('fetch'):
+                if not await self.resolve_page_id():
+                    return False
+                if not await self.probe_page():
+                    return False
+            await self.fetch_and_save_content()
+            return True
+
+    async def initialize_content(self):
+        # 取得に失敗した場合は状態を変えずにFalseを返す
+        if not await self.resolve_page_id():
+            return False
+        markdown_content, last_edited_time = await self.notion_agent.get_page_content_by_id(self.page_id)
+        if markdown_content is None:
+            return False
+        self.previous_md_content, self.last_edited_time = markdown_content, last_edited_time
         self.save_to_file(self.previous_md_content, self.md_file_path)
         self.saved_md_content = self.previous_md_content
         self.is_updated = False
         self.last_update_time = time.time()
+        return True
+
+    async def run_schedule(self):
+        await shared_metrics.start_server()
+        install_flight_recorder()
+        while not await self.initialize_content():
+            print(f"ページを取得できませんでした。{self.max_poll_interval}秒後に再試行します。")
+            await asyncio.sleep(self.max_poll_interval)
+        self.llm_agent.start_warm_up()
         print("ページが更新検知開始")
+        poll_interval = self.min_poll_interval
         while True:
-            await self.fetch_and_save_content()
+            try:
+                is_active = await self.poll()
+            except Exception as e:
+                print(e)
+                is_active = False
+            # 編集中は間隔を詰め、変化がなければ徐々に間隔を広げる
+            if is_active:
+                poll_interval = self.min_poll_interval
+            else:
+                poll_interval = min(poll_interval * self.poll_backoff, self.max_poll_interval)
+            await asyncio.sleep(poll_interval)
 
     async def fetch_and_save_content(self):
-        try:
-            markdown_content, last_edited_time, self.page_id = self.notion_agent.get_page_content(
-                page_name=self.page_name)
-            if not markdown_content:
-                print("ページが見つかりませんでした。")
-                return
-            if markdown_content != self.previous_md_content:
-                print("ページが更新されました。")
-                self.is_updated = True
-                # 変化があった場合、更新時間を記録
-                self.previous_md_content = markdown_content
-                self.last_update_time = time.time()
-            elif not self.auto_mode and self.is_updated and time.time() - self.last_update_time >= 3:
-                if self.contains_unmarked_user_input(markdown_content):
-                    self.diff_content = self.notion_agent.get_diff_to_file(
-                        self.saved_md_content, markdown_content)
-                    await self.assist_notion()
-                    markdown_content = self.remove_user_input(
-                        markdown_content)
-                    self.save_to_file(
-                        markdown_content, self.md_file_path)
-                    self.save_to_file(
-                        self.diff_content, self.diff_file_path)
+        with shared_metrics.cycle('notion') as cycle:
+            try:
+                with shared_metrics.stage('fetch'):
+                    markdown_content, _ = await self.notion_agent.get_page_content_by_id(
+                        self.page_id)
+                if markdown_content is None:
+                    print("ページを取得できなかったため、このサイクルを見送ります。")
+                    return
+                with shared_metrics.stage('detect'):
+                    is_changed = markdown_content != self.previous_md_content
+                    is_settled = self.is_updated and time.time() - self.last_update_time >= self.debounce_seconds
+                if is_changed:
+                    print("ページが更新されました。")
+                    cycle.changed = True
+                    self.is_updated = True
+                    # 変化があった場合、更新時間を記録
+                    self.previous_md_content = markdown_content
+                    self.last_update_time = time.time()
+                    self.last_activity_time = self.last_update_time
+                elif not self.auto_mode and is_settled:
+                    if self.contains_unmarked_user_input(markdown_content):
+                        cycle.changed = True
+                        with shared_metrics.stage('diff'):
+                            self.diff_content = self.diff_payload_builder.build(
+                                self.saved_md_content, markdown_content)
+                        await self.assist_notion()
+                        markdown_content = self.remove_user_input(
+                            markdown_content)
+                        with shared_metrics.stage('save'):
+                            self.save_to_file(
+                                markdown_content, self.md_file_path)
+                            self.save_to_file(
+                                self.diff_content, self.diff_file_path)
+                        self.saved_md_content = markdown_content
+                    # 「user:」がない編集は保存せずに次の変化を待つ。差分は前回保存した内容から取る
+                    self.is_updated = False
+                elif self.auto_mode and is_settled:
+                    # 一定時間変化がなかった場合、保存してLLMに送信
+                    cycle.changed = True
+                    with shared_metrics.stage('diff'):
+                        self.diff_content = self.diff_payload_builder.build(
+                            self.saved_md_content, markdown_content)
                     self.saved_md_content = markdown_content
+                    with shared_metrics.stage('save'):
+                        self.save_to_file(markdown_content, self.md_file_path)
+                        self.save_to_file(self.diff_content, self.diff_file_path)
+                    await self.assist_notion()
                     self.is_updated = False
-            elif self.auto_mode and self.is_updated and time.time() - self.last_update_time >= 3:
-                # 3秒間変化がなかった場合、保存してLLMに送信
-                self.diff_content = self.notion_agent.get_diff_to_file(
-                    self.saved_md_content, markdown_content)
-                self.saved_md_content = markdown_content
-                self.save_to_file(markdown_content, self.md_file_path)
-                self.save_to_file(self.diff_content, self.diff_file_path)
-                await self.assist_notion()
-                self.is_updated = False
-        except Exception as e:
-            print(e)
+            except Exception as e:
+                print(e)
 
 
 # 非同期関数を実行するためのエントリーポイント
-notion_assistant = NotionAssistant(NOTION_API_KEY, DATABASE_ID, PAGE_NAME,
-                                   OPENAI_API_KEY, prompt_file_path, md_file_path, diff_file_path, auto_mode)
-asyncio.run(notion_assistant.run_schedule())
+if __name__ == "__main__":
+    notion_assistant = NotionAssistant(NOTION_API_KEY, DATABASE_ID, PAGE_NAME,
+                                       OPENAI_API_KEY, prompt_file_path, md_file_path, diff_file_path, auto_mode)
+    asyncio.run(notion_assistant.run_schedule())
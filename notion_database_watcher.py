@@ -0,0 +1,159 @@
+import os
+import time
+import asyncio
+from notion_agent import NotionAgent
+from notion_assistant import NotionAssistant, NOTION_API_KEY, DATABASE_ID, OPENAI_API_KEY, prompt_file_path
+from llm_agent import LLMAgent
+from metrics import shared_metrics
+from flight_recorder import install_flight_recorder
+from dotenv import load_dotenv
+
+load_dotenv()
+NOTION_DATABASE_POLL_INTERVAL = float(os.getenv('NOTION_DATABASE_POLL_INTERVAL', '2'))
+NOTION_DATABASE_CONCURRENCY = int(os.getenv('NOTION_DATABASE_CONCURRENCY', '4'))
+# この秒数ごとに更新日時で絞らずに全ページを一覧し、データベースから消えたページの監視をやめる
+NOTION_DATABASE_FULL_SYNC_INTERVAL = float(os.getenv('NOTION_DATABASE_FULL_SYNC_INTERVAL', '300'))
+pages_path = './pages'
+
+auto_mode = True
+
+
+class NotionDatabaseWatcher:
+    def __init__(self, notion_api_key, database_id, openai_api_key, prompt_file_path, pages_path, auto_mode=True, poll_interval=NOTION_DATABASE_POLL_INTERVAL, max_concurrency=NOTION_DATABASE_CONCURRENCY, full_sync_interval=NOTION_DATABASE_FULL_SYNC_INTERVAL):
+        self.notion_agent = NotionAgent(notion_api_key, database_id)
+        self.llm_agent = LLMAgent()
+        self.notion_api_key = notion_api_key
+        self.database_id = database_id
+        self.openai_api_key = openai_api_key
+        self.prompt_file_path = prompt_file_path
+        self.pages_path = pages_path
+        self.auto_mode = auto_mode
+        self.poll_interval = poll_interval
+        self.full_sync_interval = full_sync_interval
+        self.full_synced_at = None
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        # ページIDごとの状態（保存済みマークダウン・デバウンス用の時刻など）
+        self.page_assistants = {}
+        self.last_edited_time = None
+        with open(self.prompt_file_path, 'r', encoding='utf-8') as file:
+            self.prompt = file.read()
+        if not os.path.exists(self.pages_path):
+            os.makedirs(self.pages_path)
+
+    def create_page_assistant(self, page):
+        page_assistant = NotionAssistant(
+            self.notion_api_key, self.database_id, page['title'], self.openai_api_key,
+            self.prompt_file_path,
+            f"{self.pages_path}/{page['id']}.md",
+            f"{self.pages_path}/{page['id']}_diff.md",
+            self.auto_mode,
+            notion_agent=self.notion_agent,
+            llm_agent=self.llm_agent,
+            prompt=self.prompt)
+        page_assistant.page_id = page['id']
+        self.page_assistants[page['id']] = page_assistant
+        return page_assistant
+
+    def load_saved_content(self, page_assistant, page):
+        # 前回保存したマークダウンを基準にする。保存後に編集された可能性があれば最初のポーリングで取得する
+        if not os.path.exists(page_assistant.md_file_path):
+            return False
+        with open(page_assistant.md_file_path, 'r', encoding='utf-8') as file:
+            page_assistant.saved_md_content = file.read()
+        page_assistant.previous_md_content = page_assistant.saved_md_content
+        page_assistant.last_update_time = time.time()
+        # last_edited_timeは分単位に丸められるため、保存時刻と同じ分の編集も取得の対象にする
+        if not self.notion_agent.is_settled(page['last_edited_time'], os.path.getmtime(page_assistant.md_file_path)):
+            page_assistant.last_activity_time = time.time()
+        return True
+
+    def remove_page(self, page_id):
+        # 削除・アーカイブされたページの監視をやめ、保存したマークダウンも消す
+        page_assistant = self.page_assistants.pop(page_id, None)
+        if page_assistant is None:
+            return
+        print(f"ページ「{page_assistant.page_name}」が削除されました。")
+        for file_path in (page_assistant.md_file_path, page_assistant.diff_file_path):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def update_last_edited_time(self, pages):
+        for page in pages:
+            if page['last_edited_time'] and (self.last_edited_time is None or page['last_edited_time'] > self.last_edited_time):
+                self.last_edited_time = page['last_edited_time']
+
+    async def fetch_page(self, page_assistant):
+        async with self.semaphore:
+            if page_assistant.saved_md_content is None:
+                # 保存したマークダウンのないページは、最初に更新を検知したときの内容を基準にする
+                await page_assistant.initialize_content()
+                return
+            await page_assistant.fetch_and_save_content()
+
+    async def initialize(self):
+        # 起動時にはブロックを取得せず、各ページの基準は保存したマークダウンか最初の取得で作る
+        pages = await self.notion_agent.query_database_pages()
+        if pages is None:
+            return
+        self.full_synced_at = time.monotonic()
+        pages = [page for page in pages if not page['archived']]
+        loaded_count = 0
+        for page in pages:
+            page_assistant = self.create_page_assistant(page)
+            page_assistant.last_edited_time = page['last_edited_time']
+            loaded_count += self.load_saved_content(page_assistant, page)
+        self.update_last_edited_time(pages)
+        print(f"{len(pages)}件のページの監視を開始します（保存済み: {loaded_count}件）。")
+
+    async def poll(self):
+        # 通常は前回以降に更新されたページだけを問い合わせ、一定時間ごとに全ページを一覧する
+        is_full_sync = self.full_synced_at is None or time.monotonic() - self.full_synced_at >= self.full_sync_interval
+        with shared_metrics.cycle('notion_database'), shared_metrics.stage('fetch'):
+            pages = await self.notion_agent.query_database_pages(since=None if is_full_sync else self.last_edited_time)
+        if pages is None:
+            return
+        if is_full_sync:
+            self.full_synced_at = time.monotonic()
+            listed_ids = {page['id'] for page in pages}
+            for page_id in [page_id for page_id in self.page_assistants if page_id not in listed_ids]:
+                self.remove_page(page_id)
+        now = time.time()
+        for page in pages:
+            if page['archived']:
+                self.remove_page(page['id'])
+                continue
+            page_assistant = self.page_assistants.get(page['id'])
+            if page_assistant is None:
+                print(f"ページ「{page['title']}」が追加されました。")
+                page_assistant = self.create_page_assistant(page)
+                page_assistant.saved_md_content = ""
+            if page['last_edited_time'] != page_assistant.last_edited_time:
+                page_assistant.last_edited_time = page['last_edited_time']
+                page_assistant.last_activity_time = now
+        self.update_last_edited_time(pages)
+        # 最近変化のあったページだけを差分検出とLLMに回す。デバウンス待ちもこの期間に含まれる
+        active_page_assistants = [
+            page_assistant for page_assistant in self.page_assistants.values()
+            if page_assistant.is_active(now)
+        ]
+        await asyncio.gather(*[self.fetch_page(page_assistant) for page_assistant in active_page_assistants])
+
+    async def run_schedule(self):
+        await shared_metrics.start_server()
+        install_flight_recorder()
+        await self.initialize()
+        self.llm_agent.start_warm_up()
+        print("データベース更新検知開始")
+        while True:
+            try:
+                await self.poll()
+            except Exception as e:
+                print(e)
+            await asyncio.sleep(self.poll_interval)
+
+
+# 非同期関数を実行するためのエントリーポイント
+if __name__ == "__main__":
+    notion_database_watcher = NotionDatabaseWatcher(
+        NOTION_API_KEY, DATABASE_ID, OPENAI_API_KEY, prompt_file_path, pages_path, auto_mode)
+    asyncio.run(notion_database_watcher.run_schedule())
@@ -0,0 +1,120 @@
+import os
+import time
+import asyncio
+from datetime import datetime
+from collections import Counter
+from email.utils import parsedate_to_datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+GITHUB_REQUESTS_PER_SECOND = float(os.getenv('GITHUB_REQUESTS_PER_SECOND', '10'))
+GITHUB_RATE_LIMIT_RESERVE = int(os.getenv('GITHUB_RATE_LIMIT_RESERVE', '200'))
+NOTION_REQUESTS_PER_SECOND = float(os.getenv('NOTION_REQUESTS_PER_SECOND', '3'))
+
+# 値が小さいほど優先される。書き戻しはポーリングより先に通す
+PRIORITY_WRITE = 0
+PRIORITY_READ = 1
+PRIORITY_POLL = 2
+
+
+class RequestDropped(Exception):
+    pass
+
+
+class ApiBudget:
+    def __init__(self, name, requests_per_second, burst, reserve=0):
+        self.name = name
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.reserve = reserve
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.waiting = Counter()
+        # APIから学習した残り回数とリセット時刻
+        self.remaining = None
+        self.reset_at = None
+        # GraphQLの1クエリあたりのコスト（ポイント）。リクエストごとに残り回数から差し引いておく
+        self.cost = 1
+        self.blocked_until = 0
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.requests_per_second)
+        self.updated_at = now
+
+    def is_exhausted(self):
+        if self.remaining is None or self.remaining > self.reserve:
+            return False
+        return self.reset_at is None or self.reset_at > time.time()
+
+    async def acquire(self, priority=PRIORITY_READ):
+        # 残りが予備分を切ったら、リセットまで低優先度のポーリングは捨てる
+        if priority >= PRIORITY_POLL and self.is_exhausted():
+            raise RequestDropped(f"{self.name} の残りリクエスト数が少ないためポーリングを見送りました。")
+        self.waiting[priority] += 1
+        try:
+            while True:
+                delay = self.blocked_until - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                self.refill()
+                has_higher_priority = any(self.waiting[p] for p in range(priority))
+                if self.tokens >= 1 and not has_higher_priority:
+                    self.tokens -= 1
+                    # 応答で実際の値に更新されるまで、送ったリクエストのコストを残り回数から引いておく
+                    if self.remaining is not None:
+                        self.remaining -= self.cost
+                    return
+                await asyncio.sleep(max((1 - self.tokens) / self.requests_per_second, 0.01))
+        finally:
+            self.waiting[priority] -= 1
+
+    def block_for(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers):
+        remaining = headers.get('x-ratelimit-remaining')
+        if remaining is not None:
+            self.remaining = int(remaining)
+        reset = headers.get('x-ratelimit-reset')
+        if reset is not None:
+            self.reset_at = float(reset)
+        if self.remaining == 0 and self.reset_at:
+            self.block_for(self.reset_at - time.time())
+
+    def update_from_graphql(self, rate_limit):
+        # GraphQLの rateLimit { cost remaining resetAt } を反映する
+        if not rate_limit:
+            return
+        self.remaining = rate_limit.get('remaining', self.remaining)
+        self.cost = max(1, rate_limit.get('cost') or 1)
+        if rate_limit.get('resetAt'):
+            self.reset_at = datetime.fromisoformat(rate_limit['resetAt'].replace('Z', '+00:00')).timestamp()
+        # 次のクエリで上限を超える場合は、リセットまですべてのリクエストを止める
+        if self.remaining is not None and self.remaining <= self.cost and self.reset_at:
+            self.block_for(self.reset_at - time.time())
+
+
+def get_retry_after(headers):
+    retry_after = headers.get('retry-after')
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        return max(0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+
+
+class RequestBudgeter:
+    def __init__(self):
+        self.budgets = {
+            'github': ApiBudget('github', GITHUB_REQUESTS_PER_SECOND, GITHUB_REQUESTS_PER_SECOND, GITHUB_RATE_LIMIT_RESERVE),
+            'notion': ApiBudget('notion', NOTION_REQUESTS_PER_SECOND, NOTION_REQUESTS_PER_SECOND),
+        }
+
+    def get_budget(self, api):
+        return self.budgets.get(api)
+
+
+shared_request_budgeter = RequestBudgeter()
@@ -0,0 +1,173 @@
+import os
+import shutil
+import sqlite3
+import hashlib
+from dotenv import load_dotenv
+from diff_engine import get_diff_content
+
+load_dotenv()
+SNAPSHOT_BACKEND = os.getenv('SNAPSHOT_BACKEND', 'files')
+# 最新版を含めて、アイテムごとに保持する版の数
+SNAPSHOT_HISTORY_SIZE = int(os.getenv('SNAPSHOT_HISTORY_SIZE', '10'))
+
+
+class FileSnapshotBackend:
+    # 最新版を {id}.md に、それより前の版を .history/{id}/{版番号}.md に保存する
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def get_file_path(self, item_id):
+        return os.path.join(self.directory, f"{item_id}.md")
+
+    def get_history_path(self, item_id):
+        return os.path.join(self.directory, '.history', item_id)
+
+    def get_history_versions(self, item_id):
+        history_path = self.get_history_path(item_id)
+        if not os.path.exists(history_path):
+            return []
+        return sorted(int(name[:-len('.md')]) for name in os.listdir(history_path) if name.endswith('.md'))
+
+    def read_file(self, file_path):
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, 'r', encoding='utf-8') as file:
+            return file.read()
+
+    def read(self, item_id, versions_back=0):
+        if versions_back == 0:
+            return self.read_file(self.get_file_path(item_id))
+        versions = self.get_history_versions(item_id)
+        if versions_back > len(versions):
+            return None
+        return self.read_file(os.path.join(self.get_history_path(item_id), f"{versions[-versions_back]}.md"))
+
+    def count(self, item_id):
+        if not os.path.exists(self.get_file_path(item_id)):
+            return 0
+        return len(self.get_history_versions(item_id)) + 1
+
+    def write_file(self, file_path, content):
+        tmp_file_path = f"{file_path}.tmp"
+        with open(tmp_file_path, 'w', encoding='utf-8') as file:
+            file.write(content)
+        os.replace(tmp_file_path, file_path)
+
+    def write(self, item_id, content, history_size):
+        # 新しい内容で最新版を置き換えてから、読んでおいた前の版を履歴に書き出す。途中で落ちても最新版は必ず残る
+        file_path = self.get_file_path(item_id)
+        history_path = self.get_history_path(item_id)
+        versions = self.get_history_versions(item_id)
+        previous_content = self.read_file(file_path) if history_size > 1 else None
+        self.write_file(file_path, content)
+        if previous_content is not None:
+            if not os.path.exists(history_path):
+                os.makedirs(history_path)
+            next_version = versions[-1] + 1 if versions else 1
+            self.write_file(os.path.join(history_path, f"{next_version}.md"), previous_content)
+            versions.append(next_version)
+        for version in versions[:max(0, len(versions) - (history_size - 1))]:
+            os.remove(os.path.join(history_path, f"{version}.md"))
+
+    def remove(self, item_id):
+        file_path = self.get_file_path(item_id)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        shutil.rmtree(self.get_history_path(item_id), ignore_errors=True)
+
+    def close(self):
+        pass
+
+
+class SqliteSnapshotBackend:
+    # すべてのアイテムと版を一つのSQLiteファイルに保存する
+    def __init__(self, file_path):
+        directory = os.path.dirname(file_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(file_path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS snapshots ("
+            "item_id TEXT NOT NULL, version INTEGER NOT NULL, content TEXT NOT NULL, "
+            "PRIMARY KEY (item_id, version))")
+        self.connection.commit()
+
+    def read(self, item_id, versions_back=0):
+        row = self.connection.execute(
+            "SELECT content FROM snapshots WHERE item_id = ? ORDER BY version DESC LIMIT 1 OFFSET ?",
+            (item_id, versions_back)).fetchone()
+        return row[0] if row else None
+
+    def count(self, item_id):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM snapshots WHERE item_id = ?", (item_id,)).fetchone()[0]
+
+    def write(self, item_id, content, history_size):
+        with self.connection:
+            latest_version = self.connection.execute(
+                "SELECT MAX(version) FROM snapshots WHERE item_id = ?", (item_id,)).fetchone()[0] or 0
+            self.connection.execute(
+                "INSERT INTO snapshots (item_id, version, content) VALUES (?, ?, ?)",
+                (item_id, latest_version + 1, content))
+            self.connection.execute(
+                "DELETE FROM snapshots WHERE item_id = ? AND version <= ?",
+                (item_id, latest_version + 1 - history_size))
+
+    def remove(self, item_id):
+        with self.connection:
+            self.connection.execute("DELETE FROM snapshots WHERE item_id = ?", (item_id,))
+
+    def close(self):
+        self.connection.close()
+
+
+class SnapshotStore:
+    # 最新版の内容とハッシュをメモリに持ち、内容が変わったときだけ書き込む
+    def __init__(self, directory, backend=SNAPSHOT_BACKEND, history_size=SNAPSHOT_HISTORY_SIZE):
+        self.history_size = max(1, history_size)
+        if backend == 'sqlite':
+            self.backend = SqliteSnapshotBackend(os.path.join(directory, 'snapshots.sqlite3'))
+        else:
+            self.backend = FileSnapshotBackend(directory)
+        self.latest = {}
+
+    def get_content_hash(self, content):
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def load_latest(self, item_id):
+        # 最新版は初めて参照したときに一度だけ読み込む
+        if item_id not in self.latest:
+            content = self.backend.read(item_id)
+            self.latest[item_id] = (content, self.get_content_hash(content) if content is not None else None)
+        return self.latest[item_id]
+
+    def get(self, item_id, versions_back=0):
+        # versions_back=0 で最新版、1 で一つ前の版を返す。保存されていなければNone
+        if versions_back == 0:
+            return self.load_latest(item_id)[0]
+        return self.backend.read(item_id, versions_back)
+
+    def count_versions(self, item_id):
+        return self.backend.count(item_id)
+
+    def put(self, item_id, content):
+        # 最新版と同じ内容なら何もせずFalseを返す
+        content_hash = self.get_content_hash(content)
+        if self.load_latest(item_id)[1] == content_hash:
+            return False
+        self.backend.write(item_id, content, self.history_size)
+        self.latest[item_id] = (content, content_hash)
+        return True
+
+    def remove(self, item_id):
+        self.backend.remove(item_id)
+        self.latest.pop(item_id, None)
+
+    def diff(self, item_id, content, versions_back=0):
+        # 任意の過去の版と比較した差分を「--」「++」の形式で返す
+        return get_diff_content(self.get(item_id, versions_back) or "", content)
+
+    def close(self):
+        self.backend.close()
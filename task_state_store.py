@@ -0,0 +1,133 @@
+import os
+import json
+import hashlib
+
+
+class TaskStateStore:
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.tasks = {}
+        self.is_dirty = False
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.file_path):
+            return
+        try:
+            with open(self.file_path, 'r', encoding='utf-8') as file:
+                self.tasks = {task['id']: task for task in json.load(file)}
+        except (OSError, ValueError, KeyError) as e:
+            print(f"タスク状態の読み込みに失敗しました: {e}")
+            self.tasks = {}
+
+    def save(self):
+        if not self.is_dirty:
+            return
+        directory = os.path.dirname(self.file_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # 書き込み途中で落ちても壊れないよう、一時ファイルに書いてから置き換える
+        tmp_file_path = f"{self.file_path}.tmp"
+        with open(tmp_file_path, 'w', encoding='utf-8') as file:
+            json.dump(list(self.tasks.values()), file, ensure_ascii=False)
+        os.replace(tmp_file_path, self.file_path)
+        self.is_dirty = False
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __contains__(self, item_id):
+        return item_id in self.tasks
+
+    def get(self, item_id):
+        return self.tasks.get(item_id)
+
+    def remove(self, item_id):
+        if self.tasks.pop(item_id, None) is not None:
+            self.is_dirty = True
+
+    def create_task(self, item):
+        return {
+            'id': item['id'],
+            'title': item['title'],
+            'updatedAt': item['updatedAt'],
+            'content_hash': None,
+            'is_updated': False,
+            'is_created': False,
+            'is_deleted': False
+        }
+
+    def baseline(self, snapshot):
+        self.tasks = {item['id']: self.create_task(item) for item in snapshot}
+        self.is_dirty = True
+
+    def apply_item(self, item):
+        task = self.tasks.get(item['id'])
+        if task is None:
+            task = self.create_task(item)
+            task['is_created'] = True
+            self.tasks[item['id']] = task
+            self.is_dirty = True
+            return 'created'
+        if item['title'] != task['title']:
+            task['title'] = item['title']
+            self.is_dirty = True
+        if item['updatedAt'] != task['updatedAt']:
+            task['updatedAt'] = item['updatedAt']
+            task['is_updated'] = True
+            self.is_dirty = True
+            return 'updated'
+        return None
+
+    def mark_deleted(self, item_ids):
+        deleted_ids = {item_id for item_id in item_ids if item_id in self.tasks}
+        for item_id in deleted_ids:
+            self.tasks[item_id]['is_deleted'] = True
+        if deleted_ids:
+            self.is_dirty = True
+        return deleted_ids
+
+    def apply_items(self, items, requested_ids):
+        # 指定したIDのアイテムだけを反映し、取得できなかったものは削除扱いにする
+        created_ids, updated_ids = set(), set()
+        for item in items:
+            change = self.apply_item(item)
+            if change == 'created':
+                created_ids.add(item['id'])
+            elif change == 'updated':
+                updated_ids.add(item['id'])
+        fetched_ids = {item['id'] for item in items}
+        deleted_ids = self.mark_deleted(set(requested_ids) - fetched_ids)
+        return created_ids, updated_ids, deleted_ids
+
+    def apply_snapshot(self, snapshot):
+        # 集合の差分で作成・削除を、ID引きで更新を検出する
+        present_ids = {item['id'] for item in snapshot}
+        deleted_ids = self.mark_deleted(self.tasks.keys() - present_ids)
+        created_ids, updated_ids = set(), set()
+        for item in snapshot:
+            change = self.apply_item(item)
+            if change == 'created':
+                created_ids.add(item['id'])
+            elif change == 'updated':
+                updated_ids.add(item['id'])
+        return created_ids, updated_ids, deleted_ids
+
+    def reset_flags(self):
+        for task in self.tasks.values():
+            task['is_updated'] = False
+            task['is_created'] = False
+            task['is_deleted'] = False
+
+    def get_content_hash(self, content):
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def is_processed(self, item_id, content):
+        task = self.tasks.get(item_id)
+        return task is not None and task['content_hash'] == self.get_content_hash(content)
+
+    def mark_processed(self, item_id, content):
+        task = self.tasks.get(item_id)
+        if task is not None:
+            task['content_hash'] = self.get_content_hash(content)
+            self.is_dirty = True